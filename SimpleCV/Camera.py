@@ -13,32 +13,180 @@ import cv2
 import numpy as np
 import traceback
 import sys
+import select
+import errno
+import base64
+import urlparse
+import hashlib
 
 #Globals
 _cameras = []
-_camera_polling_thread = ""
 _index = []
 
 class FrameBufferThread(threading.Thread):
     """
     **SUMMARY**
 
-    This is a helper thread which continually debuffers the camera frames.  If
-    you don't do this, cameras may constantly give you a frame behind, which
+    This is a helper thread which continually debuffers the frames of one camera.
+    If you don't do this, cameras may constantly give you a frame behind, which
     causes problems at low sample rates.  This makes sure the frames returned
     by your camera are fresh.
 
+    Each threaded camera gets its own thread, which grabs and decodes frames as
+    fast as the device delivers them and pushes them onto a bounded queue
+    together with their capture time and frame index. When the queue is full
+    the drop policy decides what happens:
+
+    * "drop-oldest" - discard the oldest queued frame, so the reader always
+      gets the most recent frames. With a buffer size of 1 this is the classic
+      "latest frame" behavior.
+    * "block" - wait for the reader to catch up, so no frame is ever lost.
+
+    The newest frame is also kept in a slot that getLatest() reads without taking
+    it, so any number of readers can look at the latest frame; getFrame() takes
+    frames off the queue for a reader that wants every one of them. With
+    "drop-oldest" frames only go on the queue once getFrame() has been called, so
+    a camera that is only read through getLatest() doesn't count every frame after
+    the first in droppedframes.
+
     """
+    DROP_POLICIES = ["drop-oldest", "block"]
+
+    def __init__(self, camera, buffersize=1, droppolicy="drop-oldest"):
+        super(FrameBufferThread, self).__init__()
+        if droppolicy not in self.DROP_POLICIES:
+            raise ValueError("FrameBufferThread: droppolicy must be one of " + str(self.DROP_POLICIES))
+        self.camera = camera
+        self.droppolicy = droppolicy
+        self.frames = Queue.Queue(max(1, buffersize))
+        self.frameindex = 0 #frames grabbed so far, including dropped ones
+        self.droppedframes = 0
+        self.daemon = True
+        self._stop = threading.Event()
+        self._mLatest = None #(image, capture time) of the newest frame
+        self._mQueueRead = False #set by the first getFrame(), until then drop-oldest doesn't queue
+        self._mLatestCondition = threading.Condition()
+        self.name = 'Thread-Camera-' + str(camera.index)
+
+    def _grab(self):
+        cam = self.camera
+        if cam.pygame_camera:
+            surface = cam.capture.get_image()
+            capturetime = time.time()
+            return Image(surface, cam), capturetime
+
+        if not cv.GrabFrame(cam.capture):
+            return None, None
+        capturetime = time.time()
+        #the Image constructor copies the frame out of the capture's buffer
+        return Image(cv.RetrieveFrame(cam.capture), cam), capturetime
+
+    def _put(self, item):
+        while not self.stopped():
+            try:
+                self.frames.put_nowait(item)
+                return
+            except Queue.Full:
+                pass
+            if self.droppolicy == "block":
+                try:
+                    self.frames.put(item, timeout=0.1)
+                    return
+                except Queue.Full:
+                    continue
+            try:
+                self.frames.get_nowait()
+                self.droppedframes += 1
+            except Queue.Empty:
+                pass
+
     def run(self):
-        global _cameras
-        while (1):
-            for cam in _cameras:
-                if cam.pygame_camera:
-                    cam.pygame_buffer = cam.capture.get_image(cam.pygame_buffer)
-                else:
-                    cv.GrabFrame(cam.capture)
-                cam._threadcapturetime = time.time()
-            time.sleep(0.04)    #max 25 fps, if you're lucky
+        while not self.stopped():
+            img, capturetime = self._grab()
+            if img is None:
+                time.sleep(0.001) #no frame ready, don't spin
+                continue
+            img.capturetime = capturetime
+            img.frameindex = self.frameindex
+            self.camera._threadcapturetime = capturetime
+            self.frameindex += 1
+            with self._mLatestCondition:
+                self._mLatest = (img, capturetime)
+                self._mLatestCondition.notifyAll()
+            if self._mQueueRead or self.droppolicy == "block":
+                self._put((img, capturetime))
+
+    def getLatest(self, timeout=None):
+        """
+        **SUMMARY**
+
+        Return the newest frame without taking it off the queue, waiting only if no
+        frame has been grabbed yet. Calling this twice in a row returns the same frame
+        unless a new one arrived in between.
+
+        **PARAMETERS**
+
+        * *timeout* - the longest to wait for the first frame in seconds, or None to
+          wait forever.
+
+        **RETURNS**
+
+        A tuple of (image, capture time), or (None, None) if no frame arrived in time
+        or the thread has stopped.
+
+        """
+        end = None
+        if timeout is not None:
+            end = time.time() + timeout
+        with self._mLatestCondition:
+            while self._mLatest is None and self.isAlive():
+                wait = 0.1
+                if end is not None:
+                    wait = min(wait, end - time.time())
+                    if wait <= 0:
+                        break
+                self._mLatestCondition.wait(wait)
+            if self._mLatest is None:
+                return None, None
+            return self._mLatest
+
+    def getFrame(self, timeout=None):
+        """
+        **SUMMARY**
+
+        Take the next frame from the queue, waiting for one if it is empty.
+
+        **PARAMETERS**
+
+        * *timeout* - the longest to wait in seconds, or None to wait forever.
+
+        **RETURNS**
+
+        A tuple of (image, capture time), or (None, None) if no frame arrived in time
+        or the thread has stopped.
+
+        """
+        self._mQueueRead = True
+        end = None
+        if timeout is not None:
+            end = time.time() + timeout
+        while self.isAlive() or not self.frames.empty():
+            wait = 0.1
+            if end is not None:
+                wait = min(wait, end - time.time())
+                if wait <= 0:
+                    break
+            try:
+                return self.frames.get(timeout=wait)
+            except Queue.Empty:
+                continue
+        return None, None
+
+    def stop(self):
+        self._stop.set()
+
+    def stopped(self):
+        return self._stop.isSet()
 
 
 
@@ -52,6 +200,7 @@ class FrameSource:
     """
     _calibMat = "" #Intrinsic calibration matrix
     _distCoeff = "" #Distortion matrix
+    _undistortMaps = None #BufferCache of remap tables built from the calibration
     _threadcapturetime = '' #when the last picture was taken
     capturetime = '' #timestamp of the last aquired image
 
@@ -178,6 +327,7 @@ class FrameSource:
                             rcv, tcv, 0)
         self._calibMat = intrinsic_matrix
         self._distCoeff = distortion_coefficient
+        self._undistortMaps = None
         return intrinsic_matrix
 
     def getCameraMatrix(self):
@@ -190,11 +340,41 @@ class FrameSource:
         """
         return self._calibMat
 
-    def undistort(self, image_or_2darray):
+    def _getUndistortMaps(self, size, roi=None, scale=1.0):
+        """
+        Return the fixed point remap tables that undistort an image of the given
+        (width, height), restricted to roi and resized by scale. The tables are
+        built from the calibration on first use and cached per set of arguments.
+        """
+        if self._undistortMaps is None:
+            self._undistortMaps = BufferCache(FRAME_CACHE_BUDGET)
+        key = (size, roi, scale)
+        maps = self._undistortMaps.get(key)
+        if maps is not None:
+            return maps
+
+        x, y, w, h = 0, 0, size[0], size[1]
+        if roi is not None:
+            x, y, w, h = roi
+        #the output camera sees the roi of the undistorted image, scaled
+        K = np.array(self._calibMat, dtype=np.float64)
+        newK = K.copy()
+        newK[0, 0] *= scale
+        newK[1, 1] *= scale
+        newK[0, 2] = (K[0, 2] - x) * scale
+        newK[1, 2] = (K[1, 2] - y) * scale
+        outSize = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+        maps = cv2.initUndistortRectifyMap(K, np.array(self._distCoeff, dtype=np.float64),
+                                           None, newK, outSize, cv2.CV_16SC2)
+        return self._undistortMaps.put(key, maps)
+
+    def undistort(self, image_or_2darray, roi=None, scale=1.0):
         """
         **SUMMARY**
 
         If given an image, apply the undistortion given by the camera's matrix and return the result.
+        The undistortion is compiled into remap tables the first time an image of a given
+        size is seen, so every later frame is undistorted with a single remap.
 
         If given a 1xN 2D cvmat or a 2xN numpy array, it will un-distort points of
         measurement and return them in the original coordinate system.
@@ -202,6 +382,10 @@ class FrameSource:
         **PARAMETERS**
 
         * *image_or_2darray* - an image or an ndarray.
+        * *roi* - an (x, y, width, height) tuple. Only this region of the undistorted
+          image is computed and returned. Ignored for points.
+        * *scale* - a resize factor for the undistorted image, e.g. 0.5 returns it at half
+          resolution, for less work than undistorting and then scaling. Ignored for points.
 
         **RETURNS**
 
@@ -221,9 +405,11 @@ class FrameSource:
 
         if (type(image_or_2darray) == InstanceType and image_or_2darray.__class__ == Image):
             inImg = image_or_2darray # we have an image
-            retVal = inImg.getEmpty()
-            cv.Undistort2(inImg.getBitmap(), retVal, self._calibMat, self._distCoeff)
-            return Image(retVal)
+            if roi is not None:
+                roi = tuple(int(v) for v in roi)
+            map1, map2 = self._getUndistortMaps((inImg.width, inImg.height), roi, float(scale))
+            retVal = cv2.remap(inImg.getNumpyCv2(), map1, map2, cv2.INTER_LINEAR)
+            return Image.fromArray(retVal)
         else:
             mat = ''
             if (type(image_or_2darray) == cv.cvmat):
@@ -242,13 +428,18 @@ class FrameSource:
                 [self.getCameraMatrix()[0, 0], self.getCameraMatrix()[1, 1]] +\
                 [self.getCameraMatrix()[0, 2], self.getCameraMatrix()[1, 2]])[:, 0]
 
-    def getImageUndistort(self):
+    def getImageUndistort(self, roi=None, scale=1.0):
         """
         **SUMMARY**
 
         Using the overridden getImage method we retrieve the image and apply the undistortion
         operation.
 
+        **PARAMETERS**
+
+        * *roi* - an (x, y, width, height) tuple to undistort only that region, see undistort.
+        * *scale* - a resize factor for the undistorted image, see undistort.
+
 
         **RETURNS**
 
@@ -263,7 +454,7 @@ class FrameSource:
         >>>    img.show()
 
         """
-        return self.undistort(self.getImage())
+        return self.undistort(self.getImage(), roi, scale)
 
 
     def saveCalibration(self, filename):
@@ -328,6 +519,7 @@ class FrameSource:
         self._calibMat = cv.Load(intrFName)
         distFName = filename + "Distortion.xml"
         self._distCoeff = cv.Load(distFName)
+        self._undistortMaps = None
         if( type(self._distCoeff) == cv.cvmat
             and type(self._calibMat) == cv.cvmat):
             retVal = True
@@ -403,7 +595,7 @@ class Camera(FrameSource):
     capture = ""   #cvCapture object
     thread = ""
     pygame_camera = False
-    pygame_buffer = ""
+    frameindex = -1 #index of the last aquired image
 
 
     prop_map = {"width": cv.CV_CAP_PROP_FRAME_WIDTH,
@@ -416,9 +608,8 @@ class Camera(FrameSource):
         "exposure": cv.CV_CAP_PROP_EXPOSURE}
     #human readable to CV constant property mapping
 
-    def __init__(self, camera_index = -1, prop_set = {}, threaded = True, calibrationfile = ''):
+    def __init__(self, camera_index = -1, prop_set = {}, threaded = True, calibrationfile = '', buffersize = 1, droppolicy = "drop-oldest"):
         global _cameras
-        global _camera_polling_thread
         global _index
         """
         **SUMMARY**
@@ -428,9 +619,10 @@ class Camera(FrameSource):
         Supported props are currently: height, width, brightness, contrast,
         saturation, hue, gain, and exposure.
 
-        You can also specify whether you want the FrameBufferThread to continuously
+        You can also specify whether you want a FrameBufferThread to continuously
         debuffer the camera.  If you specify True, the camera is essentially 'on' at
-        all times.  If you specify off, you will have to manage camera buffers.
+        all times, with its own capture thread filling a queue of decoded frames.
+        If you specify off, you will have to manage camera buffers.
 
         **PARAMETERS**
 
@@ -446,11 +638,20 @@ class Camera(FrameSource):
 
         * *calibrationfile* - A calibration file to load.
 
+        * *buffersize* - The number of captured frames a threaded camera queues up
+          for getNextImage().
+
+        * *droppolicy* - What a threaded camera does when its queue is full. Either
+          "drop-oldest" to discard the oldest frame, or "block" to stop capturing
+          until getNextImage() catches up, so no frame is lost. With "block"
+          getImage() also reads the queue.
+
 
         """
         self.index = None
         self.threaded = False
         self.capture = None
+        self.thread = None
 
         if platform.system() == "Linux" and -1 in _index and camera_index != -1 and camera_index not in _index:
             process = subprocess.Popen(["lsof /dev/video"+str(camera_index)],shell=True,stdout=subprocess.PIPE)
@@ -469,6 +670,8 @@ class Camera(FrameSource):
                 self.threaded = cam.threaded
                 self.capture = cam.capture
                 self.index = cam.index
+                self.thread = cam.thread
+                self.pygame_camera = cam.pygame_camera
                 _cameras.append(self)
                 return
 
@@ -505,7 +708,6 @@ class Camera(FrameSource):
                 logger.warning("SimpleCV can't seem to find a camera on your system, or the drivers do not work with SimpleCV.")
                 return
             time.sleep(0)
-            self.pygame_buffer = self.capture.get_image()
             self.pygame_camera = True
         else:
             _index.append(camera_index)
@@ -524,11 +726,9 @@ class Camera(FrameSource):
         if (threaded):
             self.threaded = True
             _cameras.append(self)
-            if (not _camera_polling_thread):
-                _camera_polling_thread = FrameBufferThread()
-                _camera_polling_thread.daemon = True
-                _camera_polling_thread.start()
-                time.sleep(0) #yield to thread
+            self.thread = FrameBufferThread(self, buffersize, droppolicy)
+            self.thread.start()
+            time.sleep(0) #yield to thread
 
         if calibrationfile:
             self.loadCalibration(calibrationfile)
@@ -589,19 +789,28 @@ class Camera(FrameSource):
 
         return props
 
-    def getImage(self):
+    def getImage(self, timeout=5):
         """
         **SUMMARY**
 
-        Retrieve an Image-object from the camera.  If you experience problems
-        with stale frames from the camera's hardware buffer, increase the flushcache
-        number to dequeue multiple frames before retrieval
+        Retrieve an Image-object from the camera. A threaded camera returns a copy of
+        the newest frame its capture thread has grabbed straight away, only waiting up
+        to timeout seconds for the very first frame. Cameras sharing a device all see
+        the same newest frame. With droppolicy="block" the frames are instead taken
+        off the queue one by one, like getNextImage.
+
+        The image has a capturetime attribute with the time.time() at which the frame
+        was grabbed, and a frameindex attribute counting the frames grabbed by the
+        camera. The camera's own capturetime and frameindex are set to the same values.
 
-        We're working on how to solve this problem.
+        **PARAMETERS**
+
+        * *timeout* - for a threaded camera, the longest to wait for a frame in seconds.
 
         **RETURNS**
 
-        A SimpleCV Image from the camera.
+        A SimpleCV Image from the camera, or None if a threaded camera delivered no
+        frame in time.
 
         **EXAMPLES**
 
@@ -611,19 +820,308 @@ class Camera(FrameSource):
 
         """
 
-        if self.pygame_camera:
-            return Image(self.pygame_buffer.copy())
+        if (self.threaded and self.thread):
+            if self.thread.droppolicy == "block":
+                return self.getNextImage(timeout)
+            img, capturetime = self.thread.getLatest(timeout)
+            if img is None:
+                self._warnNoFrame(timeout)
+                return None
+            return self._threadFrame(img, capturetime)
 
-        if (not self.threaded):
+        if self.pygame_camera:
+            img = Image(self.capture.get_image(), self)
+            self.capturetime = time.time()
+        else:
             cv.GrabFrame(self.capture)
             self.capturetime = time.time()
+            img = Image(cv.RetrieveFrame(self.capture), self)
+        self.frameindex += 1
+        img.capturetime = self.capturetime
+        img.frameindex = self.frameindex
+        return img
+
+    def getNextImage(self, timeout=5):
+        """
+        **SUMMARY**
+
+        Take the next frame off a threaded camera's queue, waiting up to timeout
+        seconds if it is empty. Unlike getImage this returns every frame the queue
+        kept, in order; a gap in frameindex means frames were dropped. Cameras that
+        share a device also share its queue, so each frame goes to only one of them.
+        With droppolicy="drop-oldest" the queue only starts filling at the first call.
+        An unthreaded camera just grabs a new frame.
+
+        **PARAMETERS**
+
+        * *timeout* - the longest to wait for a frame in seconds.
+
+        **RETURNS**
+
+        A SimpleCV Image from the camera, or None if no frame arrived in time.
+
+        **EXAMPLES**
+
+        >>> cam = Camera(buffersize=8, droppolicy="block")
+        >>> while True:
+        >>>    img = cam.getNextImage()
+
+        """
+        if not (self.threaded and self.thread):
+            return self.getImage()
+        img, capturetime = self.thread.getFrame(timeout)
+        if img is None:
+            self._warnNoFrame(timeout)
+            return None
+        return self._threadFrame(img, capturetime)
+
+    def _threadFrame(self, img, capturetime):
+        """
+        Return a copy of a frame from the capture thread for this camera. The thread
+        keeps the same frame as its latest, so callers drawing on their image must
+        not change anyone else's.
+        """
+        retVal = Image.fromArray(img.getNumpyCv2(), copy=True)
+        retVal.camera = self
+        retVal.capturetime = capturetime
+        retVal.frameindex = img.frameindex
+        self.capturetime = capturetime
+        self.frameindex = img.frameindex
+        return retVal
+
+    def _warnNoFrame(self, timeout):
+        if self.thread.isAlive():
+            logger.warning("Camera: no frame from the camera in " + str(timeout) + " seconds.")
         else:
-            self.capturetime = self._threadcapturetime
+            logger.warning("Camera: the capture thread has stopped.")
+
+
+def _videoReadAhead(ref, stop):
+    #the read-ahead thread of a _VideoReader, it only holds a weak reference so
+    #a reader that is dropped without close() can still be collected
+    while not stop.isSet():
+        reader = ref()
+        if reader is None:
+            return
+        reader._readAheadStep()
+        del reader
+
+
+class _VideoReader:
+    """
+    Random access reader for a video file, used by VirtualCamera. Positioning
+    is lazy, seek() only records the frame wanted next and the capture is only
+    moved when a frame has to be decoded. Short jumps forward just grab frames.
+    Longer ones use the backend's own seek, which decodes from the keyframe
+    before the target. With an index, which holds the timestamp of every frame
+    and is cached on disk beside the video (or in the temp directory), each
+    seek is checked against the timestamp of the frame it landed on and
+    corrected, so seeks are frame accurate even where the backend's are not.
+    Decoded frames are kept in an LRU cache of cachesize bytes, which
+    makes scrubbing back and forth cheap, and with readahead a background
+    thread decodes that many frames beyond the last one read.
+    """
+    maxgrab = 30 #jumps forward up to this many frames just grab their way there
+
+    def __init__(self, filename, index=False, readahead=0, cachesize=FRAME_CACHE_BUDGET):
+        self.filename = filename
+        self.capture = cv2.VideoCapture(filename)
+        self.pos = 0 #the next frame read() returns
+        self.readahead = readahead
+        self.timestamps = None
+        self._mCapPos = 0 #the next frame the capture decodes
+        self._mEnd = None #the number of frames, once it is known
+        self._mCache = BufferCache(cachesize)
+        self._mLock = threading.Condition()
+        self._mAhead = (0, 0, 0) #(next frame to decode ahead, end of the window, bytes decoded in it)
+        if index:
+            self.timestamps = self._loadIndex()
+            self._mEnd = len(self.timestamps)
+        self._mStop = threading.Event()
+        self._mThread = None
+        if readahead > 0:
+            self._mThread = threading.Thread(target=_videoReadAhead, args=(weakref.ref(self), self._mStop))
+            self._mThread.daemon = True
+            self._mThread.start()
+
+    def _indexFiles(self):
+        path = os.path.abspath(self.filename)
+        yield path + ".index.npz"
+        yield os.path.join(tempfile.gettempdir(), "simplecv-" + hashlib.md5(path).hexdigest() + ".index.npz")
+
+    def _loadIndex(self):
+        stat = os.stat(self.filename)
+        for fname in self._indexFiles():
+            try:
+                npz = np.load(fname)
+            except IOError:
+                continue
+            try:
+                if int(npz['size']) == stat.st_size and float(npz['mtime']) == stat.st_mtime:
+                    return npz['timestamps']
+            except Exception:
+                pass #not an index we wrote, or a stale one
+            finally:
+                npz.close()
+
+        #one pass through the file, grabbing without converting the frames
+        scan = cv2.VideoCapture(self.filename)
+        timestamps = []
+        while scan.grab():
+            timestamps.append(scan.get(cv.CV_CAP_PROP_POS_MSEC))
+        scan.release()
+        timestamps = np.array(timestamps, dtype=np.float64)
+        for fname in self._indexFiles():
+            try:
+                fh = open(fname, 'wb')
+                try:
+                    np.savez(fh, size=stat.st_size, mtime=stat.st_mtime, timestamps=timestamps)
+                finally:
+                    fh.close()
+                break
+            except (IOError, OSError):
+                continue
+        return timestamps
+
+    def _frameAt(self, msec):
+        #the frame whose timestamp is closest to msec
+        idx = np.searchsorted(self.timestamps, msec)
+        if idx > 0 and (idx == len(self.timestamps) or msec - self.timestamps[idx-1] < self.timestamps[idx] - msec):
+            idx -= 1
+        return int(idx)
+
+    def _decodeNext(self):
+        ok, frame = self.capture.read()
+        if not ok:
+            self._mEnd = self._mCapPos
+            return None
+        self._mCapPos += 1
+        return self._mCache.put(self._mCapPos - 1, frame)
+
+    def _seekCapture(self, n):
+        #move the capture so frame n is either cached or decoded next
+        if self._mCapPos <= n <= self._mCapPos + self.maxgrab:
+            while self._mCapPos < n and self.capture.grab():
+                self._mCapPos += 1
+            return
+        if self.timestamps is None:
+            self.capture.set(cv.CV_CAP_PROP_POS_FRAMES, n)
+            self._mCapPos = n
+            return
+        back = 0
+        while True:
+            target = max(0, n - back)
+            self.capture.set(cv.CV_CAP_PROP_POS_FRAMES, target)
+            if not self.capture.grab():
+                self._mCapPos = n
+                return
+            landed = self._frameAt(self.capture.get(cv.CV_CAP_PROP_POS_MSEC))
+            if landed <= n:
+                break
+            if target == 0:
+                #even seeking to the start overshoots, read from the top of the file
+                self.capture.open(self.filename)
+                self._mCapPos = 0
+                while self._mCapPos < n and self.capture.grab():
+                    self._mCapPos += 1
+                return
+            back = max(1, back * 2) #overshot, start further back
+        if landed == n:
+            ok, frame = self.capture.retrieve()
+            if ok:
+                self._mCache.put(n, frame)
+        self._mCapPos = landed + 1
+        while self._mCapPos < n and self.capture.grab():
+            self._mCapPos += 1
+
+    def _readAheadStep(self):
+        #one turn of the read-ahead thread
+        self._mLock.acquire()
+        try:
+            (n, end, used) = self._mAhead
+            if self._mEnd is not None:
+                end = min(end, self._mEnd)
+            while n < end and n in self._mCache:
+                n += 1
+            if n >= end:
+                self._mLock.wait(0.1)
+                return
+            #one frame per turn, so read() never waits for more than one decode
+            self._seekCapture(n)
+            frame = self._mCache.get(n)
+            if frame is None:
+                frame = self._decodeNext()
+            if frame is None:
+                self._mAhead = (end, end, used)
+                return
+            used += frame.nbytes
+            if n not in self._mCache or used + frame.nbytes > self._mCache.budget:
+                #the cache can't hold any more of the window, decoding further
+                #would only evict frames read() is about to ask for
+                self._mAhead = (end, end, used)
+            else:
+                self._mAhead = (n + 1, end, used)
+        finally:
+            self._mLock.release()
+
+    def seek(self, n):
+        self.pos = max(0, n)
+
+    def read(self):
+        """
+        Return the frame at pos as a numpy array and move on to the next one, or
+        None at the end of the video.
+        """
+        self._mLock.acquire()
+        try:
+            n = self.pos
+            frame = self._mCache.get(n)
+            if frame is None:
+                if self._mEnd is not None and n >= self._mEnd:
+                    return None
+                self._seekCapture(n)
+                frame = self._mCache.get(n)
+                if frame is None:
+                    frame = self._decodeNext()
+                if frame is None:
+                    return None
+            self.pos = n + 1
+            if self.readahead > 0:
+                self._mAhead = (n + 1, n + 1 + self.readahead, 0)
+                self._mLock.notifyAll()
+            return frame
+        finally:
+            self._mLock.release()
+
+    def close(self):
+        """
+        Stop the read-ahead thread, release the video file and drop the cached frames.
+        """
+        self._mStop.set()
+        if self._mThread is not None and self._mThread is not threading.currentThread():
+            self._mThread.join()
+        self._mThread = None
+        self._mLock.acquire()
+        try:
+            self.capture.release()
+            self._mCache = BufferCache(self._mCache.budget)
+        finally:
+            self._mLock.release()
 
-        frame = cv.RetrieveFrame(self.capture)
-        newimg = cv.CreateImage(cv.GetSize(frame), cv.IPL_DEPTH_8U, 3)
-        cv.Copy(frame, newimg)
-        return Image(newimg, self)
+    def __del__(self):
+        if hasattr(self, "_mStop"):
+            self.close()
+
+    def playTime(self):
+        """
+        The time in milliseconds of the last frame read.
+        """
+        if self.timestamps is not None and 0 < self.pos <= len(self.timestamps):
+            return self.timestamps[self.pos - 1]
+        fps = self.capture.get(cv.CV_CAP_PROP_FPS)
+        if fps > 0:
+            return 1000.0 * max(0, self.pos - 1) / fps
+        return self.capture.get(cv.CV_CAP_PROP_POS_MSEC)
 
 
 class VirtualCamera(FrameSource):
@@ -647,7 +1145,7 @@ class VirtualCamera(FrameSource):
     sourcetype = ""
     lastmtime = 0
 
-    def __init__(self, s, st, start=1):
+    def __init__(self, s, st, start=1, index=False, readahead=0, cachesize=FRAME_CACHE_BUDGET):
         """
         **SUMMARY**
 
@@ -664,6 +1162,17 @@ class VirtualCamera(FrameSource):
           * "imageset" - a SimpleCV image set.
           * "directory" - a VirtualCamera for loading a directory
 
+        * *index* - for video, build an index of the timestamp of every frame on the first
+          open, and keep it on disk for the next, so seeks with getFrame, rewind and
+          skipFrames are frame accurate. Building it reads the whole file once.
+        * *readahead* - for video, decode this many frames ahead in a background thread.
+        * *cachesize* - for video, the bytes of decoded frames to keep, so going back over
+          recent frames doesn't decode them again. Read-ahead stops short of readahead frames
+          when they wouldn't fit in it.
+
+        Every video frame is copied into its own Image, so changing an image's pixels
+        never touches the cached frame other images are made from.
+
         **EXAMPLE**
 
         >>> vc = VirtualCamera("img.jpg", "image")
@@ -708,9 +1217,9 @@ class VirtualCamera(FrameSource):
             
 
         elif (self.sourcetype == 'video'):
-         
-            self.capture = cv.CaptureFromFile(self.source)
-            cv.SetCaptureProperty(self.capture, cv.CV_CAP_PROP_POS_FRAMES, self.start-1)
+            self._mVideo = _VideoReader(self.source, index, readahead, cachesize)
+            self._mVideo.seek(self.start-1)
+            self.capture = self._mVideo.capture
 
         elif (self.sourcetype == 'directory'):
             pass
@@ -743,14 +1252,15 @@ class VirtualCamera(FrameSource):
             return img
 
         elif (self.sourcetype == 'video'):
-            # cv.QueryFrame returns None if the video is finished
-            frame = cv.QueryFrame(self.capture)
-            if frame:
-                img = cv.CreateImage(cv.GetSize(frame), cv.IPL_DEPTH_8U, 3)
-                cv.Copy(frame, img)
-                return Image(img, self)
-            else:
+            # read returns None if the video is finished
+            frame = self._mVideo.read()
+            if frame is None:
                 return None
+            #the frame may be cached and handed out again, so the image gets its own copy
+            img = Image.fromArray(frame, copy=True)
+            img.camera = self
+            img.frameindex = self._mVideo.pos - 1
+            return img
 
         elif (self.sourcetype == 'directory'):
             img = self.findLastestImage(self.source, 'bmp')
@@ -787,11 +1297,11 @@ class VirtualCamera(FrameSource):
         """
         if (self.sourcetype == 'video'):
             if not start:
-                cv.SetCaptureProperty(self.capture, cv.CV_CAP_PROP_POS_FRAMES, self.start-1)
+                self._mVideo.seek(self.start-1)
             else:
                 if start==0:
                     start=1
-                cv.SetCaptureProperty(self.capture, cv.CV_CAP_PROP_POS_FRAMES, start-1)
+                self._mVideo.seek(start-1)
 
         else:
             self.counter = 0
@@ -818,10 +1328,10 @@ class VirtualCamera(FrameSource):
 
         """
         if (self.sourcetype == 'video'):
-            number_frame = int(cv.GetCaptureProperty(self.capture, cv.CV_CAP_PROP_POS_FRAMES))
-            cv.SetCaptureProperty(self.capture, cv.CV_CAP_PROP_POS_FRAMES, frame-1)
+            number_frame = self._mVideo.pos
+            self._mVideo.seek(frame-1)
             img = self.getImage()
-            cv.SetCaptureProperty(self.capture, cv.CV_CAP_PROP_POS_FRAMES, number_frame)
+            self._mVideo.seek(number_frame)
             return img
         elif (self.sourcetype == 'imageset'):
             img = None
@@ -859,8 +1369,7 @@ class VirtualCamera(FrameSource):
 
         """
         if (self.sourcetype == 'video'):
-            number_frame = int(cv.GetCaptureProperty(self.capture, cv.CV_CAP_PROP_POS_FRAMES))
-            cv.SetCaptureProperty(self.capture, cv.CV_CAP_PROP_POS_FRAMES, number_frame + n - 1)
+            self._mVideo.seek(self._mVideo.pos + n - 1)
         elif (self.sourcetype == 'imageset'):
             self.counter = (self.counter + n) % len(self.source)
         else:
@@ -889,11 +1398,27 @@ class VirtualCamera(FrameSource):
 
         """
         if (self.sourcetype == 'video'):
-            number_frame = int(cv.GetCaptureProperty(self.capture, cv.CV_CAP_PROP_POS_FRAMES))
-            return number_frame
+            return self._mVideo.pos
         else:
             return self.counter
 
+    def close(self):
+        """
+        **SUMMARY**
+
+        Release the video file of a video source, stopping its read-ahead thread.
+        The camera can't be read after this.
+
+        **EXAMPLES**
+
+        >>> cam = VirtualCamera("filename.avi", "video", readahead=8)
+        >>> cam.getImage().show()
+        >>> cam.close()
+
+        """
+        if (self.sourcetype == 'video'):
+            self._mVideo.close()
+
     def getCurrentPlayTime(self):
         """
         **SUMMARY**
@@ -917,7 +1442,7 @@ class VirtualCamera(FrameSource):
 
         """
         if (self.sourcetype == 'video'):
-            milliseconds = int(cv.GetCaptureProperty(self.capture, cv.CV_CAP_PROP_POS_MSEC))
+            milliseconds = int(self._mVideo.playTime())
             return milliseconds
         else:
             raise ValueError('sources other than video do not have play time property')
@@ -1050,6 +1575,123 @@ class Kinect(FrameSource):
 
 
 
+class _MJPEGParser:
+    """
+    Incremental parser for a multipart/x-mixed-replace stream of JPEGs. Bytes
+    are fed in as they arrive and whole frames come out. The buffer is only
+    ever searched in bulk, for the boundary, the end of the part headers and,
+    when a part has no Content-Length, the next boundary.
+    """
+    _headerEnd = re.compile("\r?\n\r?\n")
+    _header = re.compile("^content-(type|length)\\s*:\\s*(\\S+)", re.I | re.M)
+
+    def __init__(self, boundary):
+        self.boundary = boundary.strip().strip('"')
+        self.skippedparts = 0 #parts that weren't jpegs
+        self._mBuffer = ""
+        self._mLength = None #None while looking for the next part's headers, -1 if it has no length
+        self._mJpeg = True
+        self._mSearchFrom = 0
+
+    def need(self):
+        """
+        How many bytes to read next. Reads can block until they are filled, so
+        this never asks for more than the current part is known to have left.
+        """
+        if self._mLength is None:
+            return 512
+        if self._mLength < 0:
+            return 4096
+        return max(1, self._mLength - len(self._mBuffer))
+
+    def feed(self, data):
+        """
+        Add data to the buffer and return the list of JPEGs it completed.
+        """
+        buff = self._mBuffer + data if self._mBuffer else data
+        frames = []
+        pos = 0
+        while True:
+            if self._mLength is None:
+                start = buff.find(self.boundary, pos)
+                if start < 0:
+                    #keep enough to match a boundary split across reads
+                    pos = max(pos, len(buff) - len(self.boundary))
+                    break
+                match = self._headerEnd.search(buff, start)
+                if match is None:
+                    pos = start
+                    break
+                headers = dict((k.lower(), v) for (k, v) in self._header.findall(buff[start + len(self.boundary):match.start()]))
+                self._mJpeg = headers.get("type", "image/jpeg").lower().endswith("jpeg")
+                self._mLength = int(headers["length"]) if headers.get("length", "").isdigit() else -1
+                self._mSearchFrom = 0
+                pos = match.end()
+            elif self._mLength >= 0:
+                if len(buff) - pos < self._mLength:
+                    break
+                frame = buff[pos:pos + self._mLength]
+                pos += self._mLength
+                self._endPart(frame, frames)
+            else:
+                end = buff.find(self.boundary, max(pos, self._mSearchFrom))
+                if end < 0:
+                    self._mSearchFrom = max(pos, len(buff) - len(self.boundary))
+                    break
+                frame = buff[pos:end]
+                eoi = frame.rfind("\xff\xd9")
+                if eoi >= 0:
+                    frame = frame[:eoi + 2]
+                pos = end
+                self._endPart(frame, frames)
+        self._mSearchFrom -= pos
+        self._mBuffer = buff[pos:]
+        return frames
+
+    def _endPart(self, frame, frames):
+        if self._mJpeg and frame:
+            frames.append(frame)
+        else:
+            self.skippedparts += 1
+        self._mLength = None
+
+
+def _openJpegStream(url):
+    """
+    Open an MJPEG url, with basic auth if the url has a user:password@ in it,
+    and return (response, boundary), or (None, None) if it isn't an MJPEG stream.
+    """
+    if re.search('@', url):
+        authstuff = re.findall('//(\S+)@', url)[0]
+        url = re.sub("//\S+@", "//", url)
+        user, password = authstuff.split(":")
+
+        #thank you missing urllib2 manual
+        #http://www.voidspace.org.uk/python/articles/urllib2.shtml#id5
+        password_mgr = urllib2.HTTPPasswordMgrWithDefaultRealm()
+        password_mgr.add_password(None, url, user, password)
+
+        handler = urllib2.HTTPBasicAuthHandler(password_mgr)
+        opener = urllib2.build_opener(handler)
+
+        f = opener.open(url)
+    else:
+        f = urllib2.urlopen(url)
+
+    contenttype = f.info().getheader("content-type")
+    if not contenttype:
+        logger.warning("Tried to load a JpegStream from " + url + ", but didn't find a content-type header!")
+        f.close()
+        return None, None
+
+    if not re.search("multipart", contenttype, re.I) or "boundary=" not in contenttype:
+        logger.warning("Tried to load a JpegStream from " + url + ", but the content type header was " + contenttype + " not multipart/replace!")
+        f.close()
+        return None, None
+    boundary = contenttype.split("boundary=")[1].split(";")[0]
+    return f, boundary
+
+
 class JpegStreamReader(threading.Thread):
     """
     **SUMMARY**
@@ -1057,90 +1699,94 @@ class JpegStreamReader(threading.Thread):
     A Threaded class for pulling down JPEG streams and breaking up the images. This
     is handy for reading the stream of images from a IP CAmera.
 
+    The frames are kept as undecoded JPEG data in a bounded queue, the newest
+    buffersize of them. When a frame arrives while the queue is full the oldest
+    one is dropped and counted in droppedframes, so with the default size of 1
+    the reader always holds just the latest frame.
+
     """
     url = ""
     currentframe = ""
     _threadcapturetime = ""
 
-    def run(self):
-
-        f = ''
+    def __init__(self, url="", buffersize=1):
+        threading.Thread.__init__(self)
+        self.url = url
+        self.frames = collections.deque(maxlen=max(1, buffersize))
+        self.frameindex = 0 #frames received so far, including dropped ones
+        self.droppedframes = 0
+        self._mCondition = threading.Condition()
+        self._mLast = None
+        self._stop = threading.Event()
 
-        if re.search('@', self.url):
-            authstuff = re.findall('//(\S+)@', self.url)[0]
-            self.url = re.sub("//\S+@", "//", self.url)
-            user, password = authstuff.split(":")
+    def run(self):
+        f, boundary = _openJpegStream(self.url)
+        if f is None:
+            return
+        parser = _MJPEGParser(boundary)
+        try:
+            while not self.stopped():
+                data = f.read(parser.need())
+                if not data:
+                    logger.warning("The JpegStream from " + self.url + " ended")
+                    return
+                for frame in parser.feed(data):
+                    self._put(frame)
+        finally:
+            f.close()
 
-            #thank you missing urllib2 manual
-            #http://www.voidspace.org.uk/python/articles/urllib2.shtml#id5
-            password_mgr = urllib2.HTTPPasswordMgrWithDefaultRealm()
-            password_mgr.add_password(None, self.url, user, password)
+    def _put(self, frame):
+        self._mCondition.acquire()
+        try:
+            if len(self.frames) == self.frames.maxlen:
+                self.droppedframes += 1
+            self.frames.append((frame, time.time(), self.frameindex))
+            self.frameindex += 1
+            self.currentframe = frame
+            self._threadcapturetime = self.frames[-1][1]
+            self._mCondition.notifyAll()
+        finally:
+            self._mCondition.release()
+
+    def getFrame(self, timeout=None):
+        """
+        **SUMMARY**
 
-            handler = urllib2.HTTPBasicAuthHandler(password_mgr)
-            opener = urllib2.build_opener(handler)
+        Take the oldest unread frame, or if every frame has been read the latest
+        one again. Waits for the first frame to arrive.
 
-            f = opener.open(self.url)
-        else:
-            f = urllib2.urlopen(self.url)
+        **PARAMETERS**
 
-        headers = f.info()
-        if (headers.has_key("content-type")):
-            headers['Content-type'] = headers['content-type'] #force ucase first char
+        * *timeout* - the longest to wait in seconds for the first frame, or None to wait forever.
 
-        if not headers.has_key("Content-type"):
-            logger.warning("Tried to load a JpegStream from " + self.url + ", but didn't find a content-type header!")
-            return
+        **RETURNS**
 
-        (multipart, boundary) = headers['Content-type'].split("boundary=")
-        if not re.search("multipart", multipart, re.I):
-            logger.warning("Tried to load a JpegStream from " + self.url + ", but the content type header was " + multipart + " not multipart/replace!")
-            return
+        A tuple of (JPEG data, capture time, frame index), or None if no frame arrived in time.
 
-        buff = ''
-        data = f.readline().strip()
-        length = 0
-        contenttype = "jpeg"
-
-        #the first frame contains a boundarystring and some header info
-        while (1):
-            #print data
-            if (re.search(boundary, data.strip()) and len(buff)):
-                #we have a full jpeg in buffer.  Convert to an image
-                if contenttype == "jpeg":
-                    self.currentframe = buff
-                    self._threadcapturetime = time.time()
-                buff = ''
-
-            if (re.match("Content-Type", data, re.I)):
-                #set the content type, if provided (default to jpeg)
-                (header, typestring) = data.split(":")
-                (junk, contenttype) = typestring.strip().split("/")
-
-            if (re.match("Content-Length", data, re.I)):
-                #once we have the content length, we know how far to go jfif
-                (header, length) = data.split(":")
-                length = int(length.strip())
-
-            if (re.search("JFIF", data, re.I) or re.search("\xff\xd8\xff\xdb", data) or len(data) > 55):
-                # we have reached the start of the image
-                buff = ''
-                if length and length > len(data):
-                    buff += data + f.read(length - len(data)) #read the remainder of the image
-                    if contenttype == "jpeg":
-                        self.currentframe = buff
-                        self._threadcapturetime = time.time()
-                else:
-                    while (not re.search(boundary, data)):
-                        buff += data
-                        data = f.readline()
+        """
+        end = None
+        if timeout is not None:
+            end = time.time() + timeout
+        self._mCondition.acquire()
+        try:
+            while not self.frames and not self._threadcapturetime:
+                wait = 0.1
+                if end is not None:
+                    wait = min(wait, end - time.time())
+                    if wait <= 0:
+                        return None
+                self._mCondition.wait(wait)
+            if self.frames:
+                self._mLast = self.frames.popleft()
+            return self._mLast
+        finally:
+            self._mCondition.release()
 
-                    endimg, junk = data.split(boundary)
-                    buff += endimg
-                    data = boundary
-                    continue
+    def stop(self):
+        self._stop.set()
 
-            data = f.readline() #load the next (header) line
-            time.sleep(0) #let the other threads go
+    def stopped(self):
+        return self._stop.isSet()
 
 class JpegStreamCamera(FrameSource):
     """
@@ -1148,6 +1794,10 @@ class JpegStreamCamera(FrameSource):
 
     The JpegStreamCamera takes a URL of a JPEG stream and treats it like a camera.  The current frame can always be accessed with getImage()
 
+    Frames are only decoded when getImage asks for them, and each frame at most
+    once. With a buffersize above 1 getImage returns every frame in order as long
+    as it keeps up, camthread.droppedframes counts the ones it missed.
+
     Requires the Python Imaging Library: http://www.pythonware.com/library/pil/handbook/index.htm
 
     **EXAMPLE**
@@ -1162,15 +1812,15 @@ class JpegStreamCamera(FrameSource):
     url = ""
     camthread = ""
 
-    def __init__(self, url):
+    def __init__(self, url, buffersize=1):
         if not PIL_ENABLED:
             logger.warning("You need the Python Image Library (PIL) to use the JpegStreamCamera")
             return
         if not url.startswith('http://'):
             url = "http://" + url
         self.url = url
-        self.camthread = JpegStreamReader()
-        self.camthread.url = self.url
+        self._mDecoded = (None, None) #(frame index, pixels) of the last decoded frame
+        self.camthread = JpegStreamReader(self.url, buffersize)
         self.camthread.daemon = True
         self.camthread.start()
 
@@ -1181,16 +1831,394 @@ class JpegStreamCamera(FrameSource):
         Return the current frame of the JpegStream being monitored
 
         """
-        if not self.camthread._threadcapturetime:
+        frame = self.camthread.getFrame(5)
+        if frame is None:
+            warnings.warn("Timeout fetching JpegStream at " + self.url)
+            return
+
+        (data, capturetime, index) = frame
+        self.capturetime = capturetime
+        if self._mDecoded[0] != index:
+            pixels = cv2.imdecode(np.fromstring(data, np.uint8), 1)
+            if pixels is None:
+                #not something OpenCV could read, let PIL have a go
+                pixels = Image(pil.open(StringIO(data))).getNumpyCv2()
+            self._mDecoded = (index, pixels)
+        img = Image.fromArray(self._mDecoded[1], copy=True)
+        img.camera = self
+        img.capturetime = capturetime
+        img.frameindex = index
+        return img
+
+
+class _JpegStreamConnection:
+    """
+    One non-blocking HTTP connection of a JpegStreamMultiplexer. It goes through
+    connecting -> sending the request -> reading the response headers -> reading
+    the multipart body, and back to closed on any error, where it waits out its
+    backoff before the multiplexer reconnects it.
+    """
+    CLOSED, CONNECTING, SENDING, HEADERS, BODY = range(5)
+
+    def __init__(self, camera, url, backoff, maxBackoff):
+        self.camera = camera
+        parts = urlparse.urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        request = "GET " + path + " HTTP/1.0\r\nHost: " + parts.netloc.split("@")[-1] + "\r\n"
+        if parts.username:
+            auth = base64.b64encode(parts.username + ":" + (parts.password or ""))
+            request += "Authorization: Basic " + auth + "\r\n"
+        self.request = request + "\r\n"
+        self.minBackoff = backoff
+        self.maxBackoff = maxBackoff
+        self.backoff = backoff
+        self.state = self.CLOSED
+        self.closing = False
+        self.sock = None
+        self.retryat = 0
+        self.lastactivity = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def connect(self, now):
+        self.lastactivity = now
+        try:
+            (family, socktype, proto, name, addr) = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)[0]
+            self.sock = socket.socket(family, socktype, proto)
+            self.sock.setblocking(0)
+            err = self.sock.connect_ex(addr)
+        except socket.error, e:
+            self.fail(now, str(e))
+            return
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            self.fail(now, os.strerror(err))
+            return
+        self.state = self.CONNECTING
+        self.pending = self.request
+        self.buff = ""
+
+    def fail(self, now, reason):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.state == self.BODY:
+            logger.warning("Lost the JpegStream " + self.camera.url + ": " + reason)
+        self.state = self.CLOSED
+        self.retryat = now + self.backoff
+        self.backoff = min(self.backoff * 2, self.maxBackoff)
+        self.camera.reconnects += 1
+
+    def handleWrite(self, now):
+        if self.state == self.CONNECTING:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self.fail(now, os.strerror(err))
+                return
+            self.state = self.SENDING
+        try:
+            sent = self.sock.send(self.pending)
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.fail(now, str(e))
+            return
+        self.pending = self.pending[sent:]
+        self.lastactivity = now
+        if not self.pending:
+            self.state = self.HEADERS
+
+    def handleRead(self, now):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.fail(now, str(e))
+            return
+        if not data:
+            self.fail(now, "the server closed the connection")
+            return
+        self.lastactivity = now
+        if self.state == self.HEADERS:
+            self.buff += data
+            end = self.buff.find("\r\n\r\n")
+            if end < 0:
+                if len(self.buff) > 65536:
+                    self.fail(now, "the response headers are too long")
+                return
+            lines = self.buff[:end].split("\r\n")
+            data = self.buff[end + 4:]
+            self.buff = ""
+            status = lines[0].split()
+            if len(status) < 2 or status[1] != "200":
+                self.fail(now, "the server replied " + lines[0])
+                return
+            headers = dict((k.strip().lower(), v.strip()) for (k, sep, v) in [l.partition(":") for l in lines[1:]])
+            contenttype = headers.get("content-type", "")
+            if not re.search("multipart", contenttype, re.I) or "boundary=" not in contenttype:
+                self.fail(now, "the content type was " + contenttype + " not multipart/replace")
+                return
+            self.parser = _MJPEGParser(contenttype.split("boundary=")[1].split(";")[0])
+            self.state = self.BODY
+        for frame in self.parser.feed(data):
+            self.backoff = self.minBackoff
+            self.camera._put(frame, now)
+
+
+class JpegStreamMultiplexer(threading.Thread):
+    """
+    **SUMMARY**
+
+    The JpegStreamMultiplexer reads many MJPEG streams, such as a rack of IP
+    cameras, from a single thread. Instead of a thread doing blocking reads
+    for every camera, one select() loop services all of the sockets, handing
+    each stream's bytes to an incremental parser. Each stream keeps only its
+    newest frame, and frames are decoded by a small pool of worker threads, at
+    most one decode per stream at a time and always of the newest frame.
+
+    A stream that fails to connect, errors, or goes quiet for timeout seconds
+    is closed and retried after a backoff that doubles from backoff up to
+    maxbackoff, and resets once frames flow again.
+
+    Every stream is read through the JpegStreamMuxCamera addCamera returns,
+    which works like any other camera.
+
+    **EXAMPLE**
+
+    >>> mux = JpegStreamMultiplexer(workers=4)
+    >>> cams = [mux.addCamera("http://10.0.0." + str(i) + "/video.mjpg") for i in range(10, 90)]
+    >>> while True:
+    >>>     for cam in cams:
+    >>>         img = cam.getImage()
+
+    """
+    def __init__(self, workers=2, timeout=10.0, backoff=0.5, maxbackoff=30.0):
+        """
+        **SUMMARY**
+
+        Create the multiplexer and start its thread.
+
+        **PARAMETERS**
+
+        * *workers* - The number of threads decoding JPEGs.
+        * *timeout* - Reconnect a stream that has sent nothing for this many seconds.
+        * *backoff* - The first wait in seconds before reconnecting a failed stream.
+        * *maxbackoff* - The longest wait in seconds before reconnecting.
+
+        """
+        threading.Thread.__init__(self)
+        from multiprocessing.pool import ThreadPool
+        self.timeout = timeout
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+        self.daemon = True
+        self._mPool = ThreadPool(max(1, workers))
+        self._mConnections = []
+        self._mLock = threading.Lock()
+        self._stop = threading.Event()
+        self.start()
+
+    def addCamera(self, url):
+        """
+        **SUMMARY**
+
+        Start reading another stream.
+
+        **PARAMETERS**
+
+        * *url* - The stream's url, it may include a user:password@ for basic authentication.
+
+        **RETURNS**
+
+        A JpegStreamMuxCamera for the stream.
+
+        """
+        if not url.startswith('http://'):
+            url = "http://" + url
+        camera = JpegStreamMuxCamera(url, self)
+        self._mLock.acquire()
+        try:
+            self._mConnections.append(_JpegStreamConnection(camera, url, self.backoff, self.maxbackoff))
+        finally:
+            self._mLock.release()
+        return camera
+
+    def removeCamera(self, camera):
+        """
+        **SUMMARY**
+
+        Stop reading the stream of a camera made by addCamera.
+
+        """
+        self._mLock.acquire()
+        try:
+            for conn in self._mConnections:
+                if conn.camera is camera:
+                    conn.closing = True
+        finally:
+            self._mLock.release()
+
+    def run(self):
+        while not self.stopped():
+            self._mLock.acquire()
+            try:
+                for conn in [c for c in self._mConnections if c.closing]:
+                    if conn.sock is not None:
+                        conn.sock.close()
+                    self._mConnections.remove(conn)
+                connections = list(self._mConnections)
+            finally:
+                self._mLock.release()
+
             now = time.time()
-            while not self.camthread._threadcapturetime:
-                if time.time() - now > 5:
-                    warnings.warn("Timeout fetching JpegStream at " + self.url)
+            for conn in connections:
+                if conn.state == conn.CLOSED and now >= conn.retryat:
+                    conn.connect(now)
+                elif conn.state != conn.CLOSED and now - conn.lastactivity > self.timeout:
+                    conn.fail(now, "timed out")
+            readers = [c for c in connections if c.state in (c.HEADERS, c.BODY)]
+            writers = [c for c in connections if c.state in (c.CONNECTING, c.SENDING)]
+            if not readers and not writers:
+                time.sleep(0.05)
+                continue
+            try:
+                (readable, writable, junk) = select.select(readers, writers, [], 0.05)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            now = time.time()
+            for conn in writable:
+                try:
+                    conn.handleWrite(now)
+                except Exception, e:
+                    conn.fail(now, str(e))
+            for conn in readable:
+                if conn.state == conn.CLOSED:
+                    continue
+                try:
+                    conn.handleRead(now)
+                except Exception, e:
+                    #a garbled stream shouldn't take the others down with it
+                    conn.fail(now, str(e))
+
+        for conn in self._mConnections:
+            if conn.sock is not None:
+                conn.sock.close()
+        self._mPool.close()
+
+    def stop(self):
+        self._stop.set()
+
+    def stopped(self):
+        return self._stop.isSet()
+
+
+class JpegStreamMuxCamera(FrameSource):
+    """
+    **SUMMARY**
+
+    One stream of a JpegStreamMultiplexer, made by JpegStreamMultiplexer.addCamera.
+    getImage returns the newest decoded frame. droppedframes counts the frames
+    that were replaced by a newer one before they could be decoded, and
+    reconnects the number of times the connection failed.
+
+    """
+    def __init__(self, url, multiplexer):
+        self.url = url
+        self.multiplexer = multiplexer
+        self.frameindex = -1
+        self.droppedframes = 0
+        self.reconnects = 0
+        self._mRaw = None #(jpeg, capture time, frame index) waiting to be decoded
+        self._mDecoded = None #(pixels, capture time, frame index)
+        self._mDecoding = False
+        self._mReceived = 0
+        self._mCondition = threading.Condition()
+
+    def _put(self, frame, capturetime):
+        #called by the multiplexer thread
+        self._mCondition.acquire()
+        try:
+            if self._mRaw is not None:
+                self.droppedframes += 1
+            self._mRaw = (frame, capturetime, self._mReceived)
+            self._mReceived += 1
+            if self._mDecoding:
+                return
+            self._mDecoding = True
+        finally:
+            self._mCondition.release()
+        self.multiplexer._mPool.apply_async(self._decode)
+
+    def _decode(self):
+        #runs on the decode pool, nobody reads its result so nothing may escape
+        try:
+            self._decodeFrames()
+        except Exception, e:
+            logger.warning("Decoding the JpegStream " + self.url + " failed: " + str(e))
+            self._mCondition.acquire()
+            self._mDecoding = False
+            self._mCondition.release()
+
+    def _decodeFrames(self):
+        #keeps going while newer frames arrive
+        while True:
+            self._mCondition.acquire()
+            try:
+                raw = self._mRaw
+                self._mRaw = None
+                if raw is None:
+                    self._mDecoding = False
                     return
-                time.sleep(0.1)
+            finally:
+                self._mCondition.release()
+            (data, capturetime, index) = raw
+            try:
+                pixels = cv2.imdecode(np.fromstring(data, np.uint8), 1)
+            except Exception:
+                #a garbled frame mustn't stop the stream, the next one gets decoded
+                pixels = None
+            if pixels is None:
+                logger.warning("Couldn't decode a frame from the JpegStream " + self.url)
+                continue
+            self._mCondition.acquire()
+            try:
+                self._mDecoded = (pixels, capturetime, index)
+                self._mCondition.notifyAll()
+            finally:
+                self._mCondition.release()
 
-        self.capturetime = self.camthread._threadcapturetime
-        return Image(pil.open(StringIO(self.camthread.currentframe)), self)
+    def getImage(self, timeout=5):
+        """
+        **SUMMARY**
+
+        Return the newest frame of the stream, waiting up to timeout seconds for
+        the first one.
+
+        """
+        end = time.time() + timeout
+        self._mCondition.acquire()
+        try:
+            while self._mDecoded is None:
+                wait = end - time.time()
+                if wait <= 0:
+                    warnings.warn("Timeout fetching JpegStream at " + self.url)
+                    return
+                self._mCondition.wait(min(wait, 0.1))
+            (pixels, capturetime, index) = self._mDecoded
+        finally:
+            self._mCondition.release()
+        self.capturetime = capturetime
+        self.frameindex = index
+        img = Image.fromArray(pixels, copy=True)
+        img.camera = self
+        img.capturetime = capturetime
+        img.frameindex = index
+        return img
 
 
 _SANE_INIT = False
@@ -1594,6 +2622,125 @@ class ScreenCamera():
         return img
 
 
+def _createStereoState(method="BM", state=None):
+    """
+    Build the stereo correspondence state object for method ("BM" or "SGBM")
+    configured from a state dict as documented in StereoImage.get3DImage.
+    Building it is not free, so callers processing many frames should keep it.
+    Returns None for an unknown method.
+    """
+    if method == "BM":
+        sbm = cv.CreateStereoBMState()
+        if state:
+            SADWindowSize = state.get("SADWindowSize")
+            preFilterCap = state.get("preFilterCap")
+            minDisparity = state.get("minDisparity")
+            numberOfDisparities = state.get("nDisparity")
+            uniquenessRatio = state.get("uniquenessRatio")
+            speckleRange = state.get("speckleRange")
+            speckleWindowSize = state.get("speckleWindowSize")
+            textureThreshold = state.get("textureThreshold")
+            preFilterType = state.get("preFilterType", state.get("perFilterType"))
+            preFilterSize = state.get("preFilterSize")
+
+            if SADWindowSize is not None:
+                sbm.SADWindowSize = SADWindowSize
+            if preFilterCap is not None:
+                sbm.preFilterCap = preFilterCap
+            if minDisparity is not None:
+                sbm.minDisparity = minDisparity
+            if numberOfDisparities is not None:
+                sbm.numberOfDisparities = numberOfDisparities
+            if uniquenessRatio is not None:
+                sbm.uniquenessRatio = uniquenessRatio
+            if speckleRange is not None:
+                sbm.speckleRange = speckleRange
+            if speckleWindowSize is not None:
+                sbm.speckleWindowSize = speckleWindowSize
+            if textureThreshold is not None:
+                sbm.textureThreshold = textureThreshold
+            if preFilterType is not None:
+                sbm.preFilterType = preFilterType
+            if preFilterSize is not None:
+                sbm.preFilterSize = preFilterSize
+        else:
+            sbm.SADWindowSize = 9
+            sbm.preFilterType = 1
+            sbm.preFilterSize = 5
+            sbm.preFilterCap = 61
+            sbm.minDisparity = -39
+            sbm.numberOfDisparities = 112
+            sbm.textureThreshold = 507
+            sbm.uniquenessRatio= 0
+            sbm.speckleRange = 8
+            sbm.speckleWindowSize = 0
+        return sbm
+
+    elif method == "SGBM":
+        sbm = cv2.StereoSGBM()
+        if state:
+            SADWindowSize = state.get("SADWindowSize")
+            preFilterCap = state.get("preFilterCap")
+            minDisparity = state.get("minDisparity")
+            numberOfDisparities = state.get("nDisparity")
+            P1 = state.get("P1")
+            P2 = state.get("P2")
+            uniquenessRatio = state.get("uniquenessRatio")
+            speckleRange = state.get("speckleRange")
+            speckleWindowSize = state.get("speckleWindowSize")
+            fullDP = state.get("fullDP")
+            disp12MaxDiff = state.get("disp12MaxDiff")
+
+            if SADWindowSize is not None:
+                sbm.SADWindowSize = SADWindowSize
+            if preFilterCap is not None:
+                sbm.preFilterCap = preFilterCap
+            if minDisparity is not None:
+                sbm.minDisparity = minDisparity
+            if numberOfDisparities is not None:
+                sbm.numberOfDisparities = numberOfDisparities
+            if P1 is not None:
+                sbm.P1 = P1
+            if P2 is not None:
+                sbm.P2 = P2
+            if uniquenessRatio is not None:
+                sbm.uniquenessRatio = uniquenessRatio
+            if speckleRange is not None:
+                sbm.speckleRange = speckleRange
+            if speckleWindowSize is not None:
+                sbm.speckleWindowSize = speckleWindowSize
+            if fullDP is not None:
+                sbm.fullDP = fullDP
+            if disp12MaxDiff is not None:
+                sbm.disp12MaxDiff = disp12MaxDiff
+        else:
+            sbm.SADWindowSize = 9;
+            sbm.numberOfDisparities = 96;
+            sbm.preFilterCap = 63;
+            sbm.minDisparity = -21;
+            sbm.uniquenessRatio = 7;
+            sbm.speckleWindowSize = 0;
+            sbm.speckleRange = 8;
+            sbm.disp12MaxDiff = 1;
+            sbm.fullDP = False;
+        return sbm
+
+    warnings.warn("Unknown method. Returning None")
+    return None
+
+def _stereoDisparity(grayLeft, grayRight, method, sbm):
+    """
+    Run a matcher state from _createStereoState on a pair of rows x cols grayscale
+    arrays and return the raw disparity, a CV_32F cvmat for BM or a numpy array for SGBM.
+    """
+    if method == "BM":
+        grayLeft = np.ascontiguousarray(grayLeft)
+        grayRight = np.ascontiguousarray(grayRight)
+        disparity = cv.CreateMat(grayLeft.shape[0], grayLeft.shape[1], cv.CV_32F)
+        cv.FindStereoCorrespondenceBM(cv.fromarray(grayLeft), cv.fromarray(grayRight), disparity, sbm)
+        return disparity
+    return sbm.compute(np.ascontiguousarray(grayLeft), np.ascontiguousarray(grayRight))
+
 class StereoImage:
     """
     **SUMMARY**
@@ -1621,6 +2768,11 @@ class StereoImage:
     def __init__( self, imgLeft , imgRight ):
         self.ImageLeft = imgLeft
         self.ImageRight = imgRight
+        #(parameters, raw float disparity, disparity Image) of the last findDisparityMap
+        self._mDisparity = None
+        #weak references to the copies of that Image findDisparityMap handed out
+        self._mDisparityImages = []
+        self._mDisparitySearch = None
         if self.ImageLeft.size() != self.ImageRight.size():
             logger.warning('Left and Right images should have the same size.')
             return None
@@ -1768,10 +2920,21 @@ class StereoImage:
         matched_pts2 = matched_pts2[:, ::-1.00]
         return (H, matched_pts1, matched_pts2)
 
-    def findDisparityMap( self, nDisparity=16 ,method='BM'):
+    def findDisparityMap( self, nDisparity=16 ,method='BM', levels=0, band=8):
         """
         The method generates disparity map from set of stereo images.
 
+        With levels > 0 the disparity is computed coarse to fine: first on an image
+        pyramid reduced levels times by half, with the full disparity range scaled
+        down to match, then at each finer level only in a narrow band around the
+        upsampled estimate from the level below. The band is set per small tile
+        from the coarse disparities around it, so this is much faster than a full
+        resolution search over a large disparity range.
+
+        The raw disparity behind the returned image is kept, so passing the result
+        to get3DImageFromDisparity reprojects the full precision values. Repeated calls
+        with the same parameters reuse that result, returning a new copy of the image each time.
+
         **PARAMETERS**
 
         * *method* :
@@ -1780,7 +2943,11 @@ class StereoImage:
                  *GC* - Graph Cut algorithm, This is not a real time algorithm.
 
         * *nDisparity* - Maximum disparity value. This should be multiple of 16
-        * *scale* - Scale factor
+        * *levels* - The number of pyramid levels to search coarse to fine, 0 searches
+          the full resolution image only. GC only supports 0.
+        * *band* - For levels > 0, the number of pixels of disparity searched either side
+          of the coarse estimate at each finer level. Smaller is faster, larger is more
+          forgiving of errors in the coarse estimate.
 
         **RETURNS**
 
@@ -1792,7 +2959,21 @@ class StereoImage:
         >>> img2 = Image("sampleimages/stereo_view2.png")
         >>> stereoImg = StereoImage(img1,img2)
         >>> disp = stereoImg.findDisparityMap(method="BM")
+        >>> disp = stereoImg.findDisparityMap(nDisparity=128, method="SGBM", levels=2)
         """
+        key = (nDisparity, method, levels, band)
+        if self._mDisparity is not None and self._mDisparity[0] == key:
+            return self._disparityResult()
+
+        if levels > 0:
+            if method in ['BM', 'SGBM']:
+                try:
+                    return self._findDisparityPyramid(nDisparity, method, levels, band)
+                except :
+                    logger.warning("Error in computing the Disparity Map, may be due to the Images are stereo in nature.")
+                    return None
+            logger.warning("StereoImage.findDisparityMap: only BM and SGBM support levels, using full resolution.")
+
         gray_left = self.ImageLeft.getGrayscaleMatrix()
         gray_right = self.ImageRight.getGrayscaleMatrix()
         (r, c) = self.size
@@ -1819,7 +3000,8 @@ class StereoImage:
                 disparity_visual = cv.CreateMat(c, r, cv.CV_8U)
                 cv.Normalize( disparity, disparity_visual, 0, 256, cv.CV_MINMAX )
                 disparity_visual = Image(disparity_visual)
-                return Image(disparity_visual.getBitmap(),colorSpace=ColorSpace.GRAY)
+                retVal = Image(disparity_visual.getBitmap(),colorSpace=ColorSpace.GRAY)
+                return self._cacheDisparity(key, np.asarray(disparity), retVal)
 
             elif method == 'GC':
                 disparity_left = cv.CreateMat(c, r, cv.CV_32F)
@@ -1856,7 +3038,8 @@ class StereoImage:
                 state.P2 = 32 * 1 * 41 * 41
                 state.uniquenessRatio=15
                 disparity=state.compute(self.ImageLeft.getGrayNumpy(),self.ImageRight.getGrayNumpy())
-                return Image(disparity)
+                retVal = Image(disparity)
+                return self._cacheDisparity(key, disparity.transpose().astype(np.float32) / 16.0, retVal)
 
             else :
                 logger.warning("Unknown method. Choose one method amoung BM or SGBM or GC !")
@@ -1866,6 +3049,124 @@ class StereoImage:
             logger.warning("Error in computing the Disparity Map, may be due to the Images are stereo in nature.")
             return None
 
+    def _pyramidState(self, method, window):
+        """
+        Build the BM or SGBM matcher state for one pyramid level, see _runMatcher.
+        """
+        return _createStereoState(method, {"SADWindowSize": window,
+                                           "preFilterType": 1,
+                                           "preFilterSize": window,
+                                           "preFilterCap": 31,
+                                           "textureThreshold": 10,
+                                           "uniquenessRatio": 15,
+                                           "disp12MaxDiff": 1,
+                                           "fullDP": False,
+                                           "P1": 8 * 1 * window * window,
+                                           "P2": 32 * 1 * window * window})
+
+    def _runMatcher(self, state, method, left, right, minDisparity, nDisparity):
+        """
+        Run a matcher state from _pyramidState on a pair of grayscale rows x cols arrays
+        over the disparities [minDisparity, minDisparity + nDisparity) and return a float32
+        disparity with NaN where there was no match.
+        """
+        state.minDisparity = minDisparity
+        state.numberOfDisparities = nDisparity
+        disparity = np.array(_stereoDisparity(left, right, method, state), dtype=np.float32)
+        if method == 'SGBM':
+            disparity /= 16.0
+        disparity[disparity < minDisparity] = np.nan
+        return disparity
+
+    def _findDisparityPyramid(self, nDisparity, method, levels, band):
+        """
+        Coarse to fine disparity for findDisparityMap(levels > 0).
+        """
+        left = [self.ImageLeft.getGrayNumpyCv2()]
+        right = [self.ImageRight.getGrayNumpyCv2()]
+        for i in range(levels):
+            left.append(cv2.pyrDown(left[-1]))
+            right.append(cv2.pyrDown(right[-1]))
+
+        #full search at the coarsest level
+        coarse = max(16, int(math.ceil(nDisparity / float(2 ** levels) / 16.0)) * 16)
+        window = max(5, (41 >> levels) | 1)
+        disparity = self._runMatcher(self._pyramidState(method, window), method, left[-1], right[-1], 0, coarse)
+
+        #then, one small tile at a time, a narrow search around the upsampled
+        #estimate of just that tile and its neighbourhood
+        for level in range(levels - 1, -1, -1):
+            L = left[level]
+            R = right[level]
+            (h, w) = L.shape
+            window = max(5, (41 >> level) | 1)
+            state = self._pyramidState(method, window)
+            estimate = cv2.resize(disparity, (w, h), interpolation=cv2.INTER_NEAREST) * 2
+            disparity = np.empty((h, w), dtype=np.float32)
+            disparity[:] = np.nan
+            tile = max(32, 2 * window)
+            pad = window / 2 + 1
+            searched = 0
+            for y0 in range(0, h, tile):
+                y1 = min(h, y0 + tile)
+                ya = max(0, y0 - pad)
+                yb = min(h, y1 + pad)
+                if yb - ya < window:
+                    ya = max(0, yb - window)
+                for x0 in range(0, w, tile):
+                    x1 = min(w, x0 + tile)
+                    xb = min(w, x1 + pad)
+                    values = estimate[ya:yb, max(0, x0 - pad):xb]
+                    values = values[np.isfinite(values)]
+                    if values.size:
+                        lo = max(0, int(math.floor(values.min())) - band)
+                        hi = int(math.ceil(values.max())) + band
+                    else:
+                        lo = 0
+                        hi = nDisparity >> level
+                    num = max(16, int(math.ceil((hi - lo) / 16.0)) * 16)
+                    #shift the right image by lo so only num disparities are searched,
+                    #keeping num + pad columns left of the tile for the matcher's border;
+                    #columns left of lo can not have a disparity of lo or more
+                    xa = max(lo, x0 - num - pad)
+                    xs = max(x0, xa)
+                    if xs >= x1 or xb - xa < num + window:
+                        continue
+                    match = self._runMatcher(state, method, L[ya:yb, xa:xb], R[ya:yb, xa - lo:xb - lo], 0, num)
+                    disparity[y0:y1, xs:x1] = match[y0 - ya:y1 - ya, xs - xa:x1 - xa] + lo
+                    searched += (y1 - y0) * (x1 - xs) * num
+
+        #the mean number of disparities searched per pixel at full resolution
+        self._mDisparitySearch = searched / float(disparity.size)
+
+        finite = np.isfinite(disparity)
+        visual = np.zeros(disparity.shape, dtype=np.uint8)
+        if finite.any():
+            visual = cv2.normalize(np.where(finite, disparity, disparity[finite].min()), alpha=0, beta=255,
+                                   norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+        retVal = Image(visual, cv2image=True, colorSpace=ColorSpace.GRAY)
+        return self._cacheDisparity((nDisparity, method, levels, band), disparity, retVal)
+
+    def _cacheDisparity(self, key, raw, img):
+        """
+        Keep the raw disparity and disparity Image of findDisparityMap(key) and return
+        a copy of the Image.
+        """
+        self._mDisparity = (key, raw, img)
+        self._mDisparityImages = []
+        return self._disparityResult()
+
+    def _disparityResult(self):
+        """
+        Return a copy of the cached disparity Image, so callers drawing on their result
+        don't change anyone else's, and remember it for get3DImageFromDisparity.
+        """
+        img = self._mDisparity[2]
+        retVal = Image.fromArray(img.getNumpyCv2(), copy=True, colorSpace=img._colorSpace)
+        self._mDisparityImages = [ref for ref in self._mDisparityImages if ref() is not None]
+        self._mDisparityImages.append(weakref.ref(retVal))
+        return retVal
+
     def Eline (self, point, F, whichImage):
         """
         **SUMMARY**
@@ -1964,11 +3265,13 @@ class StereoImage:
                     minDisparity  - int
                     preFilterCap - int
                     preFilterType - int (only BM)
+                    preFilterSize - odd int (only BM)
                     speckleRange - int
                     speckleWindowSize - int
                     P1 - int (only SGBM)
                     P2 - int (only SGBM)
                     fullDP - Bool (only SGBM)
+                    disp12MaxDiff - int (only SGBM)
                     uniquenessRatio - int
                     textureThreshold - int (only BM)
 
@@ -1989,135 +3292,24 @@ class StereoImage:
         >>> stereo.get3DImage(Q, "BM", state).show()
         >>> stereo.get3DImage(Q, "SGBM", state).show()
         """
-        imgLeft = self.ImageLeft
-        imgRight = self.ImageRight
-        cv2flag = True
-        try:
-            import cv2
-        except ImportError:
-            cv2flag = False
-        import cv2.cv as cv
-        (r, c) = self.size
-        if method == "BM":
-            sbm = cv.CreateStereoBMState()
-            disparity = cv.CreateMat(c, r, cv.CV_32F)
-            if state:
-                SADWindowSize = state.get("SADWindowSize")
-                preFilterCap = state.get("preFilterCap")
-                minDisparity = state.get("minDisparity")
-                numberOfDisparities = state.get("nDisparity")
-                uniquenessRatio = state.get("uniquenessRatio")
-                speckleRange = state.get("speckleRange")
-                speckleWindowSize = state.get("speckleWindowSize")
-                textureThreshold = state.get("textureThreshold")
-                speckleRange = state.get("speckleRange")
-                speckleWindowSize = state.get("speckleWindowSize")
-                preFilterType = state.get("perFilterType")
-
-                if SADWindowSize is not None:
-                    sbm.SADWindowSize = SADWindowSize
-                if preFilterCap is not None:
-                    sbm.preFilterCap = preFilterCap
-                if minDisparity is not None:
-                    sbm.minDisparity = minDisparity
-                if numberOfDisparities is not None:
-                    sbm.numberOfDisparities = numberOfDisparities
-                if uniquenessRatio is not None:
-                    sbm.uniquenessRatio = uniquenessRatio
-                if speckleRange is not None:
-                    sbm.speckleRange = speckleRange
-                if speckleWindowSize is not None:
-                    sbm.speckleWindowSize = speckleWindowSize
-                if textureThreshold is not None:
-                    sbm.textureThreshold = textureThreshold
-                if preFilterType is not None:
-                    sbm.preFilterType = preFilterType
-            else:
-                sbm.SADWindowSize = 9
-                sbm.preFilterType = 1
-                sbm.preFilterSize = 5
-                sbm.preFilterCap = 61
-                sbm.minDisparity = -39
-                sbm.numberOfDisparities = 112
-                sbm.textureThreshold = 507
-                sbm.uniquenessRatio= 0
-                sbm.speckleRange = 8
-                sbm.speckleWindowSize = 0
-
-            gray_left = imgLeft.getGrayscaleMatrix()
-            gray_right = imgRight.getGrayscaleMatrix()
-            cv.FindStereoCorrespondenceBM(gray_left, gray_right, disparity, sbm)
-            disparity_visual = cv.CreateMat(c, r, cv.CV_8U)
-
-        elif method == "SGBM":
-            if not cv2flag:
-                warnings.warn("Can't Use SGBM without OpenCV >= 2.4. Use SBM instead.")
-            sbm = cv2.StereoSGBM()
-            if state:
-                SADWindowSize = state.get("SADWindowSize")
-                preFilterCap = state.get("preFilterCap")
-                minDisparity = state.get("minDisparity")
-                numberOfDisparities = state.get("nDisparity")
-                P1 = state.get("P1")
-                P2 = state.get("P2")
-                uniquenessRatio = state.get("uniquenessRatio")
-                speckleRange = state.get("speckleRange")
-                speckleWindowSize = state.get("speckleWindowSize")
-                fullDP = state.get("fullDP")
-
-                if SADWindowSize is not None:
-                    sbm.SADWindowSize = SADWindowSize
-                if preFilterCap is not None:
-                    sbm.preFilterCap = preFilterCap
-                if minDisparity is not None:
-                    sbm.minDisparity = minDisparity
-                if numberOfDisparities is not None:
-                    sbm.numberOfDisparities = numberOfDisparities
-                if P1 is not None:
-                    sbm.P1 = P1
-                if P2 is not None:
-                    sbm.P2 = P2
-                if uniquenessRatio is not None:
-                    sbm.uniquenessRatio = uniquenessRatio
-                if speckleRange is not None:
-                    sbm.speckleRange = speckleRange
-                if speckleWindowSize is not None:
-                    sbm.speckleWindowSize = speckleWindowSize
-                if fullDP is not None:
-                    sbm.fullDP = fullDP
-            else:
-                sbm.SADWindowSize = 9;
-                sbm.numberOfDisparities = 96;
-                sbm.preFilterCap = 63;
-                sbm.minDisparity = -21;
-                sbm.uniquenessRatio = 7;
-                sbm.speckleWindowSize = 0;
-                sbm.speckleRange = 8;
-                sbm.disp12MaxDiff = 1;
-                sbm.fullDP = False;
-
-            disparity = sbm.compute(imgLeft.getGrayNumpyCv2(), imgRight.getGrayNumpyCv2())
-            
-        else:
-            warnings.warn("Unknown method. Returning None")
+        sbm = _createStereoState(method, state)
+        if sbm is None:
             return None
+        return self._get3DImage(Q, method, sbm)
 
-        if cv2flag:
-            if not isinstance(Q, np.ndarray):
-                Q = np.array(Q)
-            if not isinstance(disparity, np.ndarray):
-                disparity = np.array(disparity)
-            Image3D = cv2.reprojectImageTo3D(disparity, Q, ddepth=cv2.cv.CV_32F)
-            Image3D_normalize = cv2.normalize(Image3D, alpha=0, beta=255, norm_type=cv2.cv.CV_MINMAX, dtype=cv2.cv.CV_8UC3)
-            retVal = Image(Image3D_normalize, cv2image=True)
-        else:
-            Image3D = cv.CreateMat(self.LeftImage.size()[1], self.LeftImage.size()[0], cv2.cv.CV_32FC3)
-            Image3D_normalize = cv.CreateMat(self.LeftImage.size()[1], self.LeftImage.size()[0], cv2.cv.CV_8UC3)
-            cv.ReprojectImageTo3D(disparity, Image3D, Q)
-            cv.Normalize(Image3D, Image3D_normalize, 0, 255, cv.CV_MINMAX, CV_8UC3)
-            retVal = Image(Image3D_normalize)
+    def _get3DImage(self, Q, method, sbm):
+        """
+        get3DImage with an already configured matcher state, see _createStereoState.
+        """
+        disparity = _stereoDisparity(self.ImageLeft.getGrayNumpyCv2(), self.ImageRight.getGrayNumpyCv2(), method, sbm)
+        if not isinstance(Q, np.ndarray):
+            Q = np.array(Q)
+        if not isinstance(disparity, np.ndarray):
+            disparity = np.array(disparity)
+        Image3D = cv2.reprojectImageTo3D(disparity, Q, ddepth=cv2.cv.CV_32F)
+        Image3D_normalize = cv2.normalize(Image3D, alpha=0, beta=255, norm_type=cv2.cv.CV_MINMAX, dtype=cv2.cv.CV_8UC3)
         self.Image3D = Image3D
-        return retVal
+        return Image(Image3D_normalize, cv2image=True)
 
     def get3DImageFromDisparity(self, disparity, Q):
         """
@@ -2126,7 +3318,9 @@ class StereoImage:
         This method returns the 3D depth image using reprojectImageTo3D method.
 
         **PARAMETERS**
-        * *disparity* - Disparity Image
+        * *disparity* - Disparity Image. If this is the image returned by this
+          StereoImage's findDisparityMap, or None, the full precision disparity that
+          produced it is used instead of its 8 bit pixels.
         * *Q* - reprojection Matrix (disparity to depth matrix)
 
         **RETURNS**
@@ -2150,7 +3344,19 @@ class StereoImage:
             cv2flag = False
             import cv2.cv as cv
 
-        if cv2flag:
+        if cv2flag and self._mDisparity is not None and (disparity is None or
+                any(ref() is disparity for ref in self._mDisparityImages)):
+            if not isinstance(Q, np.ndarray):
+                Q = np.array(Q)
+            raw = self._mDisparity[1]
+            finite = np.isfinite(raw)
+            if not finite.all():
+                #unmatched pixels get the smallest disparity, which reproject treats as missing
+                raw = np.where(finite, raw, (raw[finite].min() if finite.any() else 0) - 1).astype(np.float32)
+            Image3D = cv2.reprojectImageTo3D(raw, Q, handleMissingValues=True, ddepth=cv2.cv.CV_32F)
+            Image3D_normalize = cv2.normalize(Image3D, alpha=0, beta=255, norm_type=cv2.cv.CV_MINMAX, dtype=cv2.cv.CV_8UC3)
+            retVal = Image(Image3D_normalize, cv2image=True)
+        elif cv2flag:
             if not isinstance(Q, np.ndarray):
                 Q = np.array(Q)
             disparity = disparity.getNumpyCv2()    
@@ -2180,9 +3386,16 @@ class StereoCamera :
       -> Rectification transform (rotation matrix)
       -> Projection matrix in the new (rectified) coordinate systems
       -> Disparity-to-depth mapping matrix (Q)
+
+    For processing a continuous stream of frame pairs see StereoPipeline.
     """
     def __init__(self):
-        return
+        #pipelines are sized by their rectification maps and closed when evicted
+        self._pipelines = BufferCache(FRAME_CACHE_BUDGET, evicted=lambda entry: entry[2].close())
+        #(key, entry) of the last pipeline too big for the cache, closed when replaced
+        self._largePipeline = None
+        #only the most recent matcher state per method, as (parameters, state)
+        self._stereoStates = {}
 
     def stereoCalibration(self,camLeft, camRight, nboards=30, chessboard=(8, 5), gridsize=0.027, WinSize = (352,288)):
         """
@@ -2500,25 +3713,49 @@ class StereoCamera :
         >>> imgRight = camRight.getImage()
         >>> rectLeft,rectRight = StereoCam.getImagesUndistort(imgLeft,imgRight,calibration,rectification)
         """
-        imgLeft = imgLeft.getMatrix()
-        imgRight = imgRight.getMatrix()
-        (CM1, CM2, D1, D2, R, T, E, F) = calibration
-        (R1, R2, P1, P2, Q, roi) = rectification
+        return self.getPipeline(calibration, rectification, WinSize).rectify(imgLeft, imgRight)
 
-        dst1 = cv.CloneMat(imgLeft)
-        dst2 = cv.CloneMat(imgRight)
-        map1x = cv.CreateMat(WinSize[1], WinSize[0], cv.CV_32FC1)
-        map2x = cv.CreateMat(WinSize[1], WinSize[0], cv.CV_32FC1)
-        map1y = cv.CreateMat(WinSize[1], WinSize[0], cv.CV_32FC1)
-        map2y = cv.CreateMat(WinSize[1], WinSize[0], cv.CV_32FC1)
+    def getPipeline(self, calibration, rectification, WinSize=(352,288), method="BM", state=None, threaded=False):
+        """
+        **SUMMARY**
 
-        #print "Rectifying images..."
-        cv.InitUndistortRectifyMap(CM1, D1, R1, P1, map1x, map1y)
-        cv.InitUndistortRectifyMap(CM2, D2, R2, P2, map2x, map2y)
+        Return a StereoPipeline for the calibration and rectification tuples. Pipelines
+        are cached on the StereoCamera, so calling this again with the same tuples
+        returns the same pipeline instead of recomputing the rectification maps. The
+        least recently used pipelines are closed and dropped once their maps use more
+        than FRAME_CACHE_BUDGET bytes. A pipeline too big for the cache on its own is
+        kept until a different one of that size is asked for, then closed.
 
-        cv.Remap(imgLeft, dst1, map1x, map1y)
-        cv.Remap(imgRight, dst2, map2x, map2y)
-        return Image(dst1), Image(dst2)
+        **PARAMETERS**
+
+        See StereoPipeline.
+
+        **RETURNS**
+
+        A StereoPipeline.
+
+        **EXAMPLE**
+
+        >>> StereoCam = StereoCamera()
+        >>> calibration = StereoCam.loadCalibration(fname="Stereo1")
+        >>> rectification = StereoCam.stereoRectify(calibration)
+        >>> pipeline = StereoCam.getPipeline(calibration, rectification, threaded=True)
+
+        """
+        key = (id(calibration), id(rectification), tuple(WinSize), method,
+               repr(sorted(state.items())) if state else None, bool(threaded))
+        #the entry holds on to the tuples, so their ids are not reused while it is cached
+        entry = self._pipelines.get(key)
+        if entry is None and self._largePipeline is not None and self._largePipeline[0] == key:
+            entry = self._largePipeline[1]
+        if entry is None:
+            pipeline = StereoPipeline(calibration, rectification, WinSize, method, state, threaded)
+            entry = self._pipelines.put(key, (calibration, rectification, pipeline))
+            if key not in self._pipelines:
+                if self._largePipeline is not None:
+                    self._largePipeline[1][2].close()
+                self._largePipeline = (key, entry)
+        return entry[2]
 
     def get3DImage(self, leftIndex, rightIndex, Q, method="BM", state=None):
         """
@@ -2541,11 +3778,13 @@ class StereoCamera :
                     minDisparity  - int
                     preFilterCap - int
                     preFilterType - int (only BM)
+                    preFilterSize - odd int (only BM)
                     speckleRange - int
                     speckleWindowSize - int
                     P1 - int (only SGBM)
                     P2 - int (only SGBM)
                     fullDP - Bool (only SGBM)
+                    disp12MaxDiff - int (only SGBM)
                     uniquenessRatio - int
                     textureThreshold - int (only BM)
                     
@@ -2607,12 +3846,162 @@ class StereoCamera :
         del camLeft
         del camRight
 
+        key = repr(sorted(state.items())) if state else None
+        cached = self._stereoStates.get(method)
+        if cached is not None and cached[0] == key:
+            sbm = cached[1]
+        else:
+            sbm = _createStereoState(method, state)
+            if sbm is None:
+                return None
+            self._stereoStates[method] = (key, sbm)
+
         stereoImages = StereoImage(imgLeft, imgRight)
-        Image3D_normalize = stereoImages.get3DImage(Q, method, state)
+        Image3D_normalize = stereoImages._get3DImage(Q, method, sbm)
         self.Image3D = stereoImages.Image3D
         return Image3D_normalize
 
 
+class StereoPipeline:
+    """
+    **SUMMARY**
+
+    StereoPipeline turns a stream of left/right frame pairs from a calibrated stereo
+    rig into rectified images, disparity maps and 3D images. Everything that depends
+    only on the calibration -- the fixed point rectification maps and the stereo
+    matcher state -- is built once when the pipeline is created, so each frame pair
+    only costs two remaps and one correspondence search.
+
+    With threaded=True the right image is rectified on a worker thread while the
+    left image is rectified on the calling thread; OpenCV releases the GIL while it
+    remaps so the two run in parallel.
+
+    **EXAMPLE**
+
+    >>> StereoCam = StereoCamera()
+    >>> calibration = StereoCam.loadCalibration(fname="Stereo1")
+    >>> rectification = StereoCam.stereoRectify(calibration)
+    >>> pipeline = StereoPipeline(calibration, rectification, threaded=True)
+    >>> camLeft = Camera(0)
+    >>> camRight = Camera(1)
+    >>> while True:
+    >>>     pipeline.process(camLeft.getImage(), camRight.getImage()).show()
+
+    """
+    def __init__(self, calibration, rectification, WinSize=(352,288), method="BM", state=None, threaded=False):
+        """
+        **SUMMARY**
+
+        Build the pipeline.
+
+        **PARAMETERS**
+
+        * *calibration* - A calibration tuple of the format (CM1, CM2, D1, D2, R, T, E, F)
+        * *rectification* - A rectification tuple of the format (R1, R2, P1, P2, Q, roi)
+        * *WinSize* - The (width, height) of the frames.
+        * *method* - Stereo correspondence method, "BM" or "SGBM".
+        * *state* - dictionary of stereo correspondence parameters, see StereoImage.get3DImage.
+        * *threaded* - If True rectify the left and right images in parallel.
+
+        """
+        (CM1, CM2, D1, D2, R, T, E, F) = calibration
+        (R1, R2, P1, P2, Q, roi) = rectification
+        self.WinSize = tuple(WinSize)
+        self.Q = np.array(Q)
+        self.roi = roi
+        self.method = method
+        self.Image3D = None
+        self._maps = []
+        for (CM, D, Rr, P) in [(CM1, D1, R1, P1), (CM2, D2, R2, P2)]:
+            self._maps.append(cv2.initUndistortRectifyMap(np.array(CM), np.array(D), np.array(Rr),
+                                                          np.array(P), self.WinSize, cv2.CV_16SC2))
+        self.nbytes = buffer_nbytes(self._maps)
+        self._sbm = _createStereoState(method, state)
+        self._pool = None
+        if threaded:
+            from multiprocessing.pool import ThreadPool
+            self._pool = ThreadPool(1)
+
+    def _remap(self, img, which):
+        map1, map2 = self._maps[which]
+        return Image.fromArray(cv2.remap(img.getNumpyCv2(), map1, map2, cv2.INTER_LINEAR))
+
+    def rectify(self, imgLeft, imgRight):
+        """
+        **SUMMARY**
+
+        Rectify a pair of images.
+
+        **RETURNS**
+
+        The rectified images in a tuple -> (imgLeft,imgRight)
+
+        """
+        if self._pool is None:
+            return self._remap(imgLeft, 0), self._remap(imgRight, 1)
+        right = self._pool.apply_async(self._remap, (imgRight, 1))
+        left = self._remap(imgLeft, 0)
+        return left, right.get()
+
+    def findDisparity(self, imgLeft, imgRight, rectify=True):
+        """
+        **SUMMARY**
+
+        Compute the raw disparity of a pair of images with the pipeline's matcher.
+
+        **PARAMETERS**
+
+        * *rectify* - If False the images are taken to be rectified already.
+
+        **RETURNS**
+
+        The disparity as a numpy array, or None if the method is unknown.
+
+        """
+        if self._sbm is None:
+            return None
+        if rectify:
+            imgLeft, imgRight = self.rectify(imgLeft, imgRight)
+        return np.asarray(_stereoDisparity(imgLeft.getGrayNumpyCv2(), imgRight.getGrayNumpyCv2(), self.method, self._sbm))
+
+    def process(self, imgLeft, imgRight, rectify=True):
+        """
+        **SUMMARY**
+
+        Rectify a frame pair and compute its 3D image. The CV_32F 3D image is kept
+        in StereoPipeline.Image3D.
+
+        **PARAMETERS**
+
+        * *rectify* - If False the images are taken to be rectified already.
+
+        **RETURNS**
+
+        SimpleCV.Image representing the normalized 3D depth Image, or None on failure.
+
+        """
+        if self._sbm is None:
+            return None
+        if rectify:
+            imgLeft, imgRight = self.rectify(imgLeft, imgRight)
+        stereoImages = StereoImage(imgLeft, imgRight)
+        retVal = stereoImages._get3DImage(self.Q, self.method, self._sbm)
+        self.Image3D = stereoImages.Image3D
+        return retVal
+
+    def close(self):
+        """
+        **SUMMARY**
+
+        Stop the rectification worker thread, if any.
+
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
 class AVTCameraThread(threading.Thread):
     camera = None
     run = True
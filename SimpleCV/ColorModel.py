@@ -2,6 +2,7 @@
 #load required libraries
 from SimpleCV.base import *
 from SimpleCV.ImageClass import *
+import struct
 
 
 class ColorModel:
@@ -19,13 +20,25 @@ class ColorModel:
     #TODO: Discretize the colorspace into smaller intervals,eg r=[0-7][8-15] etc
     #TODO: Work in HSV space
     mIsBackground = True
-    mData = {}
+    #per bin training counts, indexed by the bit shifted color. The counts stay
+    #unpacked in memory for soft membership, only save() can pack them to bits
+    mCounts = None
     mBits = 1
+    #cached (minCount, boolean table) compiled from mCounts
+    _mLUT = None
+
+    #binary file layout: magic, version, bits, flags, then the raw bin data
+    _FILE_MAGIC = "SCCM"
+    _FILE_VERSION = 1
+    _FILE_HEADER = "<4sBBBx"
+    _FLAG_COUNTS = 1
+    _FLAG_BACKGROUND = 2
 
     def __init__(self, data = None, isBackground=True):
         self.mIsBackground = isBackground
-        self.mData = {}
         self.mBits = 1
+        self.mCounts = None
+        self._mLUT = None
 
         if data:
             try:
@@ -37,13 +50,14 @@ class ColorModel:
     def _makeCanonical(self, data):
         """
         Turn input types in a common form used by the rest of the class -- a
-        4-bit shifted list of unique colors
+        flat array with the table index of each bit shifted color.
         """
         ret = ''
 
         #first cast everything to a numpy array
         if(data.__class__.__name__ == 'Image'):
-            ret =  data.getNumpy().reshape(-1, 3)
+            bgr = data.getNumpyCv2()
+            ret = bgr[:, :, ::-1].reshape(-1, 3)
         elif(data.__class__.__name__ == 'cvmat'):
             ret = np.array(data).reshape(-1, 3)
         elif(data.__class__.__name__ == 'list'  ):
@@ -54,22 +68,69 @@ class ColorModel:
             ret = np.array(temp,dtype='uint8')
         elif (data.__class__.__name__=='tuple'):
             ret = np.array((data[2],data[1],data[0]),'uint8')
-        elif(data.__class__.__name__=='np.array'):
-            ret = data
+        elif(data.__class__.__name__ in ['ndarray', 'memmap']):
+            ret = data.reshape(-1, 3)
         else:
             logger.warning("ColorModel: color is not in an accepted format!")
             return None
 
-        rs = np.right_shift(ret, self.mBits)  #right shift 4 bits
+        rs = np.right_shift(np.asarray(ret, dtype=np.uint8).reshape(-1, 3), self.mBits).astype(np.intp)
+        return self._flatIndex(rs[:, 0], rs[:, 1], rs[:, 2])
 
-        if( len(rs.shape) > 1 ):
-            uniques = np.unique(rs.view([('',rs.dtype)]*rs.shape[1])).view(rs.dtype).reshape(-1, 3)
-        else:
-            uniques = [rs]
-        #create a unique set of colors.  I had to look this one up
+    def _flatIndex(self, c0, c1, c2):
+        """
+        Pack three bit shifted channels into an index into the raveled table.
+        """
+        shift = 8 - self.mBits
+        return (c0 << (2 * shift)) | (c1 << shift) | c2
 
-        #create a dict of encoded strings
-        return dict.fromkeys(map(np.ndarray.tostring, uniques), 1)
+    def _getCounts(self):
+        """
+        Return the count table, allocating it on first use. If mBits was
+        changed after training the existing counts are requantized to the
+        new bin size.
+        """
+        side = 256 >> self.mBits
+        counts = self.mCounts
+        if( counts is None ):
+            self.mCounts = np.zeros((side, side, side), dtype=np.uint32)
+        elif( counts.shape[0] > side ):
+            f = counts.shape[0] / side
+            self.mCounts = np.asarray(counts, dtype=np.uint64).reshape(side, f, side, f, side, f).sum(axis=(1, 3, 5)).astype(np.uint32)
+            self._mLUT = None
+        elif( counts.shape[0] < side ):
+            f = side / counts.shape[0]
+            self.mCounts = counts.repeat(f, 0).repeat(f, 1).repeat(f, 2)
+            self._mLUT = None
+        return self.mCounts
+
+    def _getLUT(self, minCount=1):
+        """
+        Return the model as a dense boolean table with one cell per quantized
+        color, true where the bin has at least minCount training samples. The
+        table is cached until the counts change.
+        """
+        counts = self._getCounts()
+        if( self._mLUT is None or self._mLUT[0] != minCount ):
+            self._mLUT = (minCount, counts >= minCount)
+        return self._mLUT[1]
+
+    def _binCounts(self, data):
+        """
+        Histogram the input data into the bins it touches and how many samples
+        fell in each, as two flat arrays indexing the raveled count table.
+        """
+        idx = self._makeCanonical(data)
+        if( idx is None ):
+            return None
+        size = self._getCounts().size
+        if( idx.size * 16 < size ):
+            #a few colors, don't allocate a histogram the size of the table
+            (bins, inverse) = np.unique(idx, return_inverse=True)
+            return (bins, np.bincount(inverse))
+        hist = np.bincount(idx, minlength=size)
+        bins = np.flatnonzero(hist)
+        return (bins, hist[bins])
 
     def reset(self):
         """
@@ -88,13 +149,16 @@ class ColorModel:
         >>> cm.clear()
 
         """
-        self.mData = {}
+        self.mCounts = None
+        self._mLUT = None
 
     def add(self, data):
         """
         **SUMMARY**
 
-        Add an image, array, or tuple to the color model.
+        Add an image, array, or tuple to the color model. Every pixel of the data
+        increments the count of its quantized color bin in place, so a model can
+        be trained incrementally over many frames.
 
         **PARAMETERS**
 
@@ -111,13 +175,21 @@ class ColorModel:
         >>> cm.clear()
 
         """
-        self.mData.update(self._makeCanonical(data))
+        hist = self._binCounts(data)
+        if( hist is None ):
+            return
+        (bins, n) = hist
+        counts = self._getCounts().reshape(-1)
+        counts[bins] = counts[bins] + n
+        self._mLUT = None
 
     def remove(self, data):
         """
         **SUMMARY**
 
-        Remove an image, array, or tuple from the model.
+        Remove an image, array, or tuple from the model. Every color in the data
+        is dropped from the model, however many times it was added. Use subtract()
+        to undo a single add() instead.
 
         **PARAMETERS**
 
@@ -134,20 +206,59 @@ class ColorModel:
         >>> cm.remove(Color.BLACK)
 
         """
-        self.mData = dict.fromkeys(set(self.mData) ^ set(self._makeCanonical(data)), 1)
+        hist = self._binCounts(data)
+        if( hist is None ):
+            return
+        counts = self._getCounts().reshape(-1)
+        counts[hist[0]] = 0
+        self._mLUT = None
+
+    def subtract(self, data):
+        """
+        **SUMMARY**
+
+        Undo a previous add() of an image, array, or tuple. The counts contributed
+        by the data are subtracted, and a color leaves the model once its count
+        drops to zero.
+
+        **PARAMETERS**
+
+        * *data* - An image, array, or tupple of value.
+
+        **RETURNS**
+
+        Nothings.
+
+        **EXAMPLE**
+
+        >>> cm = ColorModel()
+        >>> cm.add(Image("lenna"))
+        >>> cm.add(Color.BLACK)
+        >>> cm.subtract(Color.BLACK)
 
-    def threshold(self, img):
+        """
+        hist = self._binCounts(data)
+        if( hist is None ):
+            return
+        (bins, n) = hist
+        counts = self._getCounts().reshape(-1)
+        counts[bins] = counts[bins] - np.minimum(counts[bins], n)
+        self._mLUT = None
+
+    def threshold(self, img, minCount=1):
         """
         **SUMMARY**
 
-        Perform a threshold operation on the given image. This involves iterating
-        over the image and comparing each pixel to the model. If the pixel is in the
-        model it is set to be either the foreground (white) or background (black) based
-        on the setting of mIsBackground.
+        Perform a threshold operation on the given image. Each pixel is looked up
+        in the model's color table. If the pixel is in the model it is set to be
+        either the foreground (white) or background (black) based on the setting
+        of mIsBackground.
 
         **PARAMETERS**
 
         * *img* - the image to perform the threshold on.
+        * *minCount* - the number of training samples a color needs before it is
+          considered part of the model. Raising this ignores rare colors.
 
         **RETURNS**
 
@@ -168,12 +279,13 @@ class ColorModel:
             a = 255
             b = 0
 
-        rs = np.right_shift(img.getNumpy(), self.mBits).reshape(-1, 3) #bitshift down and reshape to Nx3
-        mapped = np.array(map(self.mData.has_key, map(np.ndarray.tostring, rs))) #map to True/False based on the model
-        thresh = np.where(mapped, a, b) #replace True and False with fg and bg
-        return Image(thresh.reshape(img.width, img.height))
+        lut = self._getLUT(minCount)
+        rs = np.right_shift(img.getNumpyCv2(), self.mBits) #bitshift down, rows x cols x BGR
+        mapped = lut[rs[:, :, 2], rs[:, :, 1], rs[:, :, 0]] #one table lookup per pixel, in the model's channel order
+        thresh = np.where(mapped, np.uint8(a), np.uint8(b)) #replace True and False with fg and bg
+        return Image.fromArray(thresh, layout="cv2")
 
-    def contains(self, c):
+    def contains(self, c, minCount=1):
         """
         **SUMMARY**
 
@@ -182,6 +294,8 @@ class ColorModel:
         **PARAMETERS**
 
         * *c* - A three value color tupple.
+        * *minCount* - the number of training samples the color needs to count as
+          being in the model.
 
         **RETURNS**
 
@@ -197,8 +311,34 @@ class ColorModel:
 
 
        """
-        #reverse the color, cast to uint8, right shift, convert to string, check dict
-        return self.mData.has_key(np.right_shift(np.cast['uint8'](c[::-1]), self.mBits).tostring())
+        #reverse the color, cast to uint8, right shift, look it up in the table
+        rs = np.right_shift(np.cast['uint8'](c[::-1]), self.mBits)
+        return bool(self._getLUT(minCount)[rs[0], rs[1], rs[2]])
+
+    def getCount(self, c):
+        """
+        **SUMMARY**
+
+        Return the number of training samples that fell in the same bin as a color.
+        This gives a soft measure of how strongly the color belongs to the model.
+
+        **PARAMETERS**
+
+        * *c* - A three value color tupple.
+
+        **RETURNS**
+
+        The integer count for the color's bin.
+
+        **EXAMPLE**
+
+        >>> cm = ColorModel()
+        >>> cm.add(Image("lenna"))
+        >>> print cm.getCount(Color.RED)
+
+        """
+        rs = np.right_shift(np.cast['uint8'](c[::-1]), self.mBits)
+        return int(self._getCounts()[rs[0], rs[1], rs[2]])
 
     def setIsForeground(self):
         """
@@ -229,19 +369,19 @@ class ColorModel:
         """
         mIsBackground = True
 
-    def load(self, filename):
+    def load(self, filename, mmap=False):
         """
         **SUMMARY**
 
-        Load the color model from the specified file.
-
-        **TO DO**
-
-        This should be converted to pickle.
+        Load the color model from the specified file. Files written by save() are
+        a small header followed by the raw bins, so the counts can be memory mapped
+        rather than read. Older pickled models are still understood.
 
         **PARAMETERS**
 
         * *filename* - The file name and path to load the data from.
+        * *mmap* - If True the count table is memory mapped copy-on-write instead
+          of read into memory; later add(), remove() and subtract() calls never touch the file.
 
         **RETURNS**
 
@@ -256,17 +396,62 @@ class ColorModel:
         >>> cm.save("mymodel)
 
         """
-        self.mData =  load(open(filename))
-
-    def save(self, filename):
+        hsize = struct.calcsize(self._FILE_HEADER)
+        f = open(filename, "rb")
+        try:
+            header = f.read(hsize)
+            if( len(header) < hsize or header[:4] != self._FILE_MAGIC ):
+                #an old pickled dict of shifted color strings
+                f.seek(0)
+                data = load(f)
+                self.mBits = 1
+                self.mCounts = None
+                counts = self._getCounts()
+                keys = [k for k in data if len(k) == 3]
+                if( len(keys) ):
+                    idx = np.frombuffer(''.join(keys), dtype=np.uint8).reshape(-1, 3)
+                    counts[idx[:, 0], idx[:, 1], idx[:, 2]] = 1
+                self._mLUT = None
+                return
+
+            magic, version, bits, flags = struct.unpack(self._FILE_HEADER, header)
+            if( version > self._FILE_VERSION ):
+                logger.warning("ColorModel: unknown model file version %d" % version)
+                return
+            side = 256 >> bits
+            shape = (side, side, side)
+            if( flags & self._FLAG_COUNTS ):
+                if( mmap ):
+                    counts = np.memmap(filename, dtype='<u4', mode='c', offset=hsize, shape=shape)
+                else:
+                    counts = np.fromfile(f, dtype='<u4', count=side**3).reshape(shape)
+            else:
+                if( mmap ):
+                    packed = np.memmap(filename, dtype=np.uint8, mode='r', offset=hsize, shape=(side**3 / 8,))
+                else:
+                    packed = np.fromfile(f, dtype=np.uint8, count=side**3 / 8)
+                counts = np.unpackbits(packed).astype(np.uint32).reshape(shape)
+        finally:
+            f.close()
+
+        self.mBits = bits
+        self.mIsBackground = bool(flags & self._FLAG_BACKGROUND)
+        self.mCounts = counts
+        self._mLUT = None
+
+    def save(self, filename, counts=False):
         """
         **SUMMARY**
 
-        Save a color model file.
+        Save a color model file. By default only membership is kept, one bit per
+        color bin (256KB at the default quantization). Pass counts=True to keep
+        the full per bin counts so training can continue after a reload.
 
         **PARAMETERS**
 
         * *filename* - The file name and path to save the data to.
+        * *counts* - If True store the 32 bit count of every bin rather than a
+          packed membership bit.
 
         **RETURNS**
 
@@ -279,9 +464,19 @@ class ColorModel:
         >>> cm.add(Color.BLUE)
         >>> cm.save("mymodel.txt")
 
-        **TO DO**
-
-        This should be converted to pickle.
-
         """
-        dump(self.mData, open(filename, "wb"))
+        flags = 0
+        if( counts ):
+            flags |= self._FLAG_COUNTS
+        if( self.mIsBackground ):
+            flags |= self._FLAG_BACKGROUND
+        table = self._getCounts()
+        f = open(filename, "wb")
+        try:
+            f.write(struct.pack(self._FILE_HEADER, self._FILE_MAGIC, self._FILE_VERSION, self.mBits, flags))
+            if( counts ):
+                np.ascontiguousarray(table, dtype='<u4').tofile(f)
+            else:
+                np.packbits(table.reshape(-1) > 0).tofile(f)
+        finally:
+            f.close()
@@ -2,6 +2,11 @@ from SimpleCV.base import *
 from SimpleCV.ImageClass import Image
 from SimpleCV.Features.FeatureExtractorBase import *
 
+def _bofFilePatches(args):
+    #worker for the streaming generate, loads one file and returns its patches
+    (infile, sz) = args
+    return BOFFeatureExtractor()._getPatches(Image(infile), sz)
+
 class BOFFeatureExtractor(object):
     """
     For a discussion of bag of features please see:
@@ -29,7 +34,8 @@ class BOFFeatureExtractor(object):
         self.mPatchSize = patchsz
         self.mNumCodes = numcodes
 
-    def generate(self,imgdirs,numcodes=128,sz=(11,11),imgs_per_dir=50,img_layout=(8,16),padding=0, verbose=True):
+    def generate(self,imgdirs,numcodes=128,sz=(11,11),imgs_per_dir=50,img_layout=(8,16),padding=0, verbose=True,
+                 method="kmeans", batchsize=10000, workers=1, checkpoint=None, seed=None):
         """
         This method builds the bag of features codebook from a list of directories
         with images in them. Each directory should be broken down by image class.
@@ -40,8 +46,18 @@ class BOFFeatureExtractor(object):
         * imglayout: the shape of the resulting image in terms of patches - this must
           match the size of numcodes. I.e. numcodes == img_layout[0]*img_layout[1]
         * padding:the pixel padding of each patch in the resulting image.
-        * imgs_per_dir: this method can use a specified number of images per directory
+        * imgs_per_dir: this method can use a specified number of images per directory,
+          None uses all of them.
         * verbose: print output
+        * method: "kmeans" stacks every patch in memory and runs a batch k-means.
+          "minibatch" streams the patches from disk through a mini-batch k-means,
+          only ever holding batchsize patches, so it scales to very large image sets.
+        * batchsize: the number of patches in each mini-batch.
+        * workers: the number of processes loading images and cutting patches for
+          the minibatch method.
+        * checkpoint: for the minibatch method, a file name the state is saved to after
+          every mini-batch. If the file exists the run resumes from it.
+        * seed: seeds the choice of the initial codes for the minibatch method.
 
 
         Once the method has completed it will save the results to a local file
@@ -60,17 +76,24 @@ class BOFFeatureExtractor(object):
         self.mLayout = img_layout
         self.mNumCodes = numcodes
         self.mPatchSize = sz
-        rawFeatures = np.zeros(sz[0]*sz[1])#fakeout numpy so we can use vstack
+        files = []
         for path in imgdirs:
-            fcount = 0
-            files = []
+            found = []
             for ext in IMAGE_FORMATS:
-                files.extend(glob.glob( os.path.join(path, ext)))
-            nimgs = min(len(files),imgs_per_dir)
-            for i in range(nimgs):
+                found.extend(glob.glob( os.path.join(path, ext)))
+            files.extend(sorted(found)[:imgs_per_dir])
+
+        if( method == "minibatch" ):
+            codebook = self._streamCodebook(files, numcodes, sz, batchsize, workers, checkpoint, seed, verbose)
+            if codebook is None:
+                return None
+            self.mCodebook = codebook
+        elif( method == "kmeans" ):
+            rawFeatures = np.zeros(sz[0]*sz[1])#fakeout numpy so we can use vstack
+            for i in range(len(files)):
                 infile = files[i]
                 if verbose:
-                    print(path+" "+str(i)+" of "+str(imgs_per_dir))
+                    print(str(i)+" of "+str(len(files)))
                     print "Opening file: " + infile
                 img = Image(infile)
                 newFeat = self._getPatches(img,sz)
@@ -78,15 +101,129 @@ class BOFFeatureExtractor(object):
                     print "     Got " + str(len(newFeat)) + " features."
                 rawFeatures = np.vstack((rawFeatures,newFeat))
                 del img
-        rawFeatures = rawFeatures[1:,:] # pop the fake value we put on the top
-        if verbose:
-            print "=================================="
-            print "Got " + str(len(rawFeatures)) + " features "
-            print "Doing K-Means .... this will take a long time"
-        self.mCodebook = self._makeCodebook(rawFeatures,self.mNumCodes)
+            rawFeatures = rawFeatures[1:,:] # pop the fake value we put on the top
+            if verbose:
+                print "=================================="
+                print "Got " + str(len(rawFeatures)) + " features "
+                print "Doing K-Means .... this will take a long time"
+            self.mCodebook = self._makeCodebook(rawFeatures,self.mNumCodes)
+        else:
+            warnings.warn("Unknown codebook method " + str(method))
+            return None
         self.mCodebookImg = self._codebook2Img(self.mCodebook,self.mPatchSize,self.mNumCodes,self.mLayout,self.mPadding)
         self.mCodebookImg.save('codebook.png')
 
+    def _streamCodebook(self, files, ncodes, sz, batchsize, workers, checkpoint, seed, verbose):
+        """
+        Mini-batch k-means over the patches of files, read one file at a time.
+        Each mini-batch moves every code to the running mean of all the patches
+        ever assigned to it. The state is checkpointed between files, along with
+        the patches waiting for the next mini-batch, so a resumed run ends up
+        where an uninterrupted one would.
+        """
+        length = sz[0]*sz[1]
+        batchsize = max(batchsize, ncodes)
+        rng = np.random.RandomState(seed)
+        batch = np.empty((batchsize, length))
+        fill = 0
+        centers = None
+        counts = np.zeros(ncodes)
+        done = 0
+        if checkpoint is not None and os.path.exists(checkpoint):
+            npz = np.load(checkpoint)
+            state = dict((k, npz[k]) for k in npz.files)
+            npz.close()
+            if( tuple(state['shape']) != (ncodes, length) or list(state['files']) != files ):
+                warnings.warn("The checkpoint " + checkpoint + " is for a different codebook.")
+                return None
+            if state['centers'].size:
+                centers = state['centers']
+                counts = state['counts']
+            done = int(state['done'])
+            fill = len(state['pending'])
+            batch[:fill] = state['pending']
+            if verbose:
+                print "Resuming from " + checkpoint + " after " + str(done) + " of " + str(len(files)) + " files"
+
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        jobs = [(f, sz) for f in files[done:]]
+        pool = None
+        if workers > 1 and len(jobs) > 1 and hasattr(os, "fork"):
+            pool = multiprocessing.Pool(workers)
+            patches = pool.imap(_bofFilePatches, jobs)
+        else:
+            patches = itertools.imap(_bofFilePatches, jobs)
+        try:
+            for newFeat in patches:
+                if verbose:
+                    print str(done) + " of " + str(len(files)) + ": " + files[done] + " " + str(len(newFeat)) + " features"
+                updated = False
+                start = 0
+                while start < len(newFeat):
+                    n = min(batchsize - fill, len(newFeat) - start)
+                    batch[fill:fill+n] = newFeat[start:start+n]
+                    fill += n
+                    start += n
+                    if fill == batchsize:
+                        if centers is None:
+                            centers = batch[rng.permutation(fill)[:ncodes]].copy()
+                        self._miniBatchUpdate(centers, counts, batch)
+                        fill = 0
+                        updated = True
+                done += 1
+                if checkpoint is not None and updated:
+                    self._saveStreamState(checkpoint, files, ncodes, length, centers, counts, done, batch[:fill])
+            if pool is not None:
+                pool.close()
+        except:
+            if pool is not None:
+                pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.join()
+
+        if centers is None:
+            if fill < ncodes:
+                warnings.warn("Only found " + str(fill) + " patches, not enough for " + str(ncodes) + " codes.")
+                return None
+            centers = batch[rng.permutation(fill)[:ncodes]].copy()
+        if fill:
+            self._miniBatchUpdate(centers, counts, batch[:fill])
+        if checkpoint is not None:
+            self._saveStreamState(checkpoint, files, ncodes, length, centers, counts, done, batch[:0])
+        return centers
+
+    def _miniBatchUpdate(self, centers, counts, batch):
+        """
+        Assign a mini-batch to its nearest centers and fold it into their running
+        means, in place.
+        """
+        codes = self._assignCodes(batch, codebook=centers)
+        order = np.argsort(codes, kind='mergesort')
+        codes = codes[order]
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        hit = codes[starts]
+        sums = np.add.reduceat(batch[order], starts, axis=0)
+        n = np.diff(np.r_[starts, len(codes)])
+        counts[hit] += n
+        centers[hit] += (sums - n[:,np.newaxis]*centers[hit]) / counts[hit][:,np.newaxis]
+
+    def _saveStreamState(self, checkpoint, files, ncodes, length, centers, counts, done, pending):
+        #write next to the checkpoint and rename, so a crash never leaves it half written
+        tmp = checkpoint + ".tmp"
+        tmpfile = open(tmp, 'wb')
+        try:
+            np.savez(tmpfile, shape=np.array((ncodes, length)), files=np.array(files),
+                     centers=centers if centers is not None else np.zeros((0, length)),
+                     counts=counts, done=np.array(done), pending=pending)
+        finally:
+            tmpfile.close()
+        if os.path.exists(checkpoint) and os.name == 'nt':
+            os.remove(checkpoint)
+        os.rename(tmp, checkpoint)
+
     def extractPatches(self, img, sz=(11,11) ):
         """
         Get patches from a single images. This is an external access method. The
@@ -124,7 +261,8 @@ class BOFFeatureExtractor(object):
         w = patchsize[0]
         h = patchsize[1]
         length = w*h
-        retVal = np.zeros(length)
+        retVal = np.zeros((patch_arrangement[0]*patch_arrangement[1], length))
+        count = 0
         for widx in range(patch_arrangement[0]):
             for hidx in range(patch_arrangement[1]):
                 x = (widx*patchsize[0])+((widx+1)*spacersz)
@@ -132,8 +270,8 @@ class BOFFeatureExtractor(object):
                 cv.SetImageROI(lmat,(x,y,w,h))
                 cv.Copy(lmat,patch)
                 cv.ResetImageROI(lmat)
-                retVal = np.vstack((retVal,np.array(patch[:,:]).reshape(length)))
-        retVal = retVal[1:,:]
+                retVal[count] = np.array(patch[:,:]).reshape(length)
+                count = count + 1
         return retVal
 
 
@@ -162,35 +300,62 @@ class BOFFeatureExtractor(object):
         return img
 
     def _getPatches(self,img,sz=None):
-        #retVal = [] # may need to go to np.array
+        """
+        Cut the lightness channel of the image into a grid of non overlapping
+        sz patches, histogram equalize each one, and return them as the rows
+        of an (npatches x sz[0]*sz[1]) array, column of patches by column.
+        """
         if( sz is None ):
             sz = self.mPatchSize
-        img2 = img.toHLS()
-        lmat = cv.CreateImage((img.width,img.height), cv.IPL_DEPTH_8U, 1)
-        patch = cv.CreateImage(self.mPatchSize,cv.IPL_DEPTH_8U,1)
-        cv.Split(img2.getBitmap(),None,lmat,None,None)
-        wsteps = img2.width/sz[0]
-        hsteps = img2.height/sz[1]
         w=sz[0]
         h=sz[1]
-        length = w*h
-        retVal = np.zeros(length)
-        for widx in range(wsteps):
-            for hidx in range(hsteps):
-                x = (widx*sz[0])
-                y = (hidx*sz[1])
-                cv.SetImageROI(lmat,(x,y,w,h))
-                cv.EqualizeHist(lmat,patch)
-                #cv.Copy(lmat,patch)
-                cv.ResetImageROI(lmat)
-
-                retVal = np.vstack((retVal,np.array(patch[:,:]).reshape(length)))
-                #retVal.append()
-        retVal = retVal[1:,:] # pop the fake value we put on top of the stack
+        wsteps = img.width/w
+        hsteps = img.height/h
+        lmat = img.toHLS().getNumpyCv2()[:,:,1]
+        #a strided view of the patches, ordered x major like the grid walk
+        patches = lmat[:hsteps*h,:wsteps*w].reshape(hsteps,h,wsteps,w).transpose(2,0,1,3).reshape(-1,w*h)
+        return self._equalizePatches(patches).astype(np.float64)
+
+    def _equalizePatches(self, patches):
+        """
+        Histogram equalize every row of an (n x length) uint8 array at once, with
+        the same lookup table cv.EqualizeHist builds for each patch.
+        """
+        n, length = patches.shape
+        if n == 0:
+            return patches
+        rows = np.arange(n)[:,np.newaxis]
+        hist = np.bincount((rows*256 + patches).ravel(), minlength=n*256).reshape(n,256)
+        first = np.argmax(hist > 0, axis=1) #the darkest value in each patch
+        firstCount = hist[np.arange(n), first]
+        cdf = np.cumsum(hist, axis=1) - firstCount[:,np.newaxis]
+        scale = np.float32(255.0) / np.maximum(length - firstCount, 1).astype(np.float32)
+        lut = np.clip(np.rint(cdf.astype(np.float32) * scale[:,np.newaxis]), 0, 255).astype(np.uint8)
+        #flat patches are mapped to their own value
+        flat = firstCount == length
+        lut[flat] = first[flat][:,np.newaxis]
+        return lut[rows, patches]
+
+    def _assignCodes(self, data, chunk=1024*1024, codebook=None):
+        """
+        Return the index of the nearest codebook entry for each row of data,
+        using the extractor's codebook unless another one is given.
+        Distances are computed as |c|^2 - 2 x.c in blocks of rows, so memory
+        stays bounded by chunk distances however many rows there are.
+        """
+        if codebook is None:
+            codebook = self.mCodebook
+        codebook = np.asarray(codebook, dtype=np.float64)
+        norms = (codebook**2).sum(axis=1)
+        retVal = np.empty(len(data), dtype=np.intp)
+        step = max(1, chunk / max(1, len(codebook)))
+        for i in range(0, len(data), step):
+            block = np.dot(data[i:i+step], codebook.T)
+            block *= -2
+            block += norms
+            retVal[i:i+step] = np.argmin(block, axis=1)
         return retVal
 
-
-
     def load(self,datafile):
         """
         Load a codebook from file using the datafile. The datafile
@@ -262,8 +427,7 @@ class BOFFeatureExtractor(object):
         the provided codebook. The result are the bin counts for each codebook code.
         """
         data = self._getPatches(img)
-        p = spsd.cdist(data,self.mCodebook)
-        codes = np.argmin(p,axis=1)
+        codes = self._assignCodes(data)
         [retVal,foo] = np.histogram(codes,self.mNumCodes,normed=True,range=(0,self.mNumCodes-1))
         return retVal
 
@@ -275,9 +439,7 @@ class BOFFeatureExtractor(object):
         """
         retVal = cv.CreateImage((img.width,img.height), cv.IPL_DEPTH_8U, 1)
         data = self._getPatches(img)
-        p = spsd.cdist(data,self.mCodebook)
-        foo = p.shape[0]
-        codes = np.argmin(p,axis=1)
+        codes = self._assignCodes(data)
         count = 0
         wsteps = img.width/self.mPatchSize[0]
         hsteps = img.height/self.mPatchSize[1]
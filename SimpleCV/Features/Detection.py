@@ -726,6 +726,8 @@ class HaarFeature(Feature):
     * The x,y coordinates are defined by the center of the bounding rectangle.
     * The classifier property refers to the cascade file used for detection .
     * Points are the clockwise points of the bounding rectangle, starting in upper left.
+    * For features from findHaarFeaturesHierarchy, parent is the feature this one was
+      found inside of (or None) and children are the features found inside this one.
 
     """
     classifier = ""
@@ -733,6 +735,8 @@ class HaarFeature(Feature):
     _height = ""
     neighbors = ''
     featureName = 'None'
+    parent = None
+    children = None
 
     def __init__(self, i, haarobject, haarclassifier = None, cv2flag=True):
         self.image = i
@@ -745,6 +749,7 @@ class HaarFeature(Feature):
         points = ((x, y), (x + width, y), (x + width, y + height), (x, y + height))
 
          #set bounding points of the rectangle
+        self.children = []
         self.classifier = haarclassifier
         if( haarclassifier is not None ):
             self.featureName = haarclassifier.getName()
@@ -1,5 +1,34 @@
 from SimpleCV.base import *
 
+#process wide cache of cv2.CascadeClassifier objects: path -> (mtime, threading.local).
+#Each thread gets its own classifier for a cascade file, so detection can run
+#concurrently, and editing the file on disk invalidates the cached copies.
+_classifierCache = {}
+_classifierLock = threading.Lock()
+
+def _getCascadeClassifier(path):
+    try:
+        import cv2
+    except ImportError:
+        return None
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    with _classifierLock:
+        entry = _classifierCache.get(path)
+        if entry is None or entry[0] != mtime:
+            entry = (mtime, threading.local())
+            _classifierCache[path] = entry
+    local = entry[1]
+    classifier = getattr(local, "classifier", None)
+    if classifier is None:
+        classifier = cv2.CascadeClassifier(path)
+        if classifier.empty():
+            return None
+        local.classifier = classifier
+    return classifier
+
 class HaarCascade():
     """
     This class wraps HaarCascade files for the findHaarFeatures file.
@@ -32,11 +61,10 @@ class HaarCascade():
                     logger.warning("Try running the function img.listHaarFeatures() to see what is available")
                     return None
             
-            self._mCascade = cv.Load(self._fhandle)
-
             if HaarCascade._cache.has_key(self._fhandle):
                 self._mCascade = HaarCascade._cache[self._fhandle]
                 return
+            self._mCascade = cv.Load(self._fhandle)
             HaarCascade._cache[self._fhandle] = self._mCascade
 
     def load(self, fname=None, name = None):
@@ -55,11 +83,10 @@ class HaarCascade():
                     logger.warning("Try running the function img.listHaarFeatures() to see what is available")
                     return None
             
-            self._mCascade = cv.Load(self._fhandle)
-
             if HaarCascade._cache.has_key(self._fhandle):
-                self._mCascade = HaarCascade._cache[fname]
+                self._mCascade = HaarCascade._cache[self._fhandle]
                 return
+            self._mCascade = cv.Load(self._fhandle)
             HaarCascade._cache[self._fhandle] = self._mCascade
         else:
             logger.warning("No file path mentioned.")
@@ -75,3 +102,13 @@ class HaarCascade():
 
     def getFHandle(self):
         return self._fhandle
+
+    def getClassifier(self):
+        """
+        Return a cv2.CascadeClassifier for this cascade, shared with every other
+        HaarCascade for the same file but private to the calling thread. Returns
+        None if cv2 is not available or the file can't be loaded.
+        """
+        if self._fhandle is None:
+            return None
+        return _getCascadeClassifier(self._fhandle)
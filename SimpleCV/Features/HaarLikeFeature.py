@@ -48,38 +48,48 @@ class HaarLikeFeature():
         """
         self.mName = name
 
+    def compile(self, shape, rowStride=None):
+        """
+        Compile the regions for an integral image of the given shape into two
+        arrays, the flat indices of the integral image corners that the feature
+        reads and the weight of each one, so that
+
+        apply(intImg) == np.dot(intImg.ravel()[index], weight)
+
+        If rowStride is given the indices are laid out for a larger integral
+        image with rows of that length, so adding the flat offset of a window's
+        top left corner applies the feature to that window.
+        """
+        w = shape[0]-1
+        h = shape[1]-1
+        # using the integral image
+        # A = Lower Right Hand Corner
+        # B = upper right hand corner
+        # C = lower left hand corner
+        # D = upper left hand corner
+        # sum = A - B - C  + D
+        # regions are in
+        # (p,q,r,s,t) format
+        regions = np.array(self.mRegions, dtype=np.float64).reshape(-1, 5)
+        p = (w*regions[:, 0]).astype(np.intp) # p = left (all are unit length)
+        q = (h*regions[:, 1]).astype(np.intp) # q = top
+        r = (w*regions[:, 2]).astype(np.intp) # r = right
+        s = (h*regions[:, 3]).astype(np.intp) # s = bottom
+        sign = regions[:, 4] # t = sign
+        n = shape[1]
+        if rowStride is not None:
+            n = rowStride
+        index = np.concatenate([r*n+s, r*n+q, p*n+s, p*n+q])
+        weight = np.concatenate([sign, -sign, -sign, sign])
+        return index, weight
+
     def apply(self, intImg ):
         """
         This method takes in an integral image and applies the haar-cascade
         to the image, and returns the result.
         """
-        w = intImg.shape[0]-1
-        h = intImg.shape[1]-1
-        accumulator = 0
-        for i in range(len(self.mRegions)):
-            # using the integral image
-            # A = Lower Right Hand Corner
-            # B = upper right hand corner
-            # C = lower left hand corner
-            # D = upper left hand corner
-            # sum = A - B - C  + D
-            # regions are in
-            # (p,q,r,s,t) format
-            p = self.mRegions[i][0] # p = left (all are unit length)
-            q = self.mRegions[i][1] # q = top
-            r = self.mRegions[i][2] # r = right
-            s = self.mRegions[i][3] # s = bottom
-            sign = self.mRegions[i][4] # t = sign
-            xA = int(w*r)
-            yA = int(h*s)
-            xB = int(w*r)
-            yB = int(h*q)
-            xC = int(w*p)
-            yC = int(h*s)
-            xD = int(w*p)
-            yD = int(h*q)
-            accumulator += sign*(intImg[xA,yA]-intImg[xB,yB]-intImg[xC,yC]+intImg[xD,yD])
-        return accumulator
+        index, weight = self.compile(intImg.shape)
+        return np.dot(intImg.ravel()[index], weight)
 
     def writeToFile(self,file):
         """
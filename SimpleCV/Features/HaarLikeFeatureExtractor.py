@@ -16,6 +16,9 @@ class HaarLikeFeatureExtractor(FeatureExtractorBase):
 
     mFeatureSet = None
     mDo45 = True
+    #BufferCache of (integral image shape, row stride) -> the whole feature set
+    #compiled by _compile, so scanning images of many sizes stays bounded
+    _mCompiled = None
     def __init__(self, fname=None, do45=True):
         """
         fname - The feature file name
@@ -24,8 +27,9 @@ class HaarLikeFeatureExtractor(FeatureExtractorBase):
         """
         #we define the black (positive) and white (negative) regions of an image
         #to get our haar wavelet
-        self.mDo45 = True
-        self.mFeatureset=None;
+        self.mDo45 = do45
+        self.mFeatureSet = None
+        self._mCompiled = BufferCache()
         if(fname is not None):
             self.readWavelets(fname)
 
@@ -42,6 +46,7 @@ class HaarLikeFeatureExtractor(FeatureExtractorBase):
         # -1 loads all
         # otherwise loads min(nfeats,features in file)
         self.mFeatureSet = []
+        self._mCompiled = BufferCache()
         f = open(fname,'r')
         #line = f.readline()
         #count = int(line)
@@ -49,7 +54,6 @@ class HaarLikeFeatureExtractor(FeatureExtractorBase):
         f.close()
         data = temp.split()
         count = int(data.pop(0))
-        self.mFeatureset = []
         if(nfeats > -1):
             count = min(count,nfeats)
         while len(data) > 0:
@@ -75,21 +79,99 @@ class HaarLikeFeatureExtractor(FeatureExtractorBase):
         f.close()
         return None
 
+    def _compile(self, shape, rowStride=None):
+        """
+        Compile every feature for an integral image of the given shape into
+        flat corner indices, corner weights and the feature each corner
+        belongs to, so the whole set can be applied with one gather and one
+        sum. The most recently used results are cached per shape and row
+        stride, see HaarLikeFeature.compile.
+        """
+        if not isinstance(self._mCompiled, BufferCache): #unset, or pickled with a dict
+            self._mCompiled = BufferCache()
+        key = (shape, rowStride)
+        compiled = self._mCompiled.get(key)
+        if compiled is None:
+            indices = []
+            weights = []
+            owners = []
+            for i in range(len(self.mFeatureSet)):
+                index, weight = self.mFeatureSet[i].compile(shape, rowStride)
+                indices.append(index)
+                weights.append(weight)
+                owners.append(np.zeros(len(index), dtype=np.intp) + i)
+            compiled = (np.concatenate(indices), np.concatenate(weights), np.concatenate(owners))
+            self._mCompiled.put(key, compiled)
+        return compiled
+
+    def _applyAll(self, intImg):
+        index, weight, owner = self._compile(intImg.shape)
+        return np.bincount(owner, weights=intImg.ravel()[index]*weight, minlength=len(self.mFeatureSet))
+
     def extract(self, img):
         """
         This extractor takes in an image, creates the integral image, applies
         the Haar cascades, and returns the result as a feature vector.
         """
-        regular = img.integralImage()
-        retVal = []
-
-        for i in range(len(self.mFeatureSet)):
-            retVal.append(self.mFeatureSet[i].apply(regular))
+        retVal = self._applyAll(img._getIntegralImage())
         if(self.mDo45):
-            slant = img.integralImage(tilted=True)
-            for i in range(len(self.mFeatureSet)):
-                retVal.append(self.mFeatureSet[i].apply(regular))
-        return retVal
+            slant = img._getIntegralImage(tilted=True)
+            retVal = np.concatenate([retVal, self._applyAll(slant)])
+        return retVal.tolist()
+
+    def extractWindows(self, img, windowSize=(24,24), stride=4, scales=(1.0,), chunk=4*1024*1024):
+        """
+        Apply the features to every window of a grid of windows over the image,
+        as if each window had been cropped out and passed to extract(), but with
+        the integral image computed only once and no cropping. This is what you
+        need to run a classifier trained on these features as a detector.
+
+        Only the upright features are computed; the 45 degree integral image of
+        a window can't be read out of the whole image's, so do45 is ignored.
+
+        img - the image to scan.
+        windowSize - the (width, height) of the window at scale 1.0.
+        stride - the step between windows in pixels at scale 1.0, either one
+        number or an (x, y) tuple. It grows with the scale.
+        scales - the window scales to scan.
+        chunk - the most corner lookups done in one numpy operation, which bounds
+        the temporary memory used.
+
+        Returns a tuple of an (n_windows x n_features) numpy array and a list of
+        the (x, y, width, height) of each window, in the same order.
+        """
+        if not isinstance(stride, (tuple, list)):
+            stride = (stride, stride)
+        gray = img.getGrayNumpyCv2()
+        #an exact 64 bit integral image, so large images don't lose precision
+        intImg = np.zeros((gray.shape[0]+1, gray.shape[1]+1), dtype=np.int64)
+        intImg[1:, 1:] = gray.cumsum(axis=0, dtype=np.int64).cumsum(axis=1)
+        flat = intImg.ravel()
+        rowStride = intImg.shape[1]
+
+        results = []
+        windows = []
+        for scale in scales:
+            w = int(round(windowSize[0]*scale))
+            h = int(round(windowSize[1]*scale))
+            if w < 1 or h < 1 or w > img.width or h > img.height:
+                continue
+            sx = max(1, int(round(stride[0]*scale)))
+            sy = max(1, int(round(stride[1]*scale)))
+            xs = np.arange(0, img.width - w + 1, sx)
+            ys = np.arange(0, img.height - h + 1, sy)
+            index, weight, owner = self._compile((h+1, w+1), rowStride)
+            starts = np.flatnonzero(np.r_[True, owner[1:] != owner[:-1]])
+            offsets = (ys[:, np.newaxis]*rowStride + xs[np.newaxis, :]).ravel()
+            step = max(1, chunk / max(1, len(index)))
+            for i in range(0, len(offsets), step):
+                values = flat[offsets[i:i+step, np.newaxis] + index[np.newaxis, :]] * weight
+                results.append(np.add.reduceat(values, starts, axis=1))
+            windows.extend([(x, y, w, h) for y in ys for x in xs])
+
+        if not results:
+            return np.zeros((0, len(self.mFeatureSet))), windows
+        return np.vstack(results), windows
 
     def getFieldNames(self):
         """
@@ -113,4 +195,4 @@ class HaarLikeFeatureExtractor(FeatureExtractorBase):
         mult = 1
         if(self.mDo45):
             mult = 2
-        return mult*len(self.mFeatureset)
+        return mult*len(self.mFeatureSet)
@@ -0,0 +1,168 @@
+from SimpleCV.base import *
+from SimpleCV.Features.Features import FeatureSet
+from SimpleCV.Features.Detection import HaarFeature
+from SimpleCV.Features.HaarCascade import HaarCascade
+
+class HaarTracker:
+    """
+    **SUMMARY**
+
+    HaarTracker runs a Haar cascade over the frames of a video without scanning
+    every frame in full. Every fullScan frames (or whenever nothing is being
+    tracked) the whole frame is searched, as findHaarFeatures does. On the frames
+    in between each previous detection is moved by its last frame to frame motion,
+    padded, and the cascade is only run inside that window and only at scales
+    close to the size it was last seen at. New objects entering the frame are
+    picked up at the next full scan.
+
+    **EXAMPLE**
+
+    >>> cam = Camera()
+    >>> tracker = HaarTracker("face.xml", fullScan=15)
+    >>> while True:
+    >>>     img = cam.getImage()
+    >>>     faces = tracker.detect(img)
+    >>>     if faces:
+    >>>         faces.draw()
+    >>>     img.show()
+
+    """
+    def __init__(self, cascade, fullScan=10, padding=0.5, scaleRange=1.3, maxMisses=2,
+                 scale_factor=1.2, min_neighbors=2, use_canny=cv.CV_HAAR_DO_CANNY_PRUNING, min_size=(20,20)):
+        """
+        **SUMMARY**
+
+        Create the tracker.
+
+        **PARAMETERS**
+
+        * *cascade* - The path to a cascade file or a HaarCascade object.
+        * *fullScan* - Search the whole frame once every this many frames.
+        * *padding* - How far around a predicted detection to search, as a fraction
+          of the detection's size on each side.
+        * *scaleRange* - Only search window sizes within this factor of the size a
+          detection was last seen at.
+        * *maxMisses* - The number of frames a detection may go unseen before it is dropped.
+        * *scale_factor*, *min_neighbors*, *use_canny*, *min_size* - see Image.findHaarFeatures.
+
+        """
+        if isinstance(cascade, basestring):
+            cascade = HaarCascade(cascade)
+        self.cascade = cascade
+        self.fullScan = max(1, int(fullScan))
+        self.padding = padding
+        self.scaleRange = scaleRange
+        self.maxMisses = maxMisses
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.use_canny = use_canny
+        self.min_size = min_size
+        self.reset()
+
+    def reset(self):
+        """
+        **SUMMARY**
+
+        Forget the tracked detections, so the next frame gets a full scan.
+
+        """
+        self._tracks = [] #[x, y, w, h, vx, vy, misses]
+        self._sinceFullScan = 0
+
+    def detect(self, img):
+        """
+        **SUMMARY**
+
+        Find the cascade's objects in the next frame of the video.
+
+        **PARAMETERS**
+
+        * *img* - The frame, frames should be given in order.
+
+        **RETURNS**
+
+        A FeatureSet of HaarFeatures, empty if nothing was found.
+
+        """
+        classifier = self.cascade.getClassifier()
+        if classifier is None or not self._tracks or self._sinceFullScan >= self.fullScan:
+            boxes = self._fullScan(img, classifier)
+        else:
+            boxes = self._trackScan(img, classifier)
+        return FeatureSet([HaarFeature(img, b, self.cascade, True) for b in boxes])
+
+    def _fullScan(self, img, classifier):
+        self._sinceFullScan = 1
+        if classifier is None:
+            feats = img.findHaarFeatures(self.cascade, self.scale_factor, self.min_neighbors, self.use_canny, self.min_size)
+            self._tracks = []
+            return [] if not feats else [(int(f.points[0][0]), int(f.points[0][1]), int(f.width()), int(f.height())) for f in feats]
+        objects = classifier.detectMultiScale(img.getGrayNumpyCv2(), scaleFactor=self.scale_factor,
+                                              minNeighbors=self.min_neighbors, minSize=self.min_size, flags=self.use_canny)
+        boxes = [tuple(int(v) for v in o) for o in objects]
+
+        #carry the motion of tracks that match a new detection over to it
+        tracks = []
+        for (x, y, w, h) in boxes:
+            cx = x + w / 2.0
+            cy = y + h / 2.0
+            vx = vy = 0
+            best = None
+            for t in self._tracks:
+                d = math.hypot(t[0] + t[2] / 2.0 - cx, t[1] + t[3] / 2.0 - cy)
+                if d < max(w, h) and (best is None or d < best[0]):
+                    best = (d, t)
+            if best is not None:
+                t = best[1]
+                vx = cx - (t[0] + t[2] / 2.0)
+                vy = cy - (t[1] + t[3] / 2.0)
+            tracks.append([x, y, w, h, vx, vy, 0])
+        self._tracks = tracks
+        return boxes
+
+    def _trackScan(self, img, classifier):
+        self._sinceFullScan += 1
+        gray = img.getGrayNumpyCv2()
+        boxes = []
+        tracks = []
+        for (x, y, w, h, vx, vy, misses) in self._tracks:
+            #constant velocity prediction, padded on every side
+            px = x + vx - self.padding * w
+            py = y + vy - self.padding * h
+            x0 = int(max(0, px))
+            y0 = int(max(0, py))
+            x1 = int(min(img.width, px + w * (1 + 2 * self.padding)))
+            y1 = int(min(img.height, py + h * (1 + 2 * self.padding)))
+            found = []
+            minSize = (int(w / self.scaleRange), int(h / self.scaleRange))
+            maxSize = (int(math.ceil(w * self.scaleRange)), int(math.ceil(h * self.scaleRange)))
+            if x1 - x0 >= minSize[0] and y1 - y0 >= minSize[1]:
+                found = classifier.detectMultiScale(gray[y0:y1, x0:x1], scaleFactor=self.scale_factor,
+                                                    minNeighbors=self.min_neighbors, minSize=minSize,
+                                                    maxSize=maxSize, flags=self.use_canny)
+            if len(found):
+                #keep the detection closest to the prediction
+                pcx = x + vx + w / 2.0
+                pcy = y + vy + h / 2.0
+                (fx, fy, fw, fh) = min(found, key=lambda o: math.hypot(x0 + o[0] + o[2] / 2.0 - pcx, y0 + o[1] + o[3] / 2.0 - pcy))
+                nx = int(x0 + fx)
+                ny = int(y0 + fy)
+                nvx = (nx + fw / 2.0) - (x + w / 2.0)
+                nvy = (ny + fh / 2.0) - (y + h / 2.0)
+                tracks.append([nx, ny, int(fw), int(fh), nvx, nvy, 0])
+                boxes.append((nx, ny, int(fw), int(fh)))
+            elif misses < self.maxMisses:
+                #coast on the prediction for a frame or two, but don't report it
+                tracks.append([int(x + vx), int(y + vy), w, h, vx, vy, misses + 1])
+        self._tracks = self._dropOverlaps(tracks)
+        return boxes
+
+    def _dropOverlaps(self, tracks):
+        #two tracks that converged on the same object are merged into the first
+        kept = []
+        for t in tracks:
+            cx = t[0] + t[2] / 2.0
+            cy = t[1] + t[3] / 2.0
+            if all(abs(k[0] + k[2] / 2.0 - cx) > k[2] / 2.0 or abs(k[1] + k[3] / 2.0 - cy) > k[3] / 2.0 for k in kept):
+                kept.append(t)
+        return kept
@@ -1,6 +1,7 @@
 from SimpleCV.Features.HaarCascade import *
 from SimpleCV.Features.Features import *
 from SimpleCV.Features.Detection import *
+from SimpleCV.Features.HaarTracker import *
 from SimpleCV.Features.BlobMaker import *
 from SimpleCV.Features.Blob import *
 from SimpleCV.Features.BOFFeatureExtractor import *
@@ -571,14 +571,59 @@ class ImageSet(list):
         >>> imgs.load("images/faces")
         >>> imgs.load("images/eyes", "png")
 
+        """
+        file_set = self._findFiles(directory, extension, sort_by)
+        if file_set is None:
+            return
+
+        self.filelist = dict()
+
+        for i in file_set:
+            tmp = self._loadImage(i)
+            if( tmp is not None ):
+                if sys.platform.lower() == 'win32' or sys.platform.lower() == 'win64':
+                    self.filelist[tmp.filename.split('\\')[-1]] = tmp
+                else:
+                    self.filelist[tmp.filename.split('/')[-1]] = tmp
+                self.append(tmp)
+        return len(self)
+
+    def _loadImage(self, path):
+        """
+        Decode one image file, returning None if it can't be read or is empty.
+        """
+        try:
+            tmp = Image(path)
+        except:
+            return None
+        if( tmp is None or tmp.width <= 0 or tmp.height <= 0 ):
+            return None
+        return tmp
+
+    def _imageReference(self, index):
+        """
+        Return what features found on the image at index should point at.
+        """
+        return self[index]
+
+    def _iterSlots(self):
+        """
+        Yield every image of the set in order, None where one can not be decoded.
+        """
+        return list.__iter__(self)
+
+    def _findFiles(self, directory, extension=None, sort_by=None):
+        """
+        Return the image files in directory that load() would read, or None
+        if the directory is invalid.
         """
         if not directory:
             logger.warning("You need to give a directory to load files from.")
-            return
+            return None
 
         if not os.path.exists(directory):
             logger.warning( "Invalid image path given.")
-            return
+            return None
 
 
         if extension:
@@ -607,23 +652,90 @@ class ImageSet(list):
             if( sort_by.lower() == "size"):
                 file_set = sorted(file_set,key=os.path.getsize)
 
-        self.filelist = dict()
+        return file_set
 
-        for i in file_set:
-            tmp = None
+    def map(self, func, workers=None, chunksize=1, args=(), kwargs=None):
+        """
+        **SUMMARY**
+
+        Apply a function to every image in the set, optionally spreading the work over
+        a pool of worker processes.
+
+        The worker processes are forked after the set is built, so they read the images
+        straight out of the parent's memory instead of receiving pickled copies. Images
+        returned by the function come back through memory mapped buffers and are wrapped
+        without another copy; features in a returned FeatureSet are re-attached to the
+        parent's image rather than shipping the image back.
+
+        **PARAMETERS**
+
+        * *func* - A function taking an image as its first argument, or the name of an Image
+          method such as "findBlobs" or "resize".
+        * *workers* - Number of worker processes, defaults to the number of CPUs. 1 runs
+          everything in this process.
+        * *chunksize* - Number of images handed to a worker at a time.
+        * *args* - Extra positional arguments for func.
+        * *kwargs* - Extra keyword arguments for func.
+
+        **RETURNS**
+
+        An ImageSet if func returns images, otherwise a list of the results in order.
+        The result always has one entry per image of the set; an image that could not
+        be decoded (see :py:class:`LazyImageSet`) gets None.
+
+        **EXAMPLE**
+
+        >>> imgs = ImageSet("/path/to/archive/")
+        >>> blobs = imgs.map("findBlobs", workers=8, kwargs={"minsize":50})
+        >>> edges = imgs.map(lambda img: img.edges(10, 80), workers=8, chunksize=16)
+
+        **NOTES**
+
+        Worker processes are only used where the operating system can fork, elsewhere
+        the images are processed serially.
+
+        """
+        if kwargs is None:
+            kwargs = {}
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        workers = min(workers, len(self))
+
+        if workers <= 1 or not hasattr(os, "fork"):
+            results = [_applyToImage(img, func, args, kwargs) for img in self._iterSlots()]
+        else:
+            results = []
+            #every buffer of this call goes in its own directory, so whatever is
+            #still in flight when a worker fails is removed along with it
+            shmdir = tempfile.mkdtemp(prefix="scvmap", dir=_sharedMemoryDir())
             try:
-                tmp = Image(i)
-                if( tmp is not None and tmp.width > 0 and tmp.height > 0):
-                    if sys.platform.lower() == 'win32' or sys.platform.lower() == 'win64':
-                        self.filelist[tmp.filename.split('\\')[-1]] = tmp
-                    else:
-                        self.filelist[tmp.filename.split('/')[-1]] = tmp
-                    self.append(tmp)
-            except:
-                continue
-        return len(self)
+                #the state goes to the workers as the initializer's arguments, which
+                #they inherit when they fork, so concurrent calls can't mix it up
+                state = (self, func, args, kwargs, shmdir)
+                pool = multiprocessing.Pool(workers, _initImageSetMapWorker, (state,))
+                try:
+                    for r in pool.imap(_imageSetMapWorker, xrange(len(self)), chunksize):
+                        results.append(r)
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+
+                for idx in range(len(results)):
+                    if isinstance(results[idx], _SharedImageBuffer):
+                        results[idx] = results[idx].toImage()
+                    elif isinstance(results[idx], _DetachedFeatureSet):
+                        results[idx] = results[idx].attach(self._imageReference(idx))
+            finally:
+                shutil.rmtree(shmdir, ignore_errors=True)
+
+        if len(results) and all([isinstance(r, Image) for r in results]):
+            return ImageSet(results)
+        return results
 
-    def standardize(self,width,height):
+    def standardize(self,width,height,workers=1):
         """
         **SUMMARY**
 
@@ -633,6 +745,7 @@ class ImageSet(list):
 
         * *width* - the width that we want for every image in the set.
         * *height* - the height that we want for every image in the set.
+        * *workers* - the number of worker processes to resize with, see :py:meth:`map`.
 
         **RETURNS**
 
@@ -646,9 +759,9 @@ class ImageSet(list):
         >>>>   t.show()
 
         """
-        retVal = ImageSet()
-        for i in self:
-            retVal.append(i.resize(width,height))
+        retVal = self.map("resize", workers=workers, args=(width, height))
+        if not isinstance(retVal, ImageSet):
+            retVal = ImageSet(retVal)
         return retVal
 
     def dimensions(self):
@@ -676,7 +789,7 @@ class ImageSet(list):
             retVal.append((i.width,i.height))
         return np.array(retVal)
 
-    def average(self, mode="first", size=(None,None)):
+    def average(self, mode="first", size=(None,None), workers=1):
         """
         **SUMMARY**
 
@@ -693,6 +806,7 @@ class ImageSet(list):
           * "fixed" - fixed, use the size tuple provided.
 
         * *size* - if the mode is set to fixed use this tuple as the size of the resulting image.
+        * *workers* - the number of worker processes used to resize the images, see :py:meth:`map`.
 
         **RETURNS**
 
@@ -734,7 +848,7 @@ class ImageSet(list):
         t1 = np.sum(vals[:,0]-fw)
         t2 = np.sum(vals[:,1]-fh)
         if( t1 != 0 or t2 != 0 ):
-            resized = self.standardize(fw,fh)
+            resized = self.standardize(fw,fh,workers=workers)
         else:
             resized = self
         # Now do the average calculation
@@ -769,6 +883,288 @@ class ImageSet(list):
         return self.__getitem__(slice(i,j))
 
 
+class LazyImageSet(ImageSet):
+    """
+    **SUMMARY**
+
+    An ImageSet that only stores the paths of its images and decodes them when
+    they are used. A bounded number of recently used images is kept decoded, and
+    iterating over the set decodes the next few images on a background thread
+    while the current one is being processed.
+
+    Indexing returns decoded Images just like an ImageSet, and the other ImageSet
+    methods (show, save, standardize, map, ...) work unchanged; with :py:meth:`map`
+    the worker processes decode their own images.
+
+    Files that are empty or can't be decoded are logged and skipped while iterating,
+    as :py:meth:`ImageSet.load` skips them; indexing one returns None, and so does
+    its entry in the results of :py:meth:`map`.
+
+    **PARAMETERS**
+
+    * *directory* - A directory to load, or a list of paths.
+    * *cacheSize* - The number of decoded images to keep around.
+    * *prefetch* - The number of images to decode ahead while iterating, 0 disables read-ahead.
+
+    **EXAMPLE**
+
+    >>> imgs = LazyImageSet("/data/training/", cacheSize=32, prefetch=8)
+    >>> len(imgs) # nothing has been decoded yet
+    >>> for img in imgs:
+    >>>     blobs = img.findBlobs()
+
+    """
+
+    def __init__(self, directory=None, cacheSize=16, prefetch=4, extension=None, sort_by=None):
+        self.cacheSize = cacheSize
+        self.prefetch = prefetch
+        self._mCache = collections.OrderedDict()
+        self._mCacheLock = threading.Lock()
+        if not directory:
+            return
+
+        if isinstance(directory, list):
+            list.__init__(self, directory)
+        elif directory.lower() == 'samples' or directory.lower() == 'sample':
+            self.load(os.path.join(os.path.realpath(LAUNCH_PATH), 'sampleimages'), extension, sort_by)
+        else:
+            self.load(directory, extension, sort_by)
+
+    def load(self, directory = None, extension = None, sort_by=None):
+        """
+        **SUMMARY**
+
+        Add the image files in a directory to the set without decoding them, see
+        :py:meth:`ImageSet.load` for the parameters. filelist maps each file name to its path.
+
+        **RETURNS**
+
+        The number of images in the image set.
+
+        """
+        file_set = self._findFiles(directory, extension, sort_by)
+        if file_set is None:
+            return
+
+        self.filelist = dict()
+        for i in file_set:
+            self.filelist[os.path.basename(i)] = i
+            self.append(i)
+        return len(self)
+
+    def _decode(self, item):
+        """
+        Return the Image for a path in the set, from the cache if it is there,
+        or None if the file can't be decoded.
+        """
+        if isinstance(item, Image):
+            return item
+        with self._mCacheLock:
+            img = self._mCache.pop(item, None)
+            if img is not None:
+                self._mCache[item] = img
+                return img
+        img = self._loadImage(item)
+        if img is None:
+            logger.warning("LazyImageSet: could not decode " + str(item))
+            return None
+        with self._mCacheLock:
+            if self.cacheSize > 0:
+                self._mCache[item] = img
+                while len(self._mCache) > self.cacheSize:
+                    self._mCache.popitem(last=False)
+        return img
+
+    def _imageReference(self, index):
+        #features coming back from map are pointed at a reference that only
+        #decodes the image once they use it
+        item = list.__getitem__(self, index)
+        if isinstance(item, Image):
+            return item
+        return _LazyImage(self, item)
+
+    def __getitem__(self, key):
+        if type(key) is types.SliceType:
+            retVal = LazyImageSet(cacheSize=self.cacheSize, prefetch=self.prefetch)
+            list.extend(retVal, list.__getitem__(self, key))
+            return retVal
+        return self._decode(list.__getitem__(self, key))
+
+    def __iter__(self):
+        """
+        Yield the decoded images in order, reading ahead on a background thread.
+        Files that can not be decoded are skipped, like ImageSet.load does.
+        """
+        for img in self._iterSlots():
+            if img is not None:
+                yield img
+
+    def _iterSlots(self):
+        """
+        Yield the decoded images in order, reading ahead on a background thread,
+        and None for each file that can not be decoded.
+        """
+        items = list(list.__iter__(self))
+        if self.prefetch <= 0:
+            for item in items:
+                yield self._decode(item)
+            return
+
+        decoded = Queue.Queue(self.prefetch)
+        stop = threading.Event()
+        done = object()
+
+        def readAhead():
+            for item in items + [done]:
+                if item is not done:
+                    item = self._decode(item)
+                while not stop.is_set():
+                    try:
+                        decoded.put(item, timeout=0.1)
+                        break
+                    except Queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+
+        reader = threading.Thread(target=readAhead)
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                img = decoded.get()
+                if img is done:
+                    break
+                yield img
+        finally:
+            stop.set()
+
+    def clearCache(self):
+        """
+        **SUMMARY**
+
+        Drop every decoded image the set is holding on to.
+
+        """
+        with self._mCacheLock:
+            self._mCache.clear()
+
+
+class _LazyImage(object):
+    """
+    Stands in for an image of a LazyImageSet and decodes it the first time it
+    is used, forwarding everything to the decoded Image.
+    """
+
+    def __init__(self, images, item):
+        self._mImages = images
+        self._mItem = item
+        self._mImage = None
+
+    def _getImage(self):
+        if self._mImage is None:
+            self._mImage = self._mImages._decode(self._mItem)
+        return self._mImage
+
+    def __getattr__(self, name):
+        if name.startswith("_m"): #not set up yet, e.g. while being copied
+            raise AttributeError(name)
+        return getattr(self._getImage(), name)
+
+    def __getitem__(self, key):
+        return self._getImage()[key]
+
+    def __setitem__(self, key, value):
+        self._getImage()[key] = value
+
+#state read by ImageSet.map worker processes. Each worker sets it from the
+#arguments of its pool's initializer, which it inherits when the pool forks,
+#so the images and the function reach the workers without being pickled.
+_imageSetMapState = None
+
+def _initImageSetMapWorker(state):
+    global _imageSetMapState
+    _imageSetMapState = state
+
+def _sharedMemoryDir():
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+def _applyToImage(img, func, args, kwargs):
+    if img is None: #could not be decoded, keep its slot in the results
+        return None
+    if isinstance(func, basestring):
+        return getattr(img, func)(*args, **kwargs)
+    return func(img, *args, **kwargs)
+
+def _imageSetMapWorker(index):
+    images, func, args, kwargs, shmdir = _imageSetMapState
+    img = images[index]
+    result = _applyToImage(img, func, args, kwargs)
+    if isinstance(result, Image):
+        return _SharedImageBuffer(result, shmdir)
+    if isinstance(result, FeatureSet):
+        return _DetachedFeatureSet(result, img)
+    return result
+
+class _SharedImageBuffer(object):
+    """
+    Hands an image from an ImageSet.map worker back to the parent process
+    through a memory mapped file rather than a pickled string.
+    """
+
+    def __init__(self, img, directory=None):
+        frame = img.getNumpyCv2()
+        if directory is None:
+            directory = _sharedMemoryDir()
+        fd, self.path = tempfile.mkstemp(suffix=".scv", dir=directory)
+        os.close(fd)
+        try:
+            mm = np.memmap(self.path, dtype=np.uint8, mode="w+", shape=frame.shape)
+            mm[...] = frame
+            mm.flush()
+            del mm
+        except:
+            self.release()
+            raise
+        self.shape = frame.shape
+        self.colorSpace = img._colorSpace
+        self.filename = img.filename
+
+    def toImage(self):
+        #the mapping outlives the file, so unlink it straight away
+        mm = np.memmap(self.path, dtype=np.uint8, mode="r+", shape=self.shape)
+        self.release()
+        retVal = Image.fromArray(np.asarray(mm), colorSpace=self.colorSpace)
+        retVal.filename = self.filename
+        return retVal
+
+    def release(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class _DetachedFeatureSet(object):
+    """
+    Ships a FeatureSet from an ImageSet.map worker without the image its
+    features point at; attach() points them at the parent's copy instead.
+    """
+
+    def __init__(self, features, img):
+        self.detached = [i for i in range(len(features)) if getattr(features[i], "image", None) is img]
+        for i in self.detached:
+            features[i].image = None
+        self.features = features
+
+    def attach(self, img):
+        for i in self.detached:
+            self.features[i].image = img
+        return self.features
+
+#lookup tables compiled by Image.applyPixelFunction, held for as long as the
+#function they were built from is alive.
+_pixelFunctionLUTs = weakref.WeakKeyDictionary()
+
 class Image:
     """
     **SUMMARY**
@@ -820,14 +1216,17 @@ class Image:
 
 
     #these are buffer frames for various operations on the image
+    #_cv2Numpy is the canonical pixel buffer (rows x cols x BGR, C-contiguous)
+    #whenever the image owns its pixels; _bitmap, _matrix and _numpy are
+    #headers / views over that same memory rather than copies of it.
     _bitmap = ""  #the bitmap (iplimage)  representation of the image
     _matrix = ""  #the matrix (cvmat) representation
     _grayMatrix = "" #the gray scale (cvmat) representation -KAS
     _graybitmap = ""  #a reusable 8-bit grayscale bitmap
     _equalizedgraybitmap = "" #the above bitmap, normalized
     _blobLabel = ""  #the label image for blobbing
-    _edgeMap = "" #holding reference for edge map
-    _cannyparam = (0, 0) #parameters that created _edgeMap
+    _mDerivedCache = None #BufferCache of derived buffers keyed by (operation, parameters)
+    _mDerivedCacheBudget = DERIVED_CACHE_BUDGET
     _pil = "" #holds a PIL object in buffer
     _numpy = "" #numpy form buffer
     _grayNumpy = "" # grayscale numpy for keypoint stuff
@@ -844,27 +1243,40 @@ class Image:
     _mKeyPoints = None
     _mKPDescriptors = None
     _mKPFlavor = "NONE"
+    _mKPKey = None #(flavor, thresh, highQuality) the cached keypoints were computed with
 
     #temp files
     _tempFiles = []
 
+    #pixel generation, bumped every time the pixels are modified in place.
+    #derived buffers record the generation they were computed from in
+    #_mBufferGenerations and are only reused while it is still current.
+    _mGeneration = 0
+    _mBufferGenerations = {}
+
     #when we empty the buffers, populate with this:
     _initialized_buffers = {
         "_bitmap": "",
         "_matrix": "",
-        "_grayMatrix": "",
-        "_graybitmap": "",
-        "_equalizedgraybitmap": "",
-        "_blobLabel": "",
-        "_edgeMap": "",
-        "_cannyparam": (0, 0),
-        "_pil": "",
         "_numpy": "",
-        "_grayNumpy":"",
-        "_pgsurface": "",
-        "_cv2GrayNumpy": "",
         "_cv2Numpy":""}
 
+    #buffers derived from the pixels. invalidate() releases them so a long lived
+    #image doesn't hold on to dead copies; the generation check alone decides
+    #whether one may be reused. The palette settings are not buffers and stay.
+    _derived_buffers = {
+        "_grayMatrix": None,
+        "_graybitmap": None,
+        "_equalizedgraybitmap": None,
+        "_grayNumpy": None,
+        "_cv2GrayNumpy": None,
+        "_pil": None,
+        "_pgsurface": None,
+        "_mDerivedCache": None,
+        "_mKeyPoints": None,
+        "_mKPDescriptors": None,
+        "_mKPKey": None}
+
     #The variables _uncroppedX and _uncroppedY are used to buffer the points when we crop the image.
     _uncroppedX = 0
     _uncroppedY = 0
@@ -917,10 +1329,14 @@ class Image:
         self._mLayers = []
         self.camera = camera
         self._colorSpace = colorSpace
+        self._mGeneration = 0
+        self._mBufferGenerations = {}
+        self._DFT = []
         #Keypoint Descriptors
         self._mKeyPoints = []
         self._mKPDescriptors = []
         self._mKPFlavor = "NONE"
+        self._mKPKey = None
         #Pallete Stuff
         self._mDoHuePalette = False
         self._mPaletteBins = None
@@ -980,10 +1396,11 @@ class Image:
         if (type(source) == tuple):
             w = int(source[0])
             h = int(source[1])
-            source = cv.CreateImage((w,h), cv.IPL_DEPTH_8U, 3)
-            cv.Zero(source)
-        if (type(source) == cv.cvmat):
-            self._matrix = cv.CreateMat(source.rows, source.cols, cv.CV_8UC3)
+            self._cv2Numpy = np.zeros((h, w, 3), dtype=np.uint8)
+            self._colorSpace = ColorSpace.BGR
+        elif (type(source) == cv.cvmat):
+            self._cv2Numpy = np.empty((source.rows, source.cols, 3), dtype=np.uint8)
+            self._matrix = cv.fromarray(self._cv2Numpy)
             if((source.step/source.cols)==3): #this is just a guess
                 cv.Copy(source, self._matrix, None)
                 self._colorSpace = ColorSpace.BGR
@@ -996,44 +1413,23 @@ class Image:
 
 
         elif (type(source) == np.ndarray):  #handle a numpy array conversion
-            if (type(source[0, 0]) == np.ndarray): #we have a 3 channel array
-                #convert to an iplimage bitmap
-                source = source.astype(np.uint8)
-                self._numpy = source
-                if not cv2image:
-                    invertedsource = source[:, :, ::-1].transpose([1, 0, 2])
-                else:
-                    # If the numpy array is from cv2, then it must not be transposed.
-                    invertedsource = source
-
-                #invertedsource = source[:, :, ::-1].transpose([1, 0, 2]) # do not un-comment. breaks cv2 image support
-                self._bitmap = cv.CreateImageHeader((invertedsource.shape[1], invertedsource.shape[0]), cv.IPL_DEPTH_8U, 3)
-                cv.SetData(self._bitmap, invertedsource.tostring(),
-                    invertedsource.dtype.itemsize * 3 * invertedsource.shape[1])
-                self._colorSpace = ColorSpace.BGR #this is an educated guess
-            else:
-                #we have a single channel array, convert to an RGB iplimage
-
-                source = source.astype(np.uint8)
-                if not cv2image:
-                    source = source.transpose([1,0]) #we expect width/height but use col/row
-                self._bitmap = cv.CreateImage((source.shape[1], source.shape[0]), cv.IPL_DEPTH_8U, 3)
-                channel = cv.CreateImageHeader((source.shape[1], source.shape[0]), cv.IPL_DEPTH_8U, 1)
-                #initialize an empty channel bitmap
-                cv.SetData(channel, source.tostring(),
-                    source.dtype.itemsize * source.shape[1])
-                cv.Merge(channel, channel, channel, None, self._bitmap)
-                self._colorSpace = ColorSpace.BGR
+            #the constructor always takes its own copy of the array, use
+            #Image.fromArray to wrap an existing buffer in place.
+            self._setArray(source, cv2image=cv2image, copy=True)
+            self._colorSpace = ColorSpace.BGR #this is an educated guess
 
 
         elif (type(source) == cv.iplimage):
-            if (source.nChannels == 1):
+            if (source.depth == cv.IPL_DEPTH_8U):
+                self._cv2Numpy = np.empty((source.height, source.width, 3), dtype=np.uint8)
+                self._bitmap = cv.GetImage(cv.fromarray(self._cv2Numpy))
+            else:
                 self._bitmap = cv.CreateImage(cv.GetSize(source), source.depth, 3)
+            if (source.nChannels == 1):
                 cv.Merge(source, source, source, None, self._bitmap)
                 self._colorSpace = ColorSpace.GRAY
             else:
-                self._bitmap = cv.CreateImage(cv.GetSize(source), source.depth, 3)
-                cv.Copy(source, self._bitmap, None) 
+                cv.Copy(source, self._bitmap, None)
                 self._colorSpace = ColorSpace.BGR
         elif (type(source) == type(str()) or source.__class__.__name__ == 'StringIO'):
             if source == '':
@@ -1067,9 +1463,9 @@ class Image:
 
             else:
                 self.filename = source
-                try:
-                    self._bitmap = cv.LoadImage(self.filename, iscolor=cv.CV_LOAD_IMAGE_COLOR)
-                except:
+                #cv2.imread decodes straight into a contiguous numpy buffer
+                self._cv2Numpy = cv2.imread(self.filename, cv2.CV_LOAD_IMAGE_COLOR)
+                if self._cv2Numpy is None:
                     self._pil = pil.open(self.filename).convert("RGB")
                     self._bitmap = cv.CreateImageHeader(self._pil.size, cv.IPL_DEPTH_8U, 3)
                     cv.SetData(self._bitmap, self._pil.tostring())
@@ -1118,6 +1514,12 @@ class Image:
         self.height = bm.height
         self.depth = bm.depth
 
+        #PIL / pygame sources are kept around as buffers of the loaded pixels
+        if (self._pil):
+            self._stampBuffer("_pil")
+        if (self._pgsurface):
+            self._stampBuffer("_pgsurface")
+
 
     def __del__(self):
         """
@@ -1130,6 +1532,80 @@ class Image:
         except :
             pass
 
+    @classmethod
+    def fromArray(cls, array, layout="cv2", colorSpace=ColorSpace.BGR, copy=False):
+        """
+        **SUMMARY**
+
+        Build an Image directly on top of a numpy array. A C-contiguous uint8
+        array (or a view that reduces to one, such as the result of
+        :py:meth:`getNumpy`) is wrapped in place and becomes the image's pixel
+        buffer, so no pixels are copied. Any other array is copied exactly once.
+
+        **PARAMETERS**
+
+        * *array* - A rows x cols x 3 (or rows x cols) array for the "cv2" layout, or a
+          cols x rows x 3 (or cols x rows) array for the "simplecv" layout.
+        * *layout* - "cv2" for OpenCV >= 2.3 style BGR arrays (what :py:meth:`getNumpyCv2` returns),
+          "simplecv" for width x height RGB arrays (what :py:meth:`getNumpy` returns).
+        * *colorSpace* - The color space of the pixels, BGR by default.
+        * *copy* - If True always copy the array instead of sharing it.
+
+        **RETURNS**
+
+        A SimpleCV Image. Unless a copy was made, writing to the array modifies the image and vice versa.
+
+        **EXAMPLE**
+
+        >>> frame = cv2.imread("lenna.png")
+        >>> img = Image.fromArray(frame)
+        >>> img = Image.fromArray(img.getNumpy(), layout="simplecv")
+
+        **NOTES**
+
+        Single channel arrays are always expanded (and so copied) to three channels.
+
+        **SEE ALSO**
+
+        :py:meth:`getNumpyCv2`
+        :py:meth:`getNumpy`
+
+        """
+        if layout not in ("cv2", "simplecv"):
+            raise ValueError("Image.fromArray: layout must be 'cv2' or 'simplecv'")
+        retVal = cls()
+        retVal._setArray(array, cv2image=(layout == "cv2"), copy=copy)
+        retVal._colorSpace = colorSpace
+        return retVal
+
+    def _setArray(self, array, cv2image=False, copy=True):
+        """
+        Make a numpy array the pixel buffer of this image, converting it to
+        the canonical rows x cols x BGR layout with at most one copy.
+        """
+        if array.ndim == 2:
+            #we have a single channel array, broadcast it to three channels
+            if not cv2image:
+                array = array.transpose() #we expect width/height but use col/row
+            buf = np.empty(array.shape + (3,), dtype=np.uint8)
+            buf[...] = array[:, :, np.newaxis]
+        else:
+            if not cv2image:
+                #undo the transpose / channel swap of getNumpy, for a getNumpy
+                #view this lands back on the original contiguous buffer
+                array = array.transpose([1, 0, 2])[:, :, ::-1]
+            if copy:
+                buf = np.array(array, dtype=np.uint8, order='C')
+            else:
+                buf = np.ascontiguousarray(array, dtype=np.uint8)
+
+        self._clearBuffers(None)
+        self._cv2Numpy = buf
+        self._bitmap = cv.GetImage(cv.fromarray(buf))
+        self.width = self._bitmap.width
+        self.height = self._bitmap.height
+        self.depth = self._bitmap.depth
+
     def getEXIFData(self):
         """
         **SUMMARY**
@@ -1773,6 +2249,9 @@ class Image:
         Retrieve the bitmap (iplImage) of the Image.  This is useful if you want
         to use functions from OpenCV with SimpleCV's image class
 
+        The bitmap is a header over the image's pixel buffer, so OpenCV
+        functions that write into it modify the image in place.
+
         **RETURNS**
 
         Returns black OpenCV IplImage from this image.
@@ -1798,6 +2277,8 @@ class Image:
             return self._bitmap
         elif (self._matrix):
             self._bitmap = cv.GetImage(self._matrix)
+        elif (type(self._cv2Numpy) is np.ndarray):
+            self._bitmap = cv.GetImage(cv.fromarray(self._cv2Numpy))
         return self._bitmap
 
 
@@ -1901,10 +2382,12 @@ class Image:
         """
         if (not PIL_ENABLED):
             return None
-        if (not self._pil):
-            rgbbitmap = self.getEmpty()
-            cv.CvtColor(self.getBitmap(), rgbbitmap, cv.CV_BGR2RGB)
-            self._pil = pil.fromstring("RGB", self.size(), rgbbitmap.tostring())
+        if (not self._pil or not self._bufferIsCurrent("_pil")):
+            #PIL cannot share a BGR buffer, so let its raw decoder swap the
+            #channels while it makes its one copy of the pixels.
+            bgr = np.ascontiguousarray(self.getNumpyCv2())
+            self._pil = pil.frombuffer("RGB", self.size(), bgr.data, "raw", "BGR", 0, 1)
+            self._stampBuffer("_pil")
         return self._pil
 
 
@@ -1917,6 +2400,7 @@ class Image:
         **RETURNS**
 
         Returns the image, converted first to grayscale and then converted to a 2D numpy array.
+        The array is a transposed view of :py:meth:`getGrayNumpyCv2`.
 
         **EXAMPLE**
 
@@ -1934,11 +2418,9 @@ class Image:
         :py:meth:`getGrayscaleMatrix`
 
         """
-        if( self._grayNumpy != "" ):
-            return self._grayNumpy
-        else:
-            self._grayNumpy = uint8(np.array(cv.GetMat(self._getGrayscaleBitmap())).transpose())
-
+        if type(self._grayNumpy) is not np.ndarray or not self._bufferIsCurrent("_grayNumpy"):
+            self._grayNumpy = self.getGrayNumpyCv2().transpose()
+            self._stampBuffer("_grayNumpy")
         return self._grayNumpy
 
     def getNumpy(self):
@@ -1949,15 +2431,24 @@ class Image:
 
         **RETURNS**
 
-        Returns the image, converted first to grayscale and then converted to a 3D numpy array.
+        Returns the image as a 3D numpy array. The array is a writable view over
+        the image's pixel buffer (transposed and channel reversed), so no pixels
+        are copied and writing into it changes the image itself. Earlier versions
+        returned an independent copy: copy() the array before modifying it if the
+        image must not change, or call :py:meth:`invalidate` after modifying it so
+        the image's cached derived buffers are recomputed.
 
         **EXAMPLE**
 
         >>> img = Image("lenna")
         >>> rawImg  = img.getNumpy()
+        >>> scratch = img.getNumpy().copy()
+        >>> img.getNumpy()[0:10, 0:10] = (255, 0, 0)
+        >>> img.invalidate()
 
         **SEE ALSO**
 
+        :py:meth:`invalidate`
         :py:meth:`getEmpty`
         :py:meth:`getBitmap`
         :py:meth:`getMatrix`
@@ -1966,12 +2457,8 @@ class Image:
         :py:meth:`getGrayscaleMatrix`
 
         """
-
-        if self._numpy != "":
-            return self._numpy
-
-
-        self._numpy = np.array(self.getMatrix())[:, :, ::-1].transpose([1, 0, 2])
+        if type(self._numpy) is not np.ndarray:
+            self._numpy = self.getNumpyCv2()[:, :, ::-1].transpose([1, 0, 2])
         return self._numpy
 
     def getNumpyCv2(self):
@@ -1982,7 +2469,8 @@ class Image:
 
         **RETURNS**
 
-        Returns the  3D numpy array of the image compatible with OpenCV >= 2.3
+        Returns the  3D numpy array of the image compatible with OpenCV >= 2.3.
+        This is the image's pixel buffer itself, not a copy of it.
 
         **EXAMPLE**
 
@@ -2003,7 +2491,7 @@ class Image:
         """
 
         if type(self._cv2Numpy) is not np.ndarray:
-            self._cv2Numpy = np.array(self.getMatrix())
+            self._cv2Numpy = np.asarray(self.getMatrix())
         return self._cv2Numpy
 
     def getGrayNumpyCv2(self):
@@ -2033,15 +2521,17 @@ class Image:
         :py:meth:`getGrayNumpyCv2`
 
         """
-        if type(self._cv2GrayNumpy) is not np.ndarray:
-            self._cv2GrayNumpy = np.array(self.getGrayscaleMatrix())
+        if type(self._cv2GrayNumpy) is not np.ndarray or not self._bufferIsCurrent("_cv2GrayNumpy"):
+            self._cv2GrayNumpy = np.asarray(self.getGrayscaleMatrix())
+            self._stampBuffer("_cv2GrayNumpy")
         return self._cv2GrayNumpy
 
     def _getGrayscaleBitmap(self):
-        if (self._graybitmap):
+        if (self._graybitmap and self._bufferIsCurrent("_graybitmap")):
             return self._graybitmap
 
 
+        self._stampBuffer("_graybitmap")
         self._graybitmap = self.getEmpty(1)
         temp = self.getEmpty(3)
         if( self._colorSpace == ColorSpace.BGR or
@@ -2094,20 +2584,22 @@ class Image:
         :py:meth:`getMatrix`
 
         """
-        if (self._grayMatrix):
+        if (self._grayMatrix and self._bufferIsCurrent("_grayMatrix")):
             return self._grayMatrix
         else:
             self._grayMatrix = cv.GetMat(self._getGrayscaleBitmap()) #convert the bitmap to a matrix
+            self._stampBuffer("_grayMatrix")
             return self._grayMatrix
 
 
     def _getEqualizedGrayscaleBitmap(self):
-        if (self._equalizedgraybitmap):
+        if (self._equalizedgraybitmap and self._bufferIsCurrent("_equalizedgraybitmap")):
             return self._equalizedgraybitmap
 
 
         self._equalizedgraybitmap = self.getEmpty(1)
         cv.EqualizeHist(self._getGrayscaleBitmap(), self._equalizedgraybitmap)
+        self._stampBuffer("_equalizedgraybitmap")
 
 
         return self._equalizedgraybitmap
@@ -2144,11 +2636,15 @@ class Image:
 
 
         """
-        if (self._pgsurface):
+        if (self._pgsurface and self._bufferIsCurrent("_pgsurface")):
             return self._pgsurface
         else:
+            self._stampBuffer("_pgsurface")
             if self.isGray():
                 self._pgsurface = pg.image.fromstring(self.getBitmap().tostring(), self.size(), "RGB")
+            elif self.isBGR():
+                rgb = np.ascontiguousarray(self.getNumpyCv2()[:, :, ::-1])
+                self._pgsurface = pg.image.frombuffer(rgb.data, self.size(), "RGB")
             else:
                 self._pgsurface = pg.image.fromstring(self.toRGB().getBitmap().tostring(), self.size(), "RGB")
             return self._pgsurface
@@ -2279,9 +2775,7 @@ class Image:
 
 
             if (type(fh) == InstanceType and fh.__class__.__name__ == "JpegStreamer"):
-                fh.jpgdata = StringIO()
-                saveimg.getPIL().save(fh.jpgdata, "jpeg", **params) #save via PIL to a StringIO handle
-                fh.refreshtime = time.time()
+                fh.writeFrame(saveimg, **params) #encoded once for every client
                 self.filename = ""
                 self.filehandle = fh
 
@@ -2627,7 +3121,7 @@ class Image:
 
         scaledArray = np.zeros((w,h,3),dtype='uint8')
         retVal = cv2.resize(self.getNumpyCv2(), (w,h), interpolation = interpolation)
-        return Image(retVal, colorSpace=self._colorSpace,cv2image = True)
+        return Image.fromArray(retVal, colorSpace=self._colorSpace)
 
 
     def resize(self, w=None,h=None):
@@ -3017,9 +3511,9 @@ class Image:
             image_gauss = cv2.GaussianBlur(self.getNumpyCv2(), window, sigmaX, sigmaY=sigmaY)
 
             if grayscale:
-                return Image(image_gauss, colorSpace=ColorSpace.GRAY, cv2image=True)
+                return Image.fromArray(image_gauss, colorSpace=ColorSpace.GRAY)
             else:
-                return Image(image_gauss, colorSpace=self._colorSpace, cv2image=True)
+                return Image.fromArray(image_gauss, colorSpace=self._colorSpace)
 
     def invert(self):
         """
@@ -3616,6 +4110,9 @@ class Image:
         Note that the cascade parameter can be either a filename, or a HaarCascade
         loaded with cv.Load(), or a SimpleCV HaarCascade object.
 
+        The parsed cascade is cached per file (and per thread), so calling this on
+        every frame does not reload the XML.
+
         **PARAMETERS**
 
         * *cascade* - The Haar Cascade file, this can be either the path to a cascade
@@ -3680,13 +4177,12 @@ class Image:
             logger.warning('Could not initialize HaarCascade. Enter Valid cascade value.')
 
         # added all of the arguments from the opencv docs arglist
-        try:
-            import cv2
-            haarClassify = cv2.CascadeClassifier(cascade.getFHandle())
+        haarClassify = cascade.getClassifier()
+        if haarClassify is not None:
             objects = haarClassify.detectMultiScale(self.getGrayNumpyCv2(),scaleFactor=scale_factor,minNeighbors=min_neighbors,minSize=min_size,flags=use_canny)
             cv2flag = True
 
-        except ImportError:
+        else:
             objects = cv.HaarDetectObjects(self._getEqualizedGrayscaleBitmap(),
                 cascade.getCascade(), storage, scale_factor, min_neighbors,
                 use_canny, min_size)
@@ -3697,6 +4193,138 @@ class Image:
 
         return None
 
+    def findHaarFeaturesHierarchy(self, cascades, parents=None, scale_factor=1.2, min_neighbors=2, use_canny=cv.CV_HAAR_DO_CANNY_PRUNING, min_size=(20,20), child_min_size=(5,5)):
+        """
+        **SUMMARY**
+
+        Run several Haar cascades over the image in one pass, where some cascades are
+        only searched for inside the detections of another, e.g. eyes and mouths only
+        inside faces. All of the cascades share one grayscale image, and a child cascade
+        only looks at the regions of its parent's detections rather than the whole frame,
+        which is several times cheaper than calling findHaarFeatures for each cascade.
+
+        **PARAMETERS**
+
+        * *cascades* - A list of cascades, each either the path to a cascade file or a
+          HaarCascade object.
+
+        * *parents* - A dict mapping a cascade name to the name of the cascade it should be
+          searched inside of, e.g. {"eye.xml":"face.xml"}. The name is the HaarCascade
+          name, which defaults to the file name it was given. Cascades without a parent
+          search the whole image.
+
+        * *scale_factor* - see findHaarFeatures.
+
+        * *min_neighbors* - see findHaarFeatures.
+
+        * *use_canny* - see findHaarFeatures.
+
+        * *min_size* - Minimum window size for the cascades that search the whole image.
+
+        * *child_min_size* - Minimum window size for the cascades searched inside a parent.
+
+        **RETURNS**
+
+        A single FeatureSet of HaarFeatures from all of the cascades, parents before their
+        children. Each feature's featureName is its cascade's name, its parent is the
+        feature it was found inside of, and its children lists the features found inside
+        it. Returns None if no cascade could be loaded.
+
+        **EXAMPLE**
+
+        >>> img = Image("lenna")
+        >>> feats = img.findHaarFeaturesHierarchy(["face.xml", "eye.xml", "mouth.xml"],
+        >>>                                       parents={"eye.xml":"face.xml", "mouth.xml":"face.xml"})
+        >>> for f in feats:
+        >>>     if f.featureName == "face.xml":
+        >>>         print len(f.children)
+
+        **SEE ALSO**
+
+        :py:meth:`findHaarFeatures`
+
+        """
+        from SimpleCV.Features.HaarCascade import HaarCascade
+        if parents is None:
+            parents = {}
+
+        loaded = []
+        for cascade in cascades:
+            if isinstance(cascade, basestring):
+                cascade = HaarCascade(cascade)
+                if not cascade.getCascade():
+                    continue
+            elif not isinstance(cascade, HaarCascade):
+                logger.warning('Could not initialize HaarCascade. Enter Valid cascade value.')
+                continue
+            loaded.append(cascade)
+        if not loaded:
+            return None
+
+        gray = None
+        equalized = None
+        storage = None
+
+        def detect(cascade, x, y, w, h, size):
+            #detections in the x, y, w, h region, in image coordinates
+            classifier = cascade.getClassifier()
+            if classifier is not None:
+                roi = gray[y:y+h, x:x+w]
+                objects = classifier.detectMultiScale(roi, scaleFactor=scale_factor, minNeighbors=min_neighbors, minSize=size, flags=use_canny)
+                return [(ox + x, oy + y, ow, oh) for (ox, oy, ow, oh) in objects], True
+            roi = cv.GetSubRect(equalized, (x, y, w, h))
+            objects = cv.HaarDetectObjects(roi, cascade.getCascade(), storage, scale_factor, min_neighbors, use_canny, size)
+            return [((ox + x, oy + y, ow, oh), n) for ((ox, oy, ow, oh), n) in objects], False
+
+        found = {} #cascade name -> list of features
+        retVal = []
+        pending = list(loaded)
+        while pending:
+            progress = False
+            for cascade in list(pending):
+                name = cascade.getName()
+                parent = parents.get(name)
+                if parent is not None and parent not in found:
+                    if parent not in [c.getName() for c in loaded]:
+                        logger.warning("findHaarFeaturesHierarchy: unknown parent cascade " + str(parent))
+                        parent = None
+                    else:
+                        continue
+                pending.remove(cascade)
+                progress = True
+
+                if cascade.getClassifier() is not None:
+                    if gray is None:
+                        gray = self.getGrayNumpyCv2()
+                elif equalized is None:
+                    equalized = self._getEqualizedGrayscaleBitmap()
+                    storage = cv.CreateMemStorage(0)
+
+                features = []
+                if parent is None:
+                    regions = [(None, 0, 0, self.width, self.height)]
+                    size = min_size
+                else:
+                    regions = [(p, int(p.points[0][0]), int(p.points[0][1]), int(p.width()), int(p.height())) for p in found[parent]]
+                    size = child_min_size
+                for (p, x, y, w, h) in regions:
+                    if w <= 0 or h <= 0:
+                        continue
+                    objects, cv2flag = detect(cascade, x, y, w, h, size)
+                    for o in objects:
+                        f = HaarFeature(self, o, cascade, cv2flag)
+                        if p is not None:
+                            f.parent = p
+                            p.children.append(f)
+                        features.append(f)
+                found[name] = features
+                retVal.extend(features)
+            if not progress:
+                logger.warning("findHaarFeaturesHierarchy: the parents of " + str([c.getName() for c in pending]) + " form a cycle")
+                break
+
+        return FeatureSet(retVal)
+
 
     def drawCircle(self, ctr, rad, color = (0, 0, 0), thickness = 1):
         """
@@ -4656,12 +5284,13 @@ class Image:
     def __setitem__(self, coord, value):
         value = tuple(reversed(value))  #RGB -> BGR
 
+        #the matrix is a header over the pixel buffer, so the other views
+        #stay valid and only the derived buffers have to go
         if(isinstance(coord[0],slice)):
             cv.Set(self.getMatrix()[tuple(reversed(coord))], value)
-            self._clearBuffers("_matrix")
         else:
             self.getMatrix()[tuple(reversed(coord))] = value
-            self._clearBuffers("_matrix")
+        self.invalidate()
 
 
 
@@ -4791,6 +5420,88 @@ class Image:
             if k == clearexcept:
                 continue
             self.__dict__[k] = v
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        **SUMMARY**
+
+        Tell the image that its pixels were modified in place. The bitmap, matrix and
+        numpy arrays returned by :py:meth:`getBitmap`, :py:meth:`getMatrix`,
+        :py:meth:`getNumpy` and :py:meth:`getNumpyCv2` all share the image's pixel buffer,
+        so writing into any of them changes the image; call this method afterwards so
+        that cached derived buffers (grayscale, edges, DFTs, keypoints, palettes, ...)
+        are recomputed rather than reused. The stale buffers are released straight
+        away, the palette settings are kept.
+
+        **RETURNS**
+
+        Nothing. In place method.
+
+        **EXAMPLE**
+
+        >>> img = Image("lenna")
+        >>> cv.Circle(img.getBitmap(), (100, 100), 20, (255, 0, 0), -1)
+        >>> img.invalidate()
+        >>> edges = img.edges()
+
+        """
+        self._mGeneration = self._mGeneration + 1
+        for k, v in self._derived_buffers.items():
+            self.__dict__[k] = v
+        self._DFT = []
+
+    def setDerivedCacheBudget(self, nbytes):
+        """
+        **SUMMARY**
+
+        Set how many bytes this image may spend caching derived buffers such as
+        edge maps, integral images and DFTs for different parameter sets. The least
+        recently used buffers are dropped once the budget is exceeded.
+
+        **PARAMETERS**
+
+        * *nbytes* - The byte budget, 0 disables the cache.
+
+        **RETURNS**
+
+        Nothing. In place method.
+
+        **EXAMPLE**
+
+        >>> img = Image("lenna")
+        >>> img.setDerivedCacheBudget(256*1024*1024)
+        >>> lines = img.findLines(cannyth1=50, cannyth2=100)
+        >>> lines2 = img.findLines(cannyth1=20, cannyth2=80)
+
+        """
+        self._mDerivedCacheBudget = nbytes
+        if self._mDerivedCache is not None:
+            self._mDerivedCache.setBudget(nbytes)
+
+    def _getDerivedCache(self):
+        """
+        Return the BufferCache of derived buffers for the current pixels.
+        """
+        if self._mDerivedCache is None or not self._bufferIsCurrent("_mDerivedCache"):
+            self._mDerivedCache = BufferCache(self._mDerivedCacheBudget)
+            self._stampBuffer("_mDerivedCache")
+        return self._mDerivedCache
+
+    def _bufferIsCurrent(self, name):
+        """
+        Return True if the derived buffer name was computed from the current pixels.
+        """
+        return self._mBufferGenerations.get(name, -1) == self._mGeneration
+
+    def _stampBuffer(self, *names):
+        """
+        Record that the derived buffers in names were computed from the current pixels.
+        """
+        if "_mBufferGenerations" not in self.__dict__:
+            self._mBufferGenerations = {}
+        for name in names:
+            self._mBufferGenerations[name] = self._mGeneration
 
 
     def findBarcode(self,doZLib=True,zxing_path=""):
@@ -5153,16 +5864,14 @@ class Image:
         """
 
 
-        if (self._edgeMap and self._cannyparam[0] == t1 and self._cannyparam[1] == t2):
-            return self._edgeMap
-
-
-        self._edgeMap = self.getEmpty(1)
-        cv.Canny(self._getGrayscaleBitmap(), self._edgeMap, t1, t2)
-        self._cannyparam = (t1, t2)
+        cache = self._getDerivedCache()
+        edgeMap = cache.get(("canny", t1, t2))
+        if edgeMap is None:
+            edgeMap = self.getEmpty(1)
+            cv.Canny(self._getGrayscaleBitmap(), edgeMap, t1, t2)
+            cache.put(("canny", t1, t2), edgeMap)
 
-
-        return self._edgeMap
+        return edgeMap
 
 
     def rotate(self, angle, fixed=True, point=[-1, -1], scale = 1.0):
@@ -6015,8 +6724,8 @@ class Image:
           Do not use this method unless you have a particularly compelling reason.
 
         """
-        cv.SetZero(self._bitmap)
-        self._clearBuffers()
+        cv.SetZero(self.getBitmap())
+        self.invalidate()
 
     def draw(self, features, color=Color.GREEN, width=1, autocolor=False):
         """
@@ -6770,7 +7479,7 @@ class Image:
                 img = img.crop(x,y,targetw,targeth)
         
         retVal[targety:targety + targeth,targetx:targetx + targetw,:] = img.getNumpyCv2()
-        retVal = Image(retVal,cv2image = True)
+        retVal = Image.fromArray(retVal)
         return(retVal)
 
 
@@ -7394,16 +8103,37 @@ class Image:
         return Image(retVal)
 
 
-    def applyPixelFunction(self, theFunc):
+    def applyPixelFunction(self, theFunc, vectorized=False, lut=None):
         """
         **SUMMARY**
 
         apply a function to every pixel and return the result
         The function must be of the form int (r,g,b)=func((r,g,b))
+        Whichever way the function is applied, results are clipped to 0-255.
+
+        By default the function is called once per pixel, which is slow. If the
+        function is written with numpy operations use vectorized=True and it is
+        called once with whole channel arrays instead. If the function is a pure
+        mapping from color to color it can also be compiled into a look up table
+        once and then applied to every frame with applyLUT.
 
         **PARAMETERS**
 
         * *theFunc* - a function pointer to a function of the form (r,g.b) = theFunc((r,g,b))
+        * *vectorized* - if True theFunc is called with a tuple of three int32 numpy
+          arrays, one per channel, and must return three arrays (or scalars) of the
+          same shape.
+        * *lut* - precompute theFunc into a look up table and apply that instead.
+          This can be:
+
+          * "channel" - a 256 entry table per channel. Only valid when each output
+            channel depends on the same input channel alone, e.g. r' = f(r).
+          * "color" - a 256x256x256 table covering every color (48MB). Valid for
+            any per pixel function.
+
+          The table is built once per function object and reused for as long as
+          the function is alive, so keep a reference to the function rather than
+          passing a new lambda each frame. See compilePixelFunction.
 
         **RETURNS**
 
@@ -7417,14 +8147,111 @@ class Image:
         >>> img = Image("lenna")
         >>> img2 = img.applyPixelFunction(derp)
 
+        A vectorized function that swaps red and blue:
+
+        >>> def swap((r,g,b)):
+        >>>     return (b,g,r)
+        >>>
+        >>> img2 = img.applyPixelFunction(swap, vectorized=True, lut="color")
+
+        **SEE ALSO**
+
+        :py:meth:`compilePixelFunction`
+        :py:meth:`applyLUT`
+
         """
-        #there should be a way to do this faster using numpy vectorize
-        #but I can get vectorize to work with the three channels together... have to split them
-        #TODO: benchmark this against vectorize
+        if( lut is not None ):
+            tables = _pixelFunctionLUTs.get(theFunc)
+            if( tables is None ):
+                tables = {}
+                try:
+                    _pixelFunctionLUTs[theFunc] = tables
+                except TypeError: #not weak referenceable, so don't cache
+                    pass
+            key = (lut, bool(vectorized))
+            table = tables.get(key)
+            if( table is None ):
+                table = Image.compilePixelFunction(theFunc, vectorized, lut)
+                tables[key] = table
+            if( lut == "channel" ):
+                rLUT, gLUT, bLUT = [np.ascontiguousarray(table[:, i:i+1]) for i in range(3)]
+                return self.applyLUT(rLUT=rLUT, gLUT=gLUT, bLUT=bLUT)
+            return self.applyLUT(colorLUT=table)
+
+        if( vectorized ):
+            bgr = self.getNumpyCv2()
+            result = theFunc((bgr[:, :, 2].astype(np.int32), bgr[:, :, 1].astype(np.int32), bgr[:, :, 0].astype(np.int32)))
+            retVal = np.empty_like(bgr)
+            for i in range(3):
+                retVal[:, :, 2 - i] = np.clip(result[i], 0, 255)
+            return Image.fromArray(retVal)
+
         pixels = np.array(self.getNumpy()).reshape(-1,3).tolist()
-        result = np.array(map(theFunc,pixels),dtype=uint8).reshape(self.width,self.height,3)
+        result = np.clip(map(theFunc,pixels), 0, 255).astype(np.uint8).reshape(self.width,self.height,3)
         return Image(result)
 
+    @staticmethod
+    def compilePixelFunction(theFunc, vectorized=False, lut="color"):
+        """
+        **SUMMARY**
+
+        Evaluate a per pixel function over every possible input once and return
+        the result as a look up table that applyLUT can apply to any image.
+
+        **PARAMETERS**
+
+        * *theFunc* - a function of the form (r,g,b) = theFunc((r,g,b)), see applyPixelFunction.
+        * *vectorized* - if True theFunc accepts a tuple of channel arrays. Compiling
+          a "color" table without this calls theFunc 16.7 million times.
+        * *lut* - "channel" for a 256x3 table of per channel r,g,b outputs, or
+          "color" for a 256x256x256x3 table indexed by [r,g,b].
+
+        **RETURNS**
+
+        A uint8 numpy array.
+
+        **EXAMPLE**
+
+        >>> def warm((r,g,b)):
+        >>>     return (r*1.1, g, b*0.9)
+        >>>
+        >>> table = Image.compilePixelFunction(warm, vectorized=True, lut="color")
+        >>> cam = Camera()
+        >>> while True:
+        >>>     cam.getImage().applyLUT(colorLUT=table).show()
+
+        **SEE ALSO**
+
+        :py:meth:`applyPixelFunction`
+        :py:meth:`applyLUT`
+
+        """
+        if( lut == "channel" ):
+            values = np.arange(256, dtype=np.int32)
+            if( vectorized ):
+                result = theFunc((values, values, values))
+            else:
+                result = zip(*map(theFunc, [(v, v, v) for v in range(256)]))
+            table = np.empty((256, 3), dtype=np.uint8)
+            for i in range(3):
+                table[:, i] = np.clip(result[i], 0, 255)
+            return table
+        elif( lut == "color" ):
+            #evaluate one red plane at a time to keep the temporaries small
+            table = np.empty((256, 256, 256, 3), dtype=np.uint8)
+            g, b = np.indices((256, 256), dtype=np.int32)
+            for r in range(256):
+                if( vectorized ):
+                    result = theFunc((np.zeros_like(g) + r, g, b))
+                    for i in range(3):
+                        table[r, :, :, i] = np.clip(result[i], 0, 255)
+                else:
+                    pixels = [(r, gg, bb) for gg in range(256) for bb in range(256)]
+                    table[r] = np.clip(map(theFunc, pixels), 0, 255).reshape(256, 256, 3)
+            return table
+        else:
+            raise ValueError("Image.compilePixelFunction: lut must be 'channel' or 'color'")
+
 
     def integralImage(self,tilted=False):
         """
@@ -7443,7 +8270,8 @@ class Image:
 
         **RETURNS**
 
-        A numpy array of the values.
+        A numpy array of the values. The array is a copy of the one cached with
+        the image, so it may be modified freely.
 
         **EXAMPLE**
 
@@ -7454,6 +8282,17 @@ class Image:
 
         http://en.wikipedia.org/wiki/Summed_area_table
         """
+        return self._getIntegralImage(tilted).copy()
+
+    def _getIntegralImage(self, tilted=False):
+        """
+        Return the integral image cached with the image. The array is shared by
+        every caller, so it is read only; integralImage returns a copy of it.
+        """
+        cache = self._getDerivedCache()
+        retVal = cache.get(("integral", tilted))
+        if retVal is not None:
+            return retVal
 
         if(tilted):
             img2 = cv.CreateImage((self.width+1, self.height+1), cv.IPL_DEPTH_32F, 1)
@@ -7462,7 +8301,9 @@ class Image:
         else:
             img2 = cv.CreateImage((self.width+1, self.height+1), cv.IPL_DEPTH_32F, 1)
             cv.Integral(self._getGrayscaleBitmap(),img2)
-        return np.array(cv.GetMat(img2))
+        retVal = np.array(cv.GetMat(img2))
+        retVal.flags.writeable = False
+        return cache.put(("integral", tilted), retVal)
 
 
     def convolve(self,kernel = [[1,0,0],[0,1,0],[0,0,1]],center=None):
@@ -8003,7 +8844,7 @@ class Image:
             retVal = img.applyLUT(bLUT,rLUT,gLUT)
         return retVal
 
-    def applyLUT(self,rLUT=None,bLUT=None,gLUT=None):
+    def applyLUT(self,rLUT=None,bLUT=None,gLUT=None,colorLUT=None):
         """
         **SUMMARY**
 
@@ -8016,6 +8857,10 @@ class Image:
         * *rLUT* - a tuple or np.array of size (256x1) with dtype=uint8.
         * *gLUT* - a tuple or np.array of size (256x1) with dtype=uint8.
         * *bLUT* - a tuple or np.array of size (256x1) with dtype=uint8.
+        * *colorLUT* - a np.array of size (256x256x256x3) with dtype=uint8 that maps
+          every color, indexed as colorLUT[r,g,b], to an (r,g,b) result. This handles
+          mappings where the channels depend on each other. When it is given the per
+          channel tables are ignored. See compilePixelFunction.
 
         .. warning::
           The dtype is very important. Will throw the following error without it:
@@ -8040,6 +8885,13 @@ class Image:
         This method seems to error on the LUT map for some versions of OpenCV.
         I am trying to figure out why. -KAS
         """
+        if(colorLUT is not None):
+            bgr = self.getNumpyCv2()
+            index = bgr[:, :, 2].astype(np.int32) << 16
+            index |= bgr[:, :, 1].astype(np.int32) << 8
+            index |= bgr[:, :, 0]
+            rgb = np.take(colorLUT.reshape(-1, 3), index, axis=0)
+            return Image.fromArray(rgb[:, :, ::-1])
         r = self.getEmpty(1)
         g = self.getEmpty(1)
         b = self.getEmpty(1)
@@ -8165,8 +9017,11 @@ class Image:
             warnings.warn("Invalid choice of keypoint detector.")
             return (None, None)
 
-        if self._mKeyPoints != None and self._mKPFlavor == flavor:
+        kpKey = (flavor, thresh, highQuality)
+        if (self._mKeyPoints != None and self._mKPKey == kpKey
+                and self._bufferIsCurrent("_mKeyPoints")):
             return (self._mKeyPoints, self._mKPDescriptors)
+        self._mKPKey = None
 
         if hasattr(cv2, flavor):
 
@@ -8216,6 +9071,9 @@ class Image:
         else:
             warnings.warn("SimpleCV can't seem to find appropriate function with your OpenCV version.")
             return (None, None)
+        self._mKPFlavor = kpKey[0]
+        self._mKPKey = kpKey
+        self._stampBuffer("_mKeyPoints")
         return (self._mKeyPoints, self._mKPDescriptors)
 
     def _getFLANNMatches(self,sd,td):
@@ -8796,7 +9654,8 @@ class Image:
         ImageClass.findBlobsFromPalette(self, palette_selection, dilate = 0, minsize=5, maxsize=0)
         """
         if( self._mPaletteBins != bins or
-            self._mDoHuePalette != hue ):
+            self._mDoHuePalette != hue or
+            not self._bufferIsCurrent("_mPalette") ):
             total = float(self.width*self.height)
             percentages = []
             result = None
@@ -8841,6 +9700,7 @@ class Image:
             self._mPaletteBins = bins
             self._mPalette = np.array(result[0],dtype='uint8')
             self._mPalettePercentages = percentages
+            self._stampBuffer("_mPalette")
 
 
     def getPalette(self,bins=10,hue=False,centroids=None):
@@ -8951,6 +9811,7 @@ class Image:
             retVal._mPalette = palette
             pixels = np.array(self.getNumpy()).reshape(-1, 3)
             retVal._mPaletteMembers = scv.vq(pixels,palette)[0]
+        retVal._stampBuffer("_mPalette")
 
         percentages = []
         total = self.width*self.height
@@ -9866,7 +10727,7 @@ class Image:
         The transform can be applied to a single channel gray image or to each channel of the
         image. Each channel generates a 64F 2 channel IPL image corresponding to the real
         and imaginary components of the DFT. A list of these IPL images are then cached
-        in the private member variable _DFT.
+        in the private member variable _DFT and in the image's derived buffer cache.
 
 
         **PARAMETERS**
@@ -9896,6 +10757,13 @@ class Image:
         http://opencv.itseez.com/modules/core/doc/operations_on_arrays.html#getoptimaldftsize
 
         """
+        if( not self._bufferIsCurrent("_DFT") ):
+            self._DFT = []
+        #_DFT holds the last transform, the derived cache can hold both flavors
+        cache = self._getDerivedCache()
+        cached = cache.get(("dft", bool(grayscale)))
+        if( cached is not None ):
+            self._DFT = cached
         if( grayscale and (len(self._DFT) == 0 or len(self._DFT) == 3)):
             self._DFT = []
             img = self._getGrayscaleBitmap()
@@ -9930,6 +10798,8 @@ class Image:
                 cv.Merge(data,blank,None,None,dst)
                 cv.DFT(src, dst, cv.CV_DXT_FORWARD)
                 self._DFT.append(dst)
+        cache.put(("dft", bool(grayscale)), self._DFT)
+        self._stampBuffer("_DFT")
 
     def _getDFTClone(self,grayscale=False):
         """
@@ -11247,7 +12117,13 @@ class Image:
         #got some corner cases to catch here
         p0p = np.array([(pt0[0]-x,pt0[1]-y)])
         p1p = np.array([(pt1[0]-x,pt1[1]-y)])
-        edges = self.crop(x,y,w,h)._getEdgeMap(canny1, canny2)
+        #Canny runs on the crop, its edges differ from the full frame's near the crop
+        #border, so the crop's edge map is cached under the crop rectangle
+        cache = self._getDerivedCache()
+        key = ("canny", canny1, canny2, (int(x), int(y), int(w), int(h)))
+        edges = cache.get(key)
+        if edges is None:
+            edges = cache.put(key, self.crop(x,y,w,h)._getEdgeMap(canny1, canny2))
         line = cv.CreateImage((w,h),cv.IPL_DEPTH_8U,1)
         cv.Zero(line)
         cv.Line(line,((pt0[0]-x),(pt0[1]-y)),((pt1[0]-x),(pt1[1]-y)),cv.Scalar(255.00),width,8)
@@ -11548,7 +12424,8 @@ class Image:
 
         **RETURNS**
 
-        An array of the pixel values.
+        An array of the pixel values. Points of the line outside the image take the
+        value of the nearest pixel on the image border.
 
         **EXAMPLE**
 
@@ -11563,18 +12440,18 @@ class Image:
         :py:meth:`getVertScanline`
 
         """
-        if not self.isGray():
-            self = self.toGray()
-        #self = self._getGrayscaleBitmap()
+        #fitEdge samples many scanlines of one frame, so read them all from the
+        #image's cached grayscale array instead of converting the frame each time
+        gray = self.getGrayNumpyCv2()
         width = round(math.sqrt(math.pow(pt2[0]-pt1[0],2) + math.pow(pt2[1]-pt1[1],2)))
-        retVal = np.zeros(width)
-        
-        for x in range(0, retVal.size):
-            xind = pt1[0] + int(round((pt2[0]-pt1[0])*x/retVal.size))
-            yind = pt1[1] + int(round((pt2[1]-pt1[1])*x/retVal.size))
-            current_pixel = self.getPixel(xind,yind)
-            retVal[x] = current_pixel[0]
-        return retVal
+        size = int(width)
+        steps = np.arange(size)
+        xind = (pt1[0] + np.round((pt2[0]-pt1[0])*steps/size)).astype(int)
+        yind = (pt1[1] + np.round((pt2[1]-pt1[1])*steps/size)).astype(int)
+        #points past the image border read the nearest border pixel
+        xind = np.clip(xind, 0, self.width - 1)
+        yind = np.clip(yind, 0, self.height - 1)
+        return gray[yind, xind].astype(float)
 
     def fitLines(self,guesses,window=10,threshold=128):
         """
@@ -12153,6 +13030,8 @@ class Image:
         return dict( size = self.size(), colorspace = self._colorSpace, image = self.applyLayers().getBitmap().tostring() )
 
     def __setstate__(self, mydict):
+        self._mBufferGenerations = {}
+        self._DFT = []
         self._bitmap = cv.CreateImageHeader(mydict['size'], cv.IPL_DEPTH_8U, 3)
         cv.SetData(self._bitmap, mydict['image'])
         self._colorSpace = mydict['colorspace']
@@ -1,4 +1,6 @@
 from SimpleCV.base import *
+import atexit
+import cv2
 
 
 _jpegstreamers = {}
@@ -35,7 +37,7 @@ class JpegStreamHandler(SimpleHTTPRequestHandler):
             return
 
 
-        elif (self.path == "/stream"):
+        elif (self.path.split("?")[0] == "/stream"):
             self.send_response(200)
             self.send_header("Connection", "close")
             self.send_header("Max-Age", "0")
@@ -45,28 +47,32 @@ class JpegStreamHandler(SimpleHTTPRequestHandler):
             self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=--BOUNDARYSTRING")
             self.end_headers()
             (host, port) = self.server.socket.getsockname()[:2]
+            streamer = _jpegstreamers[port]
 
+            #a client can ask for a slower stream with /stream?fps=5
+            interval = streamer.sleeptime
+            match = re.search("[?&]fps=([0-9.]+)", self.path)
+            if match and float(match.group(1)) > 0:
+                interval = max(interval, 1.0 / float(match.group(1)))
 
-            count = 0
             timeout = 0.75
-            lasttimeserved = 0
+            frameid = None
             while (1):
-                if (_jpegstreamers[port].refreshtime > lasttimeserved or time.time() - timeout > lasttimeserved):
-                    try:
-                        self.wfile.write("--BOUNDARYSTRING\r\n")
-                        self.send_header("Content-type", "image/jpeg")
-                        self.send_header("Content-Length", str(len(_jpegstreamers[port].jpgdata.getvalue())))
-                        self.end_headers()
-                        self.wfile.write(_jpegstreamers[port].jpgdata.getvalue() + "\r\n")
-                        lasttimeserved = time.time()
-                    except socket.error, e:
-                        return
-                    except IOError, e:
-                        return
-                    count = count + 1
-
-
-                time.sleep(_jpegstreamers[port].sleeptime)
+                #wait for a frame this client hasn't seen, frames that arrive
+                #while it is still writing the last one are skipped
+                (frameid, part) = streamer.waitFrame(frameid, timeout)
+                if part is None:
+                    continue
+                served = time.time()
+                try:
+                    self.wfile.write(part)
+                except socket.error, e:
+                    return
+                except IOError, e:
+                    return
+                wait = interval - (time.time() - served)
+                if wait > 0:
+                    time.sleep(wait)
 
 
 
@@ -97,12 +103,20 @@ class JpegStreamer():
     webbrowser.open(js.url)
 
 
-    Note 3 optional parameters on the constructor:
+    Note 4 optional parameters on the constructor:
     - port (default 8080) which sets the TCP port you need to connect to
-    - sleep time (default 0.1) how often to update.  Above 1 second seems to cause dropped connections in Google chrome
+    - sleep time (default 0.1) the shortest time between two frames sent to a client.  Above 1 second seems to cause dropped connections in Google chrome
+    - quality (default 75) the JPEG quality, from 1 to 100
+    - resolution (default None) a (width, height) every frame is scaled to before it is encoded
+
 
+    Each frame is encoded once, however many clients are connected, and clients
+    are woken as soon as it arrives. A client that can't keep up is sent the
+    newest frame when it is ready for one, it never holds up the others.
+    Clients can ask for fewer frames with a url like http://localhost:8080/stream?fps=5
 
-    Once initialized, the buffer and sleeptime can be modified and will function properly -- port will not.
+
+    Once initialized, the buffer, sleeptime, quality and resolution can be modified and will function properly -- port will not.
     """
     server = ""
     host = ""
@@ -111,9 +125,11 @@ class JpegStreamer():
     framebuffer = ""
     counter = 0
     refreshtime = 0
+    quality = 75
+    resolution = None
 
 
-    def __init__(self, hostandport = 8080, st=0.1 ):
+    def __init__(self, hostandport = 8080, st=0.1, quality=75, resolution=None ):
         global _jpegstreamers
         if (type(hostandport) == int):
             self.port = hostandport
@@ -126,6 +142,12 @@ class JpegStreamer():
 
 
         self.sleeptime = st
+        self.quality = quality
+        self.resolution = resolution
+        self._mCondition = threading.Condition()
+        self._mFrameId = 0
+        self._mPart = None
+        self.jpgdata = ""
         self.server = JpegTCPServer((self.host, self.port), JpegStreamHandler)
         self.server_thread = threading.Thread(target = self.server.serve_forever)
         _jpegstreamers[self.port] = self
@@ -134,6 +156,61 @@ class JpegStreamer():
         self.framebuffer = self #self referential, ugh.  but gives some bkcompat
 
 
+    def writeFrame(self, img, **params):
+        """
+        Encode the image and send it to every connected client. This is called by
+        img.save(js), params may include quality to override the streamer's.
+        """
+        quality = int(params.get("quality", self.quality))
+        if self.resolution is not None and img.size() != tuple(self.resolution):
+            img = img.scale(self.resolution[0], self.resolution[1])
+
+        data = None
+        try:
+            if img.isGray():
+                pixels = img.getGrayNumpyCv2()
+            else:
+                pixels = img.getNumpyCv2()
+            (ok, buf) = cv2.imencode(".jpg", pixels, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if ok:
+                data = buf.tostring()
+        except Exception:
+            data = None
+        if data is None:
+            jpgdata = StringIO()
+            img.getPIL().save(jpgdata, "jpeg", quality=quality)
+            data = jpgdata.getvalue()
+
+        #the whole multipart chunk is built once and shared by every client
+        part = ("--BOUNDARYSTRING\r\nContent-type: image/jpeg\r\nContent-Length: "
+                + str(len(data)) + "\r\n\r\n" + data + "\r\n")
+        self._mCondition.acquire()
+        try:
+            self.jpgdata = data
+            self._mPart = part
+            self._mFrameId += 1
+            self.counter += 1
+            self.refreshtime = time.time()
+            self._mCondition.notifyAll()
+        finally:
+            self._mCondition.release()
+
+
+    def waitFrame(self, lastid=None, timeout=None):
+        """
+        Wait up to timeout seconds for a frame newer than lastid and return
+        (frameid, multipart chunk). On a timeout the current frame is returned
+        again, the chunk is None until the first frame is written.
+        """
+        self._mCondition.acquire()
+        try:
+            if self._mFrameId == lastid or self._mPart is None:
+                self._mCondition.wait(timeout)
+            return (self._mFrameId, self._mPart)
+        finally:
+            self._mCondition.release()
+
+
     def url(self):
         """
         Returns the JpegStreams Webbrowser-appropriate URL, if not provided in the constructor, it defaults to "http://localhost:8080"
@@ -150,6 +227,29 @@ class JpegStreamer():
 
 
 
+#the fourcc used for each file extension, anything else falls back to IYUV
+_videofourcc = {
+    "avi" : "XVID",
+    "mkv" : "XVID",
+    "mp4" : "mp4v",
+    "m4v" : "mp4v",
+    "mov" : "mp4v",
+    "mpg" : "PIM1",
+    "mpeg" : "PIM1",
+    "wmv" : "WMV2",
+    "flv" : "FLV1",
+}
+
+#streams with an encoder thread, flushed at exit if they weren't closed
+_videostreams = []
+
+def _closeVideoStreams():
+    for vs in list(_videostreams):
+        vs.close()
+
+atexit.register(_closeVideoStreams)
+
+
 class VideoStream():
     """
     The VideoStream lets you save video files in a number of different formats.
@@ -182,8 +282,30 @@ class VideoStream():
 
 
         my_camera.getImage().save(vs)
+
+
+    The codec is picked from the file extension (XVID for .avi and .mkv, mp4v for
+    .mp4 and .mov, PIM1 for .mpg, WMV2 for .wmv, FLV1 for .flv and uncompressed
+    IYUV otherwise), or can be given as a four character code::
+
+
+        vs = VideoStream("myvideo.avi", fourcc="MJPG")
+
+
+    Frames are encoded on a background thread, so saving one only queues it. Up to
+    buffersize frames can wait in the queue. When it is full the droppolicy decides
+    what happens: "block" waits for the encoder to catch up, "drop-oldest" throws
+    away the oldest waiting frame and counts it in droppedframes. A frame that
+    framefill repeats is queued once and written as many times as it is needed.
+    Each saved frame is copied once when it is queued, so the image can be changed
+    or reused straight after saving it.
+    If the encoder fails the error is logged and kept in encodeerror, and the
+    frames saved after that are counted in droppedframes instead of waiting on
+    it. Call close() when you are done to finish writing the file. threaded=False
+    encodes each frame as it is saved, like a plain writer.
     """
 
+    DROP_POLICIES = ["block", "drop-oldest"]
 
     fps = 25
     filename = ""
@@ -193,26 +315,86 @@ class VideoStream():
     videotime = 0.0
     starttime = 0.0
     framecount = 0
+    droppedframes = 0
+    encodeerror = None
 
 
-    def __init__(self, filename, fps = 25, framefill = True):
-        (revextension, revname) = filename[::-1].split(".")
-        extension = revextension[::-1]
+    def __init__(self, filename, fps = 25, framefill = True, fourcc = None, buffersize = 32, droppolicy = "block", threaded = True):
+        if droppolicy not in self.DROP_POLICIES:
+            raise ValueError("VideoStream: droppolicy must be one of " + str(self.DROP_POLICIES))
+        extension = os.path.splitext(filename)[1][1:].lower()
         self.filename = filename
         self.fps = fps
         self.framefill = framefill
-        #if extension == "mpg":
-        self.fourcc = cv.CV_FOURCC('I', 'Y', 'U', 'V')
-            #self.fourcc = 0
-        #else:
-        #  logger.warning(extension + " is not supported for video writing on this platform, sorry");
-        #  return False
+        if fourcc is None:
+            fourcc = _videofourcc.get(extension, "IYUV")
+        self.fourcc = cv.CV_FOURCC(*fourcc)
+        self.droppolicy = droppolicy
+        self.threaded = threaded
+        self._mQueue = Queue.Queue(max(1, buffersize))
+        self._mThread = None
+        self._mLastPixels = None
 
 
     def initializeWriter(self, size):
-        self.writer = cv.CreateVideoWriter(self.filename, self.fourcc, self.fps, size, 1)
+        self.writer = cv2.VideoWriter(self.filename, self.fourcc, self.fps, size, True)
+        if not self.writer.isOpened():
+            logger.warning("Couldn't open " + self.filename + " for writing, is the codec for this extension installed?")
         self.videotime = 0.0
         self.starttime = time.time()
+        if self.threaded:
+            self._mThread = threading.Thread(target = self._encode)
+            self._mThread.daemon = True
+            self._mThread.start()
+            _videostreams.append(self)
+
+
+    def _encode(self):
+        #the encoder thread, an item is (pixels, times to write them) and None ends it
+        while True:
+            item = self._mQueue.get()
+            if item is None:
+                return
+            (pixels, count) = item
+            try:
+                for i in range(count):
+                    self.writer.write(pixels)
+            except Exception, e:
+                #stop here, _queueFrame and close see the thread is gone
+                self.encodeerror = e
+                logger.warning("VideoStream: writing to " + self.filename + " failed, no more frames will be written: " + str(e))
+                return
+
+
+    def _queueFrame(self, pixels, count):
+        #framecount only counts frames that are written or on their way to
+        #the encoder, so framefill keeps the file in step with the clock
+        if count <= 0:
+            return
+        if self._mThread is None:
+            for i in range(count):
+                self.writer.write(pixels)
+            self.framecount += count
+            return
+        while self._mThread.isAlive():
+            try:
+                if self.droppolicy == "block":
+                    self._mQueue.put((pixels, count), timeout=0.1)
+                else:
+                    self._mQueue.put_nowait((pixels, count))
+                self.framecount += count
+                return
+            except Queue.Full:
+                pass
+            if self.droppolicy != "block":
+                try:
+                    dropped = self._mQueue.get_nowait()[1]
+                    self.droppedframes += dropped
+                    self.framecount -= dropped
+                except Queue.Empty:
+                    pass
+        #the encoder has failed, the frames go nowhere
+        self.droppedframes += count
 
 
     def writeFrame(self, img):
@@ -223,9 +405,12 @@ class VideoStream():
         image markup is not implicit,typically you use image.save() but
         this allows for more finer control
         """
+        #copy each saved frame once, the caller may draw on or reuse the image
+        #before the encoder gets to it; framefill repeats share this copy
+        pixels = np.array(img.getNumpyCv2())
         if not self.writer:
             self.initializeWriter(img.size())
-            self.lastframe = img
+            self._mLastPixels = pixels
 
 
         frametime = 1.0 / float(self.fps)
@@ -236,6 +421,7 @@ class VideoStream():
             if (targettime > realtime + frametime):
                 #if we're more than one frame ahead
                 #save the lastframe, but don't write to videoout
+                self._mLastPixels = pixels
                 self.lastframe = img
                 return
 
@@ -246,23 +432,36 @@ class VideoStream():
                 #figure out how many frames behind we are
 
 
-                lastframes = framesbehind / 2
-                for i in range(0, lastframes):
-                    self.framecount += 1
-                    cv.WriteFrame(self.writer, self.lastframe.getBitmap())
-
-
-                theseframes = framesbehind - lastframes
-                for i in range(0, theseframes):
-                    self.framecount += 1
-                    cv.WriteFrame(self.writer, img.getBitmap())
                 #split missing frames evenly between the prior and current frame
+                lastframes = framesbehind / 2
+                self._queueFrame(self._mLastPixels, lastframes)
+                self._queueFrame(pixels, framesbehind - lastframes)
             else: #we are on track
-                self.framecount += 1
-                cv.WriteFrame(self.writer, img.getBitmap())
+                self._queueFrame(pixels, 1)
         else:
-            cv.WriteFrame(self.writer, img.getBitmap())
-            self.framecount += 1
+            self._queueFrame(pixels, 1)
 
 
+        self._mLastPixels = pixels
         self.lastframe = img
+
+
+    def close(self):
+        """
+        Write out the frames still waiting in the queue and finish the file.
+        """
+        if self._mThread is not None:
+            while self._mThread.isAlive():
+                try:
+                    self._mQueue.put(None, timeout=0.1)
+                    break
+                except Queue.Full:
+                    pass
+            self._mThread.join()
+            self._mThread = None
+            if self in _videostreams:
+                _videostreams.remove(self)
+        if self.writer:
+            if hasattr(self.writer, "release"):
+                self.writer.release()
+            self.writer = ""
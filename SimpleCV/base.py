@@ -12,6 +12,7 @@ import types
 import SocketServer
 import threading
 import tempfile
+import shutil
 import zipfile
 import pickle
 import glob #for directory scanning
@@ -34,6 +35,10 @@ import copy
 import types
 import time
 import itertools #for track
+import collections
+import multiprocessing
+import Queue
+import weakref
 
 from numpy import linspace
 from scipy.interpolate import UnivariateSpline
@@ -436,6 +441,110 @@ class LazyProperty(object):
         result = obj.__dict__[self.__name__] = self._func(obj)
         return result
 
+#default byte budget of each image's cache of derived buffers (edges, integral images, DFTs),
+#kept to a few buffers because every image in a set carries its own cache. It holds one
+#float integral image plus one Canny map of a 5 megapixel frame (about 20 MB + 5 MB),
+#as the cache never stores a buffer bigger than its budget.
+DERIVED_CACHE_BUDGET = 32*1024*1024
+#default byte budget of the per camera caches of decoded frames and rectification maps
+FRAME_CACHE_BUDGET = 64*1024*1024
+
+def buffer_nbytes(value):
+    """
+    Estimate how many bytes of pixel data a numpy array, OpenCV image /
+    matrix, or a list of them holds. Other objects can report their size
+    through an nbytes attribute.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum([buffer_nbytes(v) for v in value])
+    if type(value) == cv.iplimage:
+        return value.width * value.height * value.nChannels * ((value.depth & 0xff) / 8)
+    if type(value) == cv.cvmat:
+        return value.step * value.rows
+    if hasattr(value, "nbytes"):
+        return value.nbytes
+    return sys.getsizeof(value)
+
+class BufferCache(object):
+    """
+    **SUMMARY**
+
+    A small least recently used cache for buffers derived from an image, keyed
+    by (operation, parameters). Once the cached buffers use more than budget
+    bytes the least recently used ones are evicted; a single buffer larger
+    than the budget is never cached. If evicted is given it is called with
+    each value that is pushed out of the cache, so that the value can release
+    whatever it holds.
+
+    **EXAMPLE**
+
+    >>> cache = BufferCache(budget=16*1024*1024)
+    >>> edges = cache.get(("canny", 50, 100))
+    >>> if edges is None:
+    >>>     edges = cache.put(("canny", 50, 100), computeEdges())
+
+    """
+
+    def __init__(self, budget=DERIVED_CACHE_BUDGET, evicted=None):
+        self.budget = budget
+        self.evicted = evicted
+        self.nbytes = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """
+        Return the buffer cached under key, marking it as most recently used.
+        """
+        try:
+            entry = self._entries.pop(key)
+        except KeyError:
+            return default
+        self._entries[key] = entry
+        return entry[0]
+
+    def put(self, key, value):
+        """
+        Cache value under key and return it.
+        """
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+        size = buffer_nbytes(value)
+        if size <= self.budget:
+            self._entries[key] = (value, size)
+            self.nbytes += size
+            self._evict()
+        return value
+
+    def setBudget(self, budget):
+        """
+        Change the byte budget, evicting entries if the cache is now over it.
+        """
+        self.budget = budget
+        self._evict()
+
+    def clear(self):
+        values = [value for value, size in self._entries.values()]
+        self._entries.clear()
+        self.nbytes = 0
+        if self.evicted is not None:
+            for value in values:
+                self.evicted(value)
+
+    def _evict(self):
+        while self.nbytes > self.budget and len(self._entries):
+            key, (value, size) = self._entries.popitem(last=False)
+            self.nbytes -= size
+            if self.evicted is not None:
+                self.evicted(value)
+
 #supported image formats regular expression ignoring case
 IMAGE_FORMATS = ('*.[bB][mM][Pp]','*.[Gg][Ii][Ff]','*.[Jj][Pp][Gg]','*.[jJ][pP][eE]',
 '*.[jJ][Pp][Ee][Gg]','*.[pP][nN][gG]','*.[pP][bB][mM]','*.[pP][gG][mM]','*.[pP][pP][mM]',
@@ -115,6 +115,35 @@ def test_findDisparityMap():
     name_stem = "test_disparitymapSGBM"
     perform_diff(dips,name_stem)
 
+def test_findDisparityMap_pyramid():
+    img1 = Image(correct_pairs[0][0])
+    img2 = Image(correct_pairs[0][1])
+    StereoImg = StereoImage(img1,img2)
+    for method in ["BM", "SGBM"]:
+        disp = StereoImg.findDisparityMap(nDisparity=64, method=method, levels=2)
+        if not disp or disp.size() != img1.size():
+            assert False
+        again = StereoImg.findDisparityMap(nDisparity=64, method=method, levels=2)
+        if again is disp or not np.array_equal(again.getNumpy(), disp.getNumpy()):
+            assert False
+        #drawing on one result must not change the next one
+        disp.getNumpyCv2()[:] = 0
+        if not StereoImg.findDisparityMap(nDisparity=64, method=method, levels=2).getNumpy().any():
+            assert False
+    Q = np.eye(4)
+    if not StereoImg.get3DImageFromDisparity(disp, Q):
+        assert False
+
+def test_findDisparityMap_pyramid_search():
+    img1 = Image(correct_pairs[0][0])
+    img2 = Image(correct_pairs[0][1])
+    StereoImg = StereoImage(img1,img2)
+    if not StereoImg.findDisparityMap(nDisparity=128, method="BM", levels=2, band=4):
+        assert False
+    #each tile only searches around its own coarse estimate, not the full range
+    if StereoImg._mDisparitySearch is None or StereoImg._mDisparitySearch >= 64:
+        assert False
+
 def test_eline():
     for pairs in correct_pairs :
         img1 = Image(pairs[0])
@@ -186,3 +215,22 @@ def test_getImagesUndistort():
         assert True
     else :
         assert False
+
+def test_StereoPipeline():
+    img1 = Image(correct_pairs[0][0]).resize(352,288)
+    img2 = Image(correct_pairs[0][1]).resize(352,288)
+    cam = StereoCamera()
+    calib = cam.loadCalibration("Stereo","./StereoVision/")
+    rectify = cam.stereoRectify(calib)
+    pipeline = cam.getPipeline(calib, rectify)
+    if pipeline is not cam.getPipeline(calib, rectify):
+        assert False
+    threaded = StereoPipeline(calib, rectify, threaded=True)
+    rectLeft, rectRight = pipeline.rectify(img1, img2)
+    tLeft, tRight = threaded.rectify(img1, img2)
+    if not np.all(rectLeft.getNumpy() == tLeft.getNumpy()) or not np.all(rectRight.getNumpy() == tRight.getNumpy()):
+        assert False
+    for i in range(2):
+        if not threaded.process(img1, img2):
+            assert False
+    threaded.close()
@@ -135,6 +135,19 @@ def test_image_numpy_constructor():
     else:
         assert False
 
+def test_image_fromarray():
+    img = Image(testimage)
+    frame = img.getNumpyCv2()
+    shared = Image.fromArray(frame)
+    viewed = Image.fromArray(img.getNumpy(), layout="simplecv")
+    copied = Image.fromArray(frame, copy=True)
+    frame[0,0] = (1, 2, 3)
+    if( shared[0,0] != (3, 2, 1) or viewed[0,0] != (3, 2, 1) or copied[0,0] == (3, 2, 1) ):
+        assert False
+    gray = Image.fromArray(np.zeros((20, 10), dtype=np.uint8))
+    if( gray.size() != (10, 20) ):
+        assert False
+
 def test_image_bitmap():
     img1 = Image("lenna")
     img2 = Image("lenna")
@@ -143,6 +156,20 @@ def test_image_bitmap():
     name_stem = "test_image_bitmap"
     perform_diff(result,name_stem)
 
+def test_image_buffer_views():
+    img = Image(testimage)
+    cv2np = img.getNumpyCv2()
+    np_view = img.getNumpy()
+    # both arrays are views over the same pixel buffer
+    cv2np[2,1] = (0, 0, 255) # BGR
+    if( tuple(np_view[1,2]) != (255, 0, 0) or img[1,2] != (255, 0, 0) ):
+        assert False
+    if( not cv2np.flags['C_CONTIGUOUS'] ):
+        assert False
+    pil_img = img.getPIL()
+    if( pil_img.getpixel((1,2)) != (255, 0, 0) ):
+        assert False
+
 # # Image Class Test
 
 def test_image_scale():
@@ -198,6 +225,32 @@ def test_image_setitem():
     perform_diff(result,name_stem)
 
 
+def test_image_setitem_derived_buffers():
+    img = Image(blackimage)
+    gray = img.getGrayNumpy()
+    edges = img._getEdgeMap()
+    img[0:20,0:20] = (255, 255, 255)
+    if( img.getGrayNumpy()[5,5] != 255 or gray is img.getGrayNumpy() ):
+        assert False
+    if( img._getEdgeMap() is edges ):
+        assert False
+
+def test_image_invalidate():
+    img = Image(blackimage)
+    before = img.getPIL()
+    img.getNumpyCv2()[0:10,0:10] = 255
+    img.invalidate()
+    #the stale buffers are released, not just marked stale
+    if( img._pil is not None or img._mDerivedCache is not None ):
+        assert False
+    after = img.getPIL()
+    if( before is after or after.getpixel((5,5)) != (255, 255, 255) ):
+        assert False
+    img.getPalette(bins=4)
+    img.invalidate()
+    if( img._mPaletteBins != 4 ):
+        assert False
+
 def test_image_setslice():
     img = Image(testimage)
     img[1:10,1:10] = (0,0,0) #make a black box
@@ -415,6 +468,53 @@ def test_detection_lines_standard():
     if(lines == 0 or lines == None):
         assert False
 
+def test_image_derived_cache():
+    img = Image(testimage2)
+    e1 = img._getEdgeMap(50, 100)
+    e2 = img._getEdgeMap(20, 80)
+    if( img._getEdgeMap(50, 100) is not e1 or img._getEdgeMap(20, 80) is not e2 ):
+        assert False
+    ii = img._getIntegralImage()
+    if( img._getIntegralImage() is not ii or ii.flags.writeable ):
+        assert False
+    #the public result is the caller's own copy
+    public = img.integralImage()
+    public[0, 0] = 1
+    if( public is ii or ii[0, 0] != 0 ):
+        assert False
+    img.setDerivedCacheBudget(0)
+    if( img._getEdgeMap(50, 100) is img._getEdgeMap(50, 100) ):
+        assert False
+
+def test_image_derived_cache_5mp():
+    #the default budget holds an integral image and an edge map of a 5 megapixel frame
+    img = Image((2592, 1944))
+    ii = img._getIntegralImage()
+    edges = img._getEdgeMap(50, 100)
+    if( img._getIntegralImage() is not ii or img._getEdgeMap(50, 100) is not edges ):
+        assert False
+
+def test_image_derived_cache_crops():
+    img = Image(testimage2)
+    a, b = (25, 100), (225, 110)
+    pts = img.edgeIntersections(a, b, width=3)
+    #the edges come from Canny on the crop, as before the cache
+    cached = img._getDerivedCache().get(("canny", 0, 100, (25, 100, 200, 10)))
+    fresh = img.crop(25, 100, 200, 10)._getEdgeMap(0, 100)
+    if( cached is None or np.any(np.asarray(cv.GetMat(cached)) != np.asarray(cv.GetMat(fresh))) ):
+        assert False
+    if( img.edgeIntersections(a, b, width=3) != pts ):
+        assert False
+    gray = img.toGray()
+    scan = img.getDiagonalScanlineGrey((10, 20), (90, 60))
+    expected = [gray.getPixel(10 + (80*i)/len(scan), 20 + (40*i)/len(scan))[0] for i in range(len(scan))]
+    if( list(scan) != expected ):
+        assert False
+    #endpoints past the border read the border instead of wrapping around
+    scan = img.getDiagonalScanlineGrey((-20, 5), (10, 5))
+    if( scan[0] != gray.getPixel(0, 5)[0] ):
+        assert False
+
 def test_detection_feature_measures():
     img = Image(testimage2)
 
@@ -938,6 +1038,83 @@ def test_camera_undistort():
     if (not img2): #right now just wait for this to return
         assert False
 
+def test_camera_framebuffer():
+    class FakeCamera:
+        index = 0
+        _threadcapturetime = 0
+
+    class FakeFrames(FrameBufferThread):
+        #hands out total frames of a stand-in image, then nothing
+        def __init__(self, total, *args, **kwargs):
+            FrameBufferThread.__init__(self, FakeCamera(), *args, **kwargs)
+            self.total = total
+            self.grabbed = 0
+            self.base = Image(testimage2)
+
+        def _grab(self):
+            if self.grabbed >= self.total:
+                return None, None
+            self.grabbed += 1
+            return self.base.copy(), time.time()
+
+    #nobody reads the queue, so nothing is queued or counted as dropped
+    thread = FakeFrames(20)
+    thread.start()
+    start = time.time()
+    while thread.frameindex < 20 and time.time() - start < 5:
+        time.sleep(0.01)
+    thread.stop()
+    if( thread.getLatest(1)[0].frameindex != 19 or thread.droppedframes != 0 or not thread.frames.empty() ):
+        assert False
+
+    #drop-oldest keeps only the newest frames for a queue reader
+    thread = FakeFrames(20, buffersize=2, droppolicy="drop-oldest")
+    thread.getFrame(0)
+    thread.start()
+    start = time.time()
+    while thread.frameindex < 20 and time.time() - start < 5:
+        time.sleep(0.01)
+    kept = [thread.getFrame(1)[0] for i in range(2)]
+    #the latest frame slot is read without taking anything
+    latest = thread.getLatest(1)[0]
+    if( latest is None or latest.frameindex != 19 or thread.getLatest(1)[0] is not latest ):
+        assert False
+    thread.stop()
+    if( thread.droppedframes != 18 or [img.frameindex for img in kept] != [18, 19] ):
+        assert False
+    if( thread.getFrame(0.1) != (None, None) ):
+        assert False
+
+    #block never loses a frame, and frames come out in order
+    thread = FakeFrames(20, buffersize=2, droppolicy="block")
+    thread.start()
+    frames = []
+    for i in range(20):
+        time.sleep(0.005)
+        frames.append(thread.getFrame(1))
+    thread.stop()
+    if( thread.droppedframes != 0 or None in [img for (img, t) in frames] ):
+        assert False
+    if( [img.frameindex for (img, t) in frames] != range(20) ):
+        assert False
+    times = [t for (img, t) in frames]
+    if( times != sorted(times) or [img.capturetime for (img, t) in frames] != times ):
+        assert False
+
+def test_camera_undistort_roi():
+    fakeCamera = FrameSource()
+    fakeCamera.loadCalibration("./StereoVision/Default")
+    img = Image("../sampleimages/CalibImage0.png")
+    full = fakeCamera.undistort(img)
+    part = fakeCamera.undistort(img, roi=(10, 20, 100, 50))
+    if( part.size() != (100, 50) ):
+        assert False
+    if( np.abs(part.getNumpy().astype(int) - full.crop(10, 20, 100, 50).getNumpy()).max() > 2 ):
+        assert False
+    small = fakeCamera.undistort(img, scale=0.5)
+    if( small.size() != (int(round(img.width*0.5)), int(round(img.height*0.5))) ):
+        assert False
+
 def test_image_crop():
     img = Image(logo)
     x = 5
@@ -1118,6 +1295,60 @@ def test_color_colormap_build():
     #  assert False
 
 
+def test_color_model_lut():
+    img = Image(testimage)
+    cm = ColorModel()
+    cm.add(img.crop(0, 0, 20, 20))
+    cm.add((127,127,127))
+    if( not cm.contains((127,127,127)) ):
+        assert False
+
+    #compare the table lookup against a per pixel lookup
+    rs = np.right_shift(img.getNumpy(), cm.mBits).reshape(-1, 3)
+    known = set(map(np.ndarray.tostring, np.right_shift(img.crop(0, 0, 20, 20).getNumpy(), cm.mBits).reshape(-1, 3)))
+    known.add(np.right_shift(np.array((127,127,127), 'uint8'), cm.mBits).tostring())
+    mapped = np.array([k in known for k in map(np.ndarray.tostring, rs)])
+    expected = np.where(mapped, 0, 255).reshape(img.width, img.height)
+    result = cm.threshold(img).getGrayNumpy()
+    if( not np.all(result == expected) ):
+        assert False
+
+    cm.remove((127,127,127))
+    if( cm.contains((127,127,127)) ):
+        assert False
+
+
+def test_color_model_counts():
+    cm = ColorModel()
+    cm.add((10,20,30))
+    cm.add((10,20,30))
+    if( cm.getCount((10,20,30)) != 2 or cm.contains((10,20,30), minCount=3) ):
+        assert False
+    cm.subtract((10,20,30))
+    if( not cm.contains((10,20,30)) ):
+        assert False
+    cm.subtract((10,20,30))
+    if( cm.contains((10,20,30)) ):
+        assert False
+    cm.add([(10,20,30),(10,20,30),(40,50,60)])
+    cm.remove((10,20,30))
+    if( cm.contains((10,20,30)) or cm.getCount((40,50,60)) != 1 ):
+        assert False
+
+    img = Image(testimage)
+    cm.add(img)
+    cm.save("temp.bin", counts=True)
+    cm2 = ColorModel()
+    cm2.load("temp.bin", mmap=True)
+    if( not np.all(cm2.mCounts == cm.mCounts) ):
+        assert False
+    cm.save("temp.bin")
+    cm2.load("temp.bin")
+    if( not np.all(cm2.threshold(img).getGrayNumpy() == cm.threshold(img).getGrayNumpy()) ):
+        assert False
+    os.remove("temp.bin")
+
+
 def test_feature_height():
     imgA = Image(logo)
     lines = imgA.findLines(1)
@@ -1541,6 +1772,27 @@ def test_applyPixelFunc():
     perform_diff(results,name_stem)
     pass
 
+def test_applyPixelFunc_vectorized():
+    img = Image(logo).crop(0, 0, 40, 30)
+    def myFunc((r,g,b)):
+        return( (b,g/2,r) )
+    def brighten((r,g,b)):
+        return( (r+100,g+100,b+100) )
+
+    expected = img.applyPixelFunction(myFunc).getNumpy()
+    if( not np.all(img.applyPixelFunction(myFunc, vectorized=True).getNumpy() == expected) ):
+        assert False
+    if( not np.all(img.applyPixelFunction(myFunc, vectorized=True, lut="color").getNumpy() == expected) ):
+        assert False
+
+    expected = np.clip(img.getNumpy().astype(int) + 100, 0, 255)
+    if( not np.all(img.applyPixelFunction(brighten, vectorized=True, lut="channel").getNumpy() == expected) ):
+        assert False
+    if( not np.all(img.applyPixelFunction(brighten, lut="channel").getNumpy() == expected) ):
+        assert False
+    if( not np.all(img.applyPixelFunction(brighten).getNumpy() == expected) ):
+        assert False
+
 def test_applySideBySide():
     img = Image(logo)
     img3 = Image(testimage2)
@@ -1932,6 +2184,163 @@ def test_keypoint_extraction():
     name_stem = "test_keypoint_extraction"
     perform_diff(results,name_stem,tolerance=4.0)
 
+def test_keypoint_cache_threshold():
+    try:
+        import cv2
+    except:
+        pass
+        return
+
+    img = Image("../sampleimages/KeypointTemplate2.png")
+    kp300,d300 = img._getRawKeypoints(thresh=300)
+    kp3000,d3000 = img._getRawKeypoints(thresh=3000)
+    if( kp3000 is not None and len(kp3000) >= len(kp300) ):
+        assert False
+    if( img._getRawKeypoints(thresh=300)[0] is kp300 ):
+        assert False
+
+
+def test_haarlike_feature_extractor():
+    img = Image(testimage2)
+    haar = HaarLikeFeatureExtractor(fname="../Features/haar.txt")
+    feats = haar.extract(img)
+    if( len(feats) != haar.getNumFields() ):
+        assert False
+    n = len(haar.mFeatureSet)
+    regular = [f.apply(img.integralImage()) for f in haar.mFeatureSet]
+    slant = [f.apply(img.integralImage(tilted=True)) for f in haar.mFeatureSet]
+    if( not np.allclose(feats[:n], regular, rtol=1e-4) or not np.allclose(feats[n:], slant, rtol=1e-4) ):
+        assert False
+
+def test_haarlike_feature_windows():
+    img = Image(testimage2)
+    haar = HaarLikeFeatureExtractor(fname="../Features/haar.txt", do45=False)
+    feats, windows = haar.extractWindows(img, windowSize=(32,32), stride=16, scales=(1.0,2.0))
+    if( feats.shape != (len(windows), len(haar.mFeatureSet)) ):
+        assert False
+    for i in [0, len(windows)-1]:
+        (x, y, w, h) = windows[i]
+        expected = haar.extract(img.crop(x, y, w, h))
+        if( not np.allclose(feats[i], expected, rtol=1e-3, atol=1.0) ):
+            assert False
+
+def test_bof_patches():
+    img = Image(testimage2)
+    bof = BOFFeatureExtractor(patchsz=(11,11))
+    data = bof._getPatches(img)
+    wsteps = img.width/11
+    hsteps = img.height/11
+    if( data.shape != (wsteps*hsteps, 121) ):
+        assert False
+    lmat = img.toHLS().getNumpyCv2()[:,:,1]
+    for i in [0, hsteps+1, len(data)-1]:
+        (widx, hidx) = divmod(i, hsteps)
+        patch = np.ascontiguousarray(lmat[hidx*11:(hidx+1)*11, widx*11:(widx+1)*11])
+        expected = cv2.equalizeHist(patch).reshape(121)
+        if( np.any(data[i] != expected) ):
+            assert False
+    bof.mCodebook = data[::7]
+    bof.mNumCodes = len(bof.mCodebook)
+    codes = bof._assignCodes(data, chunk=100)
+    dist = ((data[:,np.newaxis,:]-bof.mCodebook[np.newaxis,:,:])**2).sum(axis=2)
+    if( np.any(dist[np.arange(len(data)), codes] != dist.min(axis=1)) ):
+        assert False
+
+def test_bof_generate_minibatch():
+    bof = BOFFeatureExtractor()
+    checkpoint = "bofcheckpoint.npz"
+    bof.generate(["../sampleimages/"], numcodes=16, img_layout=(4,4), imgs_per_dir=4, verbose=False,
+                 method="minibatch", batchsize=500, checkpoint=checkpoint, seed=1)
+    if( bof.mCodebook is None or bof.mCodebook.shape != (16,121) ):
+        assert False
+    first = bof.mCodebook.copy()
+    #a finished checkpoint resumes straight to the same codebook
+    bof.generate(["../sampleimages/"], numcodes=16, img_layout=(4,4), imgs_per_dir=4, verbose=False,
+                 method="minibatch", batchsize=500, checkpoint=checkpoint, seed=1)
+    os.remove(checkpoint)
+    os.remove("codebook.png")
+    if( not np.allclose(first, bof.mCodebook) ):
+        assert False
+
+def test_jpegstreamer():
+    js = JpegStreamer(8189, quality=50, resolution=(80,60))
+    img = Image(testimage2)
+    img.save(js)
+    if( js.jpgdata[:2] != "\xff\xd8" ):
+        assert False
+    sock = socket.create_connection(("localhost", 8189))
+    sock.sendall("GET /stream HTTP/1.0\r\n\r\n")
+    fh = sock.makefile()
+    length = None
+    while length is None:
+        line = fh.readline()
+        if( not line ):
+            assert False
+        if( line.startswith("Content-Length") ):
+            length = int(line.split(":")[1])
+    fh.readline()
+    data = fh.read(length)
+    sock.close()
+    frame = cv2.imdecode(np.fromstring(data, np.uint8), 1)
+    if( data != js.jpgdata or frame is None or frame.shape[:2] != (60,80) ):
+        assert False
+    js.server.shutdown()
+
+def test_jpegstreamcamera():
+    js = JpegStreamer(8190, st=0.01)
+    img = Image(testimage2)
+    img.save(js)
+    cam = JpegStreamCamera(js.streamUrl(), buffersize=2)
+    frame = cam.getImage()
+    if( frame is None or frame.size() != img.size() ):
+        assert False
+    for i in range(5):
+        img.save(js)
+        time.sleep(0.05)
+    again = cam.getImage()
+    if( again is None or again.frameindex <= frame.frameindex ):
+        assert False
+    if( cam.camthread.droppedframes < 0 or cam.camthread.frameindex < 2 ):
+        assert False
+    cam.camthread.stop()
+    js.server.shutdown()
+
+def test_jpegstream_multiplexer():
+    img = Image(testimage2)
+    streamers = [JpegStreamer(8191, st=0.01), JpegStreamer(8192, st=0.01)]
+    mux = JpegStreamMultiplexer(workers=2, backoff=0.1, maxbackoff=0.5)
+    cams = [mux.addCamera(js.streamUrl()) for js in streamers]
+    dead = mux.addCamera("http://localhost:8193/stream") #nothing is listening here
+    for i in range(3):
+        for js in streamers:
+            img.save(js)
+        time.sleep(0.1)
+    for cam in cams:
+        frame = cam.getImage()
+        if( frame is None or frame.size() != img.size() ):
+            assert False
+    if( dead.getImage(timeout=0.5) is not None or dead.reconnects < 1 ):
+        assert False
+    mux.stop()
+    for js in streamers:
+        js.server.shutdown()
+
+def test_videostream_async():
+    img = Image(testimage2)
+    fname = "videostreamtest.avi"
+    vs = VideoStream(fname, fps=20, framefill=False, fourcc="MJPG", buffersize=4)
+    for i in range(10):
+        img.save(vs)
+    #the queued frames are copies, drawing on the image afterwards leaves them alone
+    img.getNumpyCv2()[:] = 0
+    if( not np.any(vs._mLastPixels) ):
+        assert False
+    vs.close()
+    if( vs.framecount != 10 or vs.droppedframes != 0 ):
+        assert False
+    if( not os.path.exists(fname) or os.path.getsize(fname) == 0 ):
+        assert False
+    os.remove(fname)
 
 def test_keypoint_match():
     try:
@@ -2384,6 +2793,43 @@ def test_findHaarFeatures():
     perform_diff(results,name_stem)
 
 
+def test_findHaarFeaturesHierarchy():
+    img = Image("../sampleimages/orson_welles.jpg")
+    feats = img.findHaarFeaturesHierarchy(["face_cv2.xml", "eye.xml"], parents={"eye.xml":"face_cv2.xml"})
+    faces = [f for f in feats if f.featureName == "face_cv2.xml"]
+    eyes = [f for f in feats if f.featureName == "eye.xml"]
+    if( len(faces) == 0 or len(faces) != len(img.findHaarFeatures("face_cv2.xml")) ):
+        assert False
+    for e in eyes:
+        p = e.parent
+        if( p is None or e not in p.children ):
+            assert False
+        if( e.points[0][0] < p.points[0][0] or e.points[2][0] > p.points[2][0] ):
+            assert False
+
+def test_haar_tracker():
+    img = Image("../sampleimages/orson_welles.jpg")
+    tracker = HaarTracker("face_cv2.xml", fullScan=3)
+    full = img.findHaarFeatures("face_cv2.xml")
+    for i in range(5):
+        #a slowly moving face
+        frame = img.crop(2*i, i, img.width - 10, img.height - 5)
+        faces = tracker.detect(frame)
+        if( len(faces) == 0 or len(faces) > len(full) ):
+            assert False
+
+def test_haar_classifier_cache():
+    face = HaarCascade("face_cv2.xml")
+    classifier = face.getClassifier()
+    if( classifier is None or HaarCascade("face_cv2.xml").getClassifier() is not classifier ):
+        assert False
+    others = []
+    t = threading.Thread(target=lambda: others.append(face.getClassifier()))
+    t.start()
+    t.join()
+    if( others[0] is None or others[0] is classifier ):
+        assert False
+
 def test_biblical_flood_fill():
     img = Image(testimage2)
     b = img.findBlobs()
@@ -3090,6 +3536,113 @@ def test_image_set_average():
 
 
 
+def test_image_set_map():
+    iset = ImageSet()
+    for i in range(4):
+        iset.append(Image("./../sampleimages/tracktest%d.jpg" % i))
+    serial = iset.map("resize", workers=1, args=(64, 48))
+    parallel = iset.map("resize", workers=2, args=(64, 48))
+    if( not isinstance(parallel, ImageSet) or len(parallel) != 4 ):
+        assert False
+    for s, p in zip(serial, parallel):
+        if( p.size() != (64, 48) or np.any(s.getNumpyCv2() != p.getNumpyCv2()) ):
+            assert False
+    sizes = iset.map(lambda img: img.size(), workers=2)
+    if( sizes != [img.size() for img in iset] ):
+        assert False
+    blobs = iset.map("findBlobs", workers=2)
+    for img, fs in zip(iset, blobs):
+        if( fs is not None and fs[0].image is not img ):
+            assert False
+
+def test_image_set_map_concurrent():
+    import threading
+    small = ImageSet([Image("./../sampleimages/tracktest%d.jpg" % i) for i in range(4)])
+    large = ImageSet([Image("./../sampleimages/tracktest%d.jpg" % i).resize(100, 80) for i in range(4)])
+    results = {}
+    def run(name, iset, func):
+        for i in range(5):
+            results.setdefault(name, []).append(iset.map(func, workers=2))
+    threads = [threading.Thread(target=run, args=("widths", small, lambda img: img.width)),
+               threading.Thread(target=run, args=("heights", large, lambda img: -img.height))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    #each call ran its own function on its own images
+    if( results["widths"] != [[img.width for img in small]] * 5 ):
+        assert False
+    if( results["heights"] != [[-80] * 4] * 5 ):
+        assert False
+
+def test_image_set_map_failure_cleanup():
+    from SimpleCV.ImageClass import _sharedMemoryDir
+    iset = ImageSet()
+    for i in range(4):
+        iset.append(Image("./../sampleimages/tracktest%d.jpg" % i))
+    def failing(img):
+        if( img is iset[3] ):
+            raise ValueError("failing worker")
+        return img.resize(64, 48)
+    before = set(os.listdir(_sharedMemoryDir()))
+    try:
+        iset.map(failing, workers=2)
+        assert False
+    except ValueError:
+        pass
+    if( set(os.listdir(_sharedMemoryDir())) - before ):
+        assert False
+
+def test_lazy_image_set():
+    imgs = LazyImageSet("../sampleimages/", cacheSize=2, prefetch=2)
+    eager = ImageSet("../sampleimages/")
+    if( len(imgs) < len(eager) or len(imgs._mCache) != 0 ):
+        assert False
+    first = imgs[0]
+    if( not isinstance(first, Image) or imgs[0] is not first ):
+        assert False
+    count = 0
+    for img in imgs:
+        count += 1
+    if( count != len(eager) or len(imgs._mCache) > 2 ):
+        assert False
+    if( not isinstance(imgs[1:3], LazyImageSet) ):
+        assert False
+
+def test_lazy_image_set_bad_file():
+    fname = "lazy_empty.png"
+    open(fname, "w").close()
+    imgs = LazyImageSet(["./../sampleimages/tracktest0.jpg", fname], prefetch=0)
+    if( imgs[1] is not None or len([img for img in imgs]) != 1 ):
+        assert False
+    imgs.prefetch = 2
+    if( len([img for img in imgs]) != 1 ):
+        assert False
+    os.remove(fname)
+
+def test_lazy_image_set_map():
+    paths = ["./../sampleimages/tracktest%d.jpg" % i for i in range(4)]
+    imgs = LazyImageSet(paths, cacheSize=4, prefetch=0)
+    blobs = imgs.map("findBlobs", workers=2)
+    #reattaching the features does not decode the images in this process
+    if( len(imgs._mCache) != 0 ):
+        assert False
+    for path, fs in zip(paths, blobs):
+        if( fs is not None and fs[0].image.size() != Image(path).size() ):
+            assert False
+
+def test_lazy_image_set_map_bad_file():
+    fname = "lazy_map_empty.png"
+    open(fname, "w").close()
+    paths = ["./../sampleimages/tracktest0.jpg", fname, "./../sampleimages/tracktest1.jpg"]
+    imgs = LazyImageSet(paths, prefetch=0)
+    #the undecodable file keeps its slot, serially and in the workers
+    for workers in [1, 2]:
+        sizes = imgs.map(lambda img: img.size(), workers=workers)
+        if( len(sizes) != 3 or sizes[1] is not None or sizes[2] != Image(paths[2]).size() ):
+            assert False
+    os.remove(fname)
+
 def test_save_to_gif():
     imgs = ImageSet()
     imgs.append(Image('../sampleimages/tracktest0.jpg'))
@@ -73,3 +73,32 @@ def test_camera_iset_directory():
         pass
     else:
         assert False
+
+def test_camera_video_index():
+    mycam = VirtualCamera(testvideo, "video")
+    frames = []
+    for i in range(40):
+        frames.append(mycam.getImage().getNumpyCv2().copy())
+    indexed = VirtualCamera(testvideo, "video", index=True, readahead=4)
+    for n in [30, 5, 6, 39, 1, 20]:
+        img = indexed.getFrame(n)
+        if( img is None or not np.array_equal(img.getNumpyCv2(), frames[n-1]) ):
+            assert False
+    indexed.rewind(10)
+    for n in range(10, 15):
+        if( not np.array_equal(indexed.getImage().getNumpyCv2(), frames[n-1]) ):
+            assert False
+    #drawing on a frame leaves the cached copy alone
+    indexed.getFrame(12).getNumpyCv2()[:] = 0
+    if( not np.array_equal(indexed.getFrame(12).getNumpyCv2(), frames[11]) ):
+        assert False
+    #the second open reuses the index written by the first
+    again = VirtualCamera(testvideo, "video", index=True)
+    if( len(again._mVideo.timestamps) != len(indexed._mVideo.timestamps) ):
+        assert False
+    indexed.close()
+    again.close()
+    if( indexed._mVideo._mThread is not None ):
+        assert False
+    if( os.path.exists(testvideo + ".index.npz") ):
+        os.remove(testvideo + ".index.npz")